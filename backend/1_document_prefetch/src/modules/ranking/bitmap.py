@@ -0,0 +1,534 @@
+import numpy as np
+from numba import njit
+
+
+"""
+    Compressed bitmap of uint32 doc ids (roaring-style).
+
+    The doc id space is split into chunks of 2^16 ids, addressed by the high 16 bits of the id (the "key").
+    Each non-empty chunk is stored in one of three container types, depending on which one is the smallest:
+        ARRAY:  sorted uint16 array of the low 16 bits                (2 bytes per id, used for sparse chunks)
+        BITMAP: 1024 uint64 words, bit i of the chunk is bit i%64 of word i//64    (8 KB, used for dense chunks)
+        RUN:    uint16 array of shape (n_runs, 2), [first, last] of each run of consecutive ids    (4 bytes per run)
+    A container is a tuple ( container_type, data, cardinality ).
+"""
+
+ARRAY = 0
+BITMAP = 1
+RUN = 2
+
+CHUNK_SIZE = 1 << 16
+BITMAP_WORDS = CHUNK_SIZE // 64
+ARRAY_MAX_SIZE = 4096
+## intersect two sorted arrays by galloping when one is this many times longer than the other
+GALLOPING_RATIO = 32
+
+
+@njit( nogil = True )
+def _popcount64( x ):
+    x = x - ( ( x >> np.uint64(1) ) & np.uint64(0x5555555555555555) )
+    x = ( x & np.uint64(0x3333333333333333) ) + ( ( x >> np.uint64(2) ) & np.uint64(0x3333333333333333) )
+    x = ( x + ( x >> np.uint64(4) ) ) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return np.int64( ( x * np.uint64(0x0101010101010101) ) >> np.uint64(56) )
+
+@njit( nogil = True )
+def _popcount_words( words ):
+    total = 0
+    for i in range( len(words) ):
+        total += _popcount64( words[i] )
+    return total
+
+@njit( nogil = True )
+def _bitmap_to_array( words, out ):
+    k = 0
+    for i in range( len(words) ):
+        w = words[i]
+        bit = 0
+        while w != np.uint64(0):
+            if w & np.uint64(1):
+                out[k] = i * 64 + bit
+                k += 1
+            w = w >> np.uint64(1)
+            bit += 1
+    return k
+
+@njit( nogil = True )
+def _set_bits( words, values ):
+    for i in range( len(values) ):
+        v = np.int64( values[i] )
+        words[v >> 6] |= np.uint64(1) << np.uint64( v & 63 )
+
+@njit( nogil = True )
+def _clear_bits( words, values ):
+    for i in range( len(values) ):
+        v = np.int64( values[i] )
+        words[v >> 6] &= ~( np.uint64(1) << np.uint64( v & 63 ) )
+
+@njit( nogil = True )
+def _test_bits( words, values, out ):
+    for i in range( len(values) ):
+        v = np.int64( values[i] )
+        out[i] = ( words[v >> 6] >> np.uint64( v & 63 ) ) & np.uint64(1)
+
+@njit( nogil = True )
+def _set_runs( words, runs ):
+    ## fill whole words at once, only the partial words at the ends of a run are masked
+    all_ones = ~np.uint64(0)
+    for r in range( runs.shape[0] ):
+        first = np.int64( runs[r,0] )
+        last = np.int64( runs[r,1] )
+        first_word = first >> 6
+        last_word = last >> 6
+        for w in range( first_word, last_word + 1 ):
+            mask = all_ones
+            if w == first_word:
+                mask &= all_ones << np.uint64( first & 63 )
+            if w == last_word:
+                mask &= all_ones >> np.uint64( 63 - ( last & 63 ) )
+            words[w] |= mask
+
+@njit( nogil = True )
+def _count_bitmap_runs( words ):
+    ## number of runs of consecutive 1s = number of 1s whose lower neighbour is 0
+    n_runs = 0
+    carry = np.uint64(0)
+    for i in range( len(words) ):
+        w = words[i]
+        starts = w & ~( ( w << np.uint64(1) ) | carry )
+        n_runs += _popcount64( starts )
+        carry = w >> np.uint64(63)
+    return n_runs
+
+@njit( nogil = True )
+def _bitmap_to_runs( words, out ):
+    k = 0
+    in_run = False
+    for i in range( len(words) ):
+        w = words[i]
+        if not in_run and w == np.uint64(0):
+            continue
+        if in_run and w == ~np.uint64(0):
+            continue
+        for bit in range(64):
+            is_set = ( ( w >> np.uint64(bit) ) & np.uint64(1) ) == np.uint64(1)
+            if is_set and not in_run:
+                out[k,0] = i * 64 + bit
+                in_run = True
+            elif not is_set and in_run:
+                out[k,1] = i * 64 + bit - 1
+                k += 1
+                in_run = False
+    if in_run:
+        out[k,1] = len(words) * 64 - 1
+        k += 1
+    return k
+
+@njit( nogil = True )
+def _split_chunks( ids, starts, n_runs ):
+    ## split sorted ids into chunks of equal high 16 bits in one pass: starts[c] is the start of chunk c and n_runs[c] its number of runs
+    n_chunks = 0
+    for i in range( len(ids) ):
+        if i == 0 or ( ids[i] >> 16 ) != ( ids[i-1] >> 16 ):
+            starts[n_chunks] = i
+            n_runs[n_chunks] = 1
+            n_chunks += 1
+        elif ids[i] != ids[i-1] + 1:
+            n_runs[n_chunks-1] += 1
+    starts[n_chunks] = len(ids)
+    return n_chunks
+
+@njit( nogil = True )
+def _merge_intersect( a, b, out ):
+    i = 0
+    j = 0
+    k = 0
+    while i < len(a) and j < len(b):
+        if a[i] < b[j]:
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            out[k] = a[i]
+            k += 1
+            i += 1
+            j += 1
+    return k
+
+@njit( nogil = True )
+def _galloping_intersect( small, large, out ):
+    ## for each value in small, gallop forward in large to find its lower bound
+    n = len(large)
+    j = 0
+    k = 0
+    for i in range( len(small) ):
+        v = small[i]
+        if j >= n:
+            break
+        if large[j] < v:
+            lo = j
+            step = 1
+            hi = j + 1
+            while hi < n and large[hi] < v:
+                lo = hi
+                step *= 2
+                hi = lo + step
+            if hi > n:
+                hi = n
+            lo += 1
+            while lo < hi:
+                mid = ( lo + hi ) // 2
+                if large[mid] < v:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            j = lo
+        if j < n and large[j] == v:
+            out[k] = v
+            k += 1
+            j += 1
+    return k
+
+@njit( nogil = True )
+def _merge_difference( a, b, out ):
+    ## a - b
+    i = 0
+    j = 0
+    k = 0
+    while i < len(a):
+        if j >= len(b) or a[i] < b[j]:
+            out[k] = a[i]
+            k += 1
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            i += 1
+            j += 1
+    return k
+
+
+def intersect_sorted( a, b ):
+    """
+        Intersection of two sorted unique arrays of the same dtype, galloping through the longer one if the lengths are very different.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    out = np.empty( len(a), dtype = a.dtype )
+    if len(a) * GALLOPING_RATIO < len(b):
+        k = _galloping_intersect( a, b, out )
+    else:
+        k = _merge_intersect( a, b, out )
+    return out[:k]
+
+
+def make_container( container_type, data, cardinality = None ):
+    if cardinality is None:
+        if container_type == ARRAY:
+            cardinality = len(data)
+        elif container_type == BITMAP:
+            cardinality = _popcount_words( data )
+        else:
+            cardinality = int( np.sum( data[:,1].astype(np.int64) - data[:,0].astype(np.int64) + 1 ) )
+    return ( container_type, data, cardinality )
+
+def array_runs( values ):
+    if len(values) == 0:
+        return np.zeros( (0,2), dtype = np.uint16 )
+    breaks = np.flatnonzero( np.diff( values.astype(np.int32) ) != 1 )
+    firsts = np.concatenate( [ values[:1], values[breaks+1] ] )
+    lasts = np.concatenate( [ values[breaks], values[-1:] ] )
+    return np.stack( [firsts, lasts], axis = 1 ).astype(np.uint16)
+
+def container_to_array( container ):
+    container_type, data, cardinality = container
+    if container_type == ARRAY:
+        return data
+    if container_type == BITMAP:
+        out = np.empty( cardinality, dtype = np.uint16 )
+        _bitmap_to_array( data, out )
+        return out
+    return np.concatenate( [ np.arange( int(first), int(last) + 1, dtype = np.uint16 ) for first, last in data ] )
+
+def container_to_words( container ):
+    container_type, data, cardinality = container
+    if container_type == BITMAP:
+        return data
+    words = np.zeros( BITMAP_WORDS, dtype = np.uint64 )
+    if container_type == ARRAY:
+        _set_bits( words, data )
+    else:
+        _set_runs( words, data )
+    return words
+
+def optimize_container( container ):
+    """
+        Pick the smallest representation of a container: array (2 bytes/id), bitmap (8 KB) or runs (4 bytes/run).
+    """
+    container_type, data, cardinality = container
+    if cardinality == 0:
+        return None
+    if container_type == RUN:
+        if len(data) * 4 <= min( 2 * cardinality, 8192 ):
+            return container
+        if cardinality <= ARRAY_MAX_SIZE:
+            return make_container( ARRAY, container_to_array( container ), cardinality )
+        return make_container( BITMAP, container_to_words( container ), cardinality )
+    if container_type == ARRAY:
+        n_runs = 1 + int( np.count_nonzero( np.diff( data.astype(np.int32) ) != 1 ) )
+        return optimize_array_container( data, cardinality, n_runs )
+    ## bitmap
+    n_runs = _count_bitmap_runs( data )
+    if n_runs * 4 < min( 2 * cardinality, 8192 ):
+        runs = np.empty( ( n_runs, 2 ), dtype = np.uint16 )
+        _bitmap_to_runs( data, runs )
+        return make_container( RUN, runs, cardinality )
+    if cardinality <= ARRAY_MAX_SIZE:
+        return make_container( ARRAY, container_to_array( container ), cardinality )
+    return container
+
+def optimize_array_container( values, cardinality, n_runs ):
+    if n_runs * 4 < min( 2 * cardinality, 8192 ):
+        return make_container( RUN, array_runs( values ), cardinality )
+    if cardinality > ARRAY_MAX_SIZE:
+        words = np.zeros( BITMAP_WORDS, dtype = np.uint64 )
+        _set_bits( words, values )
+        return make_container( BITMAP, words, cardinality )
+    ## copy, so that a slice does not keep the whole array it was taken from alive
+    return make_container( ARRAY, values.copy(), cardinality )
+
+def is_full_container( container ):
+    return container[2] == CHUNK_SIZE
+
+def container_and( c1, c2 ):
+    if is_full_container( c1 ):
+        return c2
+    if is_full_container( c2 ):
+        return c1
+    t1 = c1[0]
+    t2 = c2[0]
+    if t1 != BITMAP and t2 != BITMAP and ( t1 == ARRAY or t2 == ARRAY ):
+        ## at least one side is sparse: intersect sorted arrays
+        result = make_container( ARRAY, intersect_sorted( container_to_array( c1 ), container_to_array( c2 ) ) )
+    elif t1 == ARRAY or t2 == ARRAY:
+        ## array & bitmap: test the bits of the array values
+        values, words = ( c1[1], c2[1] ) if t1 == ARRAY else ( c2[1], c1[1] )
+        mask = np.empty( len(values), dtype = np.uint64 )
+        _test_bits( words, values, mask )
+        result = make_container( ARRAY, values[ mask == 1 ] )
+    else:
+        result = make_container( BITMAP, np.bitwise_and( container_to_words( c1 ), container_to_words( c2 ) ) )
+    return optimize_container( result )
+
+def container_or( c1, c2 ):
+    if is_full_container( c1 ):
+        return c1
+    if is_full_container( c2 ):
+        return c2
+    if c1[0] == ARRAY and c2[0] == ARRAY and c1[2] + c2[2] <= ARRAY_MAX_SIZE:
+        result = make_container( ARRAY, np.union1d( c1[1], c2[1] ) )
+    elif c1[0] == BITMAP or c2[0] == BITMAP or c1[2] + c2[2] > ARRAY_MAX_SIZE:
+        if c2[0] == BITMAP:
+            c1, c2 = c2, c1
+        words = container_to_words( c1 ).copy()
+        if c2[0] == ARRAY:
+            _set_bits( words, c2[1] )
+        elif c2[0] == RUN:
+            _set_runs( words, c2[1] )
+        else:
+            words |= c2[1]
+        result = make_container( BITMAP, words )
+    else:
+        result = make_container( ARRAY, np.union1d( container_to_array( c1 ), container_to_array( c2 ) ) )
+    return optimize_container( result )
+
+def container_andnot( c1, c2 ):
+    if is_full_container( c2 ):
+        return None
+    if c1[0] != BITMAP and c2[0] != BITMAP and c1[2] <= ARRAY_MAX_SIZE:
+        a = container_to_array( c1 )
+        out = np.empty( len(a), dtype = np.uint16 )
+        k = _merge_difference( a, container_to_array( c2 ), out )
+        result = make_container( ARRAY, out[:k] )
+    elif c1[0] == ARRAY:
+        mask = np.empty( len(c1[1]), dtype = np.uint64 )
+        _test_bits( container_to_words( c2 ), c1[1], mask )
+        result = make_container( ARRAY, c1[1][ mask == 0 ] )
+    else:
+        words = container_to_words( c1 ).copy()
+        if c2[0] == ARRAY:
+            _clear_bits( words, c2[1] )
+        else:
+            words &= ~container_to_words( c2 )
+        result = make_container( BITMAP, words )
+    return optimize_container( result )
+
+
+class CompressedBitmap:
+    def __init__( self, keys = None, containers = None ):
+        ## keys: sorted list of the high 16 bits of the stored ids; containers: the container of each key
+        self.keys = keys if keys is not None else []
+        self.containers = containers if containers is not None else []
+
+    @classmethod
+    def from_ids( cls, ids ):
+        """
+            ids: sorted, unique doc ids
+        """
+        ids = np.asarray( ids )
+        if len(ids) == 0:
+            return cls()
+        ids = ids.astype( np.uint32, copy = False )
+        starts = np.empty( len(ids) + 1, dtype = np.int64 )
+        n_runs = np.empty( len(ids), dtype = np.int64 )
+        n_chunks = _split_chunks( ids, starts, n_runs )
+        lows = ( ids & 0xFFFF ).astype( np.uint16 )
+        keys = []
+        containers = []
+        for chunk in range( n_chunks ):
+            start = starts[chunk]
+            end = starts[chunk+1]
+            keys.append( int( ids[start] >> 16 ) )
+            containers.append( optimize_array_container( lows[start:end], int(end - start), int(n_runs[chunk]) ) )
+        return cls( keys, containers )
+
+    @classmethod
+    def from_packed( cls, packed_bits ):
+        """
+            packed_bits: uint8 array packed with bitorder = "little", as INFO:PACKED_DOC_IDS
+        """
+        chunk_bytes = CHUNK_SIZE // 8
+        keys = []
+        containers = []
+        for key, start in enumerate( range( 0, len(packed_bits), chunk_bytes ) ):
+            chunk = np.zeros( chunk_bytes, dtype = np.uint8 )
+            chunk_data = packed_bits[ start: start + chunk_bytes ]
+            chunk[ :len(chunk_data) ] = chunk_data
+            ## with little bitorder, bit i of the chunk is bit i%64 of the little-endian uint64 word i//64
+            container = optimize_container( make_container( BITMAP, chunk.view( "<u8" ).astype( np.uint64 ) ) )
+            if container is not None:
+                keys.append( key )
+                containers.append( container )
+        return cls( keys, containers )
+
+    @classmethod
+    def from_ranges( cls, starts, ends ):
+        """
+            Bitmap of the ids in the sorted, disjoint ranges [starts[i], ends[i]), stored as run containers
+        """
+        runs = {}
+        for start, end in zip( starts, ends ):
+            start, end = int(start), int(end)
+            while start < end:
+                key = start // CHUNK_SIZE
+                chunk_end = min( end, ( key + 1 ) * CHUNK_SIZE )
+                runs.setdefault( key, [] ).append( ( start - key * CHUNK_SIZE, chunk_end - 1 - key * CHUNK_SIZE ) )
+                start = chunk_end
+        keys = sorted( runs.keys() )
+        return cls( keys, [ optimize_container( make_container( RUN, np.array( runs[key], dtype = np.uint16 ) ) ) for key in keys ] )
+
+    def binary_op( self, other, container_op, keep_self_only, keep_other_only ):
+        keys = []
+        containers = []
+        i = 0
+        j = 0
+        while i < len(self.keys) or j < len(other.keys):
+            if j >= len(other.keys) or ( i < len(self.keys) and self.keys[i] < other.keys[j] ):
+                if keep_self_only:
+                    keys.append( self.keys[i] )
+                    containers.append( self.containers[i] )
+                i += 1
+            elif i >= len(self.keys) or other.keys[j] < self.keys[i]:
+                if keep_other_only:
+                    keys.append( other.keys[j] )
+                    containers.append( other.containers[j] )
+                j += 1
+            else:
+                container = container_op( self.containers[i], other.containers[j] )
+                if container is not None:
+                    keys.append( self.keys[i] )
+                    containers.append( container )
+                i += 1
+                j += 1
+        return CompressedBitmap( keys, containers )
+
+    def __and__( self, other ):
+        return self.binary_op( other, container_and, False, False )
+
+    def __or__( self, other ):
+        return self.binary_op( other, container_or, True, True )
+
+    def __sub__( self, other ):
+        return self.binary_op( other, container_andnot, True, False )
+
+    def andnot( self, other ):
+        return self - other
+
+    def shift( self, offset ):
+        """
+            Add offset to all the ids. If offset is a multiple of the chunk size, only the keys change and the containers are shared.
+        """
+        if offset == 0:
+            return self
+        if offset % CHUNK_SIZE == 0:
+            return CompressedBitmap( [ key + offset // CHUNK_SIZE for key in self.keys ], list(self.containers) )
+        return CompressedBitmap.from_ids( self.to_ids().astype( np.int64 ) + offset )
+
+    def cardinality( self ):
+        ## the cardinality of each container is kept up to date (popcount of the bitmap containers), so counting never expands the ids
+        return int( sum( container[2] for container in self.containers ) )
+
+    def __len__( self ):
+        return self.cardinality()
+
+    def is_empty( self ):
+        return len(self.containers) == 0
+
+    @property
+    def nbytes( self ):
+        return int( sum( container[1].nbytes for container in self.containers ) )
+
+    def to_ids( self ):
+        if len(self.containers) == 0:
+            return np.zeros( 0, dtype = np.uint32 )
+        return np.concatenate( [ ( np.uint32(key) << np.uint32(16) ) | container_to_array( container ).astype( np.uint32 )
+                                 for key, container in zip( self.keys, self.containers ) ] )
+
+    def to_bool_array( self, length ):
+        bool_arr = np.zeros( length, dtype = bool )
+        ids = self.to_ids()
+        bool_arr[ ids[ ids < length ] ] = True
+        return bool_arr
+
+    def to_packed( self, num_bytes ):
+        """
+            Pack to an uint8 array with bitorder = "little"
+        """
+        packed = np.zeros( int(np.ceil( num_bytes / 8 )) * 8, dtype = np.uint8 )
+        words = packed.view( "<u8" )
+        for key, container in zip( self.keys, self.containers ):
+            start = key * BITMAP_WORDS
+            if start >= len(words):
+                break
+            chunk_words = container_to_words( container )[ :len(words) - start ]
+            words[ start: start + len(chunk_words) ] = chunk_words
+        return packed[:num_bytes]
+
+    @staticmethod
+    def union_all( bitmaps ):
+        result = CompressedBitmap()
+        for bitmap in bitmaps:
+            result = result | bitmap
+        return result
+
+    @staticmethod
+    def intersect_all( bitmaps ):
+        if len(bitmaps) == 0:
+            return CompressedBitmap()
+        ## intersect the smallest operands first, so that the intermediate results stay small
+        bitmaps = sorted( bitmaps, key = lambda bitmap: bitmap.cardinality() )
+        result = bitmaps[0]
+        for bitmap in bitmaps[1:]:
+            if result.is_empty():
+                break
+            result = result & bitmap
+        return result
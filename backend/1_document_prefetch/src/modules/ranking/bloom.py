@@ -0,0 +1,66 @@
+import hashlib
+import numpy as np
+
+
+"""
+    Bloom filter over the terms of a shard.
+
+    may_contain( term ) is False only if the term is certainly not in the shard, so a lookup of an absent term
+    (a rare author name, a DOI) is answered without touching the term dictionary on disk.
+    The num_hashes bit positions of a term are ( h1 + i * h2 ) mod num_bits, i = 0 ... num_hashes - 1 (double hashing),
+    where h1 and h2 are the two uint64 halves of the 16-byte blake2b digest of the utf-8 term.
+    The bits are stored little-endian in a uint8 array, bit p is bit p%8 of byte p//8.
+"""
+
+## about 1% false positives with the optimal number of hashes ( BITS_PER_TERM * ln 2 )
+BITS_PER_TERM = 10
+NUM_HASHES = 7
+
+
+def get_term_digest( term ):
+    ## 16 bytes: h1 and h2 as little-endian uint64
+    return hashlib.blake2b( term.encode("utf-8"), digest_size = 16 ).digest()
+
+
+class TermBloomFilter:
+    def __init__( self, bits, num_hashes = NUM_HASHES ):
+        ## bits: uint8 array (e.g. a section of a mmapped segment)
+        self.bits = bits
+        self.num_bits = len(bits) * 8
+        self.num_hashes = num_hashes
+
+    @classmethod
+    def from_digests( cls, digests, bits_per_term = BITS_PER_TERM, num_hashes = NUM_HASHES ):
+        ## digests: bytes of the concatenated 16-byte digests of the terms
+        hashes = np.frombuffer( digests, dtype = "<u8" ).reshape( -1, 2 )
+        num_bits = max( int(np.ceil( len(hashes) * bits_per_term / 64 )), 1 ) * 64
+        ## the bits are set directly in packed uint64 words: bit p is bit p%64 of word p//64,
+        ## which is bit p%8 of byte p//8 once the little-endian words are viewed as bytes
+        words = np.zeros( num_bits // 64, dtype = "<u8" )
+        for i in range( num_hashes ):
+            ## uint64 arithmetic wraps around, like the modulo 2^64 in may_contain()
+            pos = ( hashes[:,0] + np.uint64(i) * hashes[:,1] ) % np.uint64(num_bits)
+            np.bitwise_or.at( words, pos >> np.uint64(6), np.uint64(1) << ( pos & np.uint64(63) ) )
+        return cls( words.view( np.uint8 ), num_hashes )
+
+    @classmethod
+    def from_terms( cls, terms, bits_per_term = BITS_PER_TERM, num_hashes = NUM_HASHES ):
+        ## terms can be any iterable, only their 16-byte digests are kept
+        digests = bytearray()
+        for term in terms:
+            digests += get_term_digest( term )
+        return cls.from_digests( digests, bits_per_term, num_hashes )
+
+    def may_contain( self, term ):
+        digest = get_term_digest( term )
+        h1 = int.from_bytes( digest[:8], "little" )
+        h2 = int.from_bytes( digest[8:], "little" )
+        for i in range( self.num_hashes ):
+            pos = ( ( h1 + i * h2 ) % 2**64 ) % self.num_bits
+            if not ( self.bits[ pos >> 3 ] >> ( pos & 7 ) ) & 1:
+                return False
+        return True
+
+    @property
+    def nbytes( self ):
+        return len(self.bits)
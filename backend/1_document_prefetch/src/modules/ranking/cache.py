@@ -0,0 +1,114 @@
+import threading
+import time
+import json
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+        A thread-safe LRU cache with an optional time-to-live and an optional memory budget.
+        max_entries: maximum number of cached entries (0 disables the cache)
+        ttl: seconds after which an entry expires (None: never expires)
+        max_nbytes: maximum total size of the cached values (None: unlimited);
+                    the size of a value is given by sizeof( value )
+    """
+    def __init__( self, max_entries = 1024, ttl = None, max_nbytes = None, sizeof = None ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_nbytes = max_nbytes
+        self.sizeof = sizeof if sizeof is not None else ( lambda value: 0 )
+        self.lock = threading.Lock()
+        ## key -> ( value, nbytes, insertion_time )
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.reset_stats()
+
+    def reset_stats( self ):
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+        self.num_expirations = 0
+
+    def get( self, key, default = None ):
+        with self.lock:
+            entry = self.entries.get( key, None )
+            if entry is not None and self.ttl is not None and time.time() - entry[2] > self.ttl:
+                self.remove( key )
+                self.num_expirations += 1
+                entry = None
+            if entry is None:
+                self.num_misses += 1
+                return default
+            self.entries.move_to_end( key )
+            self.num_hits += 1
+            return entry[0]
+
+    def put( self, key, value ):
+        if self.max_entries <= 0:
+            return
+        nbytes = self.sizeof( value )
+        ## a value that alone exceeds the memory budget is not cached
+        if self.max_nbytes is not None and nbytes > self.max_nbytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove( key )
+            self.entries[key] = ( value, nbytes, time.time() )
+            self.nbytes += nbytes
+            while len(self.entries) > self.max_entries or \
+                  ( self.max_nbytes is not None and self.nbytes > self.max_nbytes ):
+                self.remove( next(iter( self.entries )) )
+                self.num_evictions += 1
+
+    def remove( self, key ):
+        ## the caller must hold the lock
+        value, nbytes, _ = self.entries.pop( key )
+        self.nbytes -= nbytes
+
+    def clear( self ):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def __len__( self ):
+        return len(self.entries)
+
+    def get_stats( self ):
+        with self.lock:
+            num_lookups = self.num_hits + self.num_misses
+            return {
+                "num_entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "nbytes": self.nbytes,
+                "max_nbytes": self.max_nbytes,
+                "ttl": self.ttl,
+                "num_hits": self.num_hits,
+                "num_misses": self.num_misses,
+                "hit_rate": self.num_hits / num_lookups if num_lookups > 0 else 0.0,
+                "num_evictions": self.num_evictions,
+                "num_expirations": self.num_expirations
+            }
+
+
+def canonicalize_query( query ):
+    """
+        Canonical string of a parsed query tree (see QueryParser.parse), used as cache key.
+        The elements of AND and of plain OR are commutative, so they are sorted;
+        the elements of an OR with "optional_after_pos" keep their order, since the position matters.
+        A PHRASE also depends on its words and their offsets, an EXPAND on its wildcard pattern, a YEAR_RANGE on its years.
+    """
+    if query["operation"] is None:
+        return json.dumps( query["elements"][0] )
+    if query["operation"] == "EXPAND":
+        return "EXPAND(%s)"%( json.dumps( query["elements"][0] ) )
+    if query["operation"] == "YEAR_RANGE":
+        return "YEAR_RANGE(%d,%d)"%( query["start_year"], query["end_year"] )
+    elements = [ canonicalize_query( element ) for element in query["elements"] ]
+    if query["operation"] == "PHRASE":
+        return "PHRASE(%s,%s)"%( json.dumps( list( zip( query["terms"], query["offsets"] ) ) ), elements[0] )
+    optional_after_pos = query.get( "optional_after_pos", None )
+    if query["operation"] in [ "AND", "OR" ] and optional_after_pos is None:
+        elements = sorted( set( elements ) )
+    return "%s%s(%s)"%( query["operation"],
+                         "" if optional_after_pos is None else ":%d"%( optional_after_pos ),
+                         ",".join( elements ) )
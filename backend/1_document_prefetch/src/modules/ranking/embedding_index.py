@@ -0,0 +1,177 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+try:
+    import pickle5 as pickle
+except:
+    import pickle
+
+
+"""
+    On-disk embedding index shard.
+
+    A shard is a directory holding raw .npy arrays, so that each of them is opened with np.load( mmap_mode = "r" ) without a copy,
+    and the processes serving the same shard share the page cache:
+        header.json:               {"version", "num_docs", "vector_dim", "dtype", "collections", "fingerprint", "normalized"},
+                                   fingerprint: blake2b digest of the embedding matrix and of the doc ids, computed when the shard is written
+        embedding_matrix.npy:      ( num_docs, vector_dim ) float32 or float16 matrix, row pos is the embedding of the document at pos,
+                                   L2-normalized if header["normalized"] (all the shards written by save_embedding_index())
+        pos_collections.npy:       uint16, the index (into header["collections"]) of the collection of the document at each pos
+        pos_doc_ids.npy:           int64, the id_int of the document at each pos
+        doc_id_to_pos_<i>.npy:     int32, the pos of each id_int of the collection header["collections"][i] (-1 if not in this shard),
+                                   its length is a multiple of 8 (only written if the shard has documents of this collection)
+    The legacy format is a single pickled dict { "embedding_matrix", "doc_id_to_pos_mapper", "pos_to_doc_id_mapper" }, it is still readable.
+"""
+
+EMBEDDING_INDEX_VERSION = 1
+## the rows are normalized in chunks of this many rows when a shard is written
+NORMALIZATION_CHUNK_SIZE = 65536
+
+
+class PosToDocIdMapper:
+    """
+        List-like view pos -> { "collection", "id_field":"id_int", "id_type":"int", "id_value" } on top of two arrays,
+        the dicts are only built for the positions that are looked up
+    """
+    def __init__( self, collections, pos_collections, pos_doc_ids ):
+        self.collections = collections
+        self.pos_collections = pos_collections
+        self.pos_doc_ids = pos_doc_ids
+
+    @classmethod
+    def from_list( cls, pos_to_doc_id_mapper ):
+        collections = sorted( set( item["collection"] for item in pos_to_doc_id_mapper ) )
+        collection_indices = { collection: count for count, collection in enumerate( collections ) }
+        pos_collections = np.array( [ collection_indices[ item["collection"] ] for item in pos_to_doc_id_mapper ], dtype = np.uint16 )
+        pos_doc_ids = np.array( [ int( item["id_value"] ) for item in pos_to_doc_id_mapper ], dtype = np.int64 )
+        return cls( collections, pos_collections, pos_doc_ids )
+
+    @classmethod
+    def concatenate( cls, mappers ):
+        collections = sorted( set( collection for mapper in mappers for collection in mapper.collections ) )
+        collection_indices = { collection: count for count, collection in enumerate( collections ) }
+        pos_collections = [ np.array( [ collection_indices[ collection ] for collection in mapper.collections ], dtype = np.uint16 )[ mapper.pos_collections ]
+                            for mapper in mappers if len(mapper) > 0 ]
+        pos_doc_ids = [ mapper.pos_doc_ids for mapper in mappers if len(mapper) > 0 ]
+        return cls( collections, np.concatenate( [ np.zeros( 0, dtype = np.uint16 ) ] + pos_collections ),
+                                 np.concatenate( [ np.zeros( 0, dtype = np.int64 ) ] + pos_doc_ids ) )
+
+    def __len__( self ):
+        return len( self.pos_doc_ids )
+
+    def __getitem__( self, pos ):
+        if isinstance( pos, slice ):
+            return PosToDocIdMapper( self.collections, self.pos_collections[pos], self.pos_doc_ids[pos] )
+        pos = int( pos )
+        return { "collection":self.collections[ int( self.pos_collections[pos] ) ], "id_field":"id_int", "id_type":"int", "id_value":int( self.pos_doc_ids[pos] ) }
+
+    def get_doc_id_to_pos_mapper( self ):
+        ## collection -> int32 array of the pos of each id_int (-1 if absent), padded to a multiple of 8; only the collections having documents
+        doc_id_to_pos_mapper = {}
+        for count, collection in enumerate( self.collections ):
+            positions = np.flatnonzero( self.pos_collections == count )
+            if len(positions) == 0:
+                continue
+            doc_ids = self.pos_doc_ids[ positions ]
+            doc_id_to_pos_array = -np.ones( int(np.ceil( ( doc_ids.max() + 1 ) / 8 ) * 8), dtype = np.int32 )
+            doc_id_to_pos_array[ doc_ids ] = positions
+            doc_id_to_pos_mapper[ collection ] = doc_id_to_pos_array
+        return doc_id_to_pos_mapper
+
+
+class EmbeddingIndexShard:
+    """
+        Read-only view of an embedding index shard: embedding_matrix, doc_id_to_pos_mapper and pos_to_doc_id_mapper.
+        A shard directory is memory-mapped (nothing is read until it is used), a legacy pickled file is loaded into memory.
+    """
+    def __init__( self, path ):
+        self.path = path
+        if os.path.isdir( path ):
+            with open( path + "/header.json", "r" ) as f:
+                self.header = json.load( f )
+            self.embedding_matrix = np.load( path + "/embedding_matrix.npy", mmap_mode = "r" )
+            self.doc_id_to_pos_mapper = { collection: np.load( path + "/doc_id_to_pos_%d.npy"%( count ), mmap_mode = "r" )
+                                           for count, collection in enumerate( self.header["collections"] )
+                                           if os.path.exists( path + "/doc_id_to_pos_%d.npy"%( count ) ) }
+            self.pos_to_doc_id_mapper = PosToDocIdMapper( self.header["collections"],
+                                                          np.load( path + "/pos_collections.npy", mmap_mode = "r" ),
+                                                          np.load( path + "/pos_doc_ids.npy", mmap_mode = "r" ) )
+        else:
+            with open( path, "rb" ) as f:
+                embedding_info = pickle.load( f )
+            self.embedding_matrix = embedding_info["embedding_matrix"]
+            self.doc_id_to_pos_mapper = embedding_info["doc_id_to_pos_mapper"]
+            self.pos_to_doc_id_mapper = PosToDocIdMapper.from_list( embedding_info["pos_to_doc_id_mapper"] )
+            self.header = {}
+        self.num_docs = self.embedding_matrix.shape[0]
+        ## None for the legacy shards
+        self.fingerprint = self.header.get( "fingerprint", None )
+        ## the rankers use the rows as they are when they are already normalized
+        self.is_normalized = bool( self.header.get( "normalized", False ) )
+
+
+def save_embedding_index( path, embedding_matrix, pos_to_doc_id_mapper, precision = None ):
+    """
+        Write a shard directory. pos_to_doc_id_mapper: a PosToDocIdMapper or a list of { "collection", "id_value", ... } dicts;
+        precision: "float32" or "float16" (None: keep the dtype of embedding_matrix).
+        The rows are L2-normalized (in float32) before being stored, so that the rankers can memory-map them without a private normalized copy.
+        The shard is written into a temporary directory first and then renamed, so that a reader never sees a partial shard.
+    """
+    if not isinstance( pos_to_doc_id_mapper, PosToDocIdMapper ):
+        pos_to_doc_id_mapper = PosToDocIdMapper.from_list( pos_to_doc_id_mapper )
+    embedding_matrix = np.asarray( embedding_matrix )
+    embedding_matrix = get_normalized_rows( embedding_matrix, precision if precision is not None else embedding_matrix.dtype )
+    assert len( embedding_matrix.shape ) == 2 and embedding_matrix.shape[0] == len( pos_to_doc_id_mapper )
+
+    ## the temporary name does not start with the shard prefix, so it is not listed as a shard
+    tmp_path = os.path.join( os.path.dirname( path ), ".tmp." + os.path.basename( path ) )
+    shutil.rmtree( tmp_path, ignore_errors = True )
+    os.makedirs( tmp_path )
+    np.save( tmp_path + "/embedding_matrix.npy", embedding_matrix )
+    np.save( tmp_path + "/pos_collections.npy", np.asarray( pos_to_doc_id_mapper.pos_collections, dtype = np.uint16 ) )
+    np.save( tmp_path + "/pos_doc_ids.npy", np.asarray( pos_to_doc_id_mapper.pos_doc_ids, dtype = np.int64 ) )
+    doc_id_to_pos_mapper = pos_to_doc_id_mapper.get_doc_id_to_pos_mapper()
+    for count, collection in enumerate( pos_to_doc_id_mapper.collections ):
+        if collection in doc_id_to_pos_mapper:
+            np.save( tmp_path + "/doc_id_to_pos_%d.npy"%( count ), doc_id_to_pos_mapper[collection] )
+    with open( tmp_path + "/header.json", "w" ) as f:
+        json.dump( {
+            "version":EMBEDDING_INDEX_VERSION,
+            "num_docs":embedding_matrix.shape[0],
+            "vector_dim":embedding_matrix.shape[1],
+            "dtype":str( embedding_matrix.dtype ),
+            "collections":list( pos_to_doc_id_mapper.collections ),
+            "fingerprint":get_fingerprint( [ embedding_matrix, pos_to_doc_id_mapper.pos_doc_ids ] ),
+            "normalized":True
+        }, f )
+
+    remove_embedding_index( path )
+    os.replace( tmp_path, path )
+
+
+def get_normalized_rows( embedding_matrix, dtype ):
+    ## the L2-normalized rows of embedding_matrix (any array or mmap), converted to dtype chunk by chunk
+    assert len( embedding_matrix.shape ) == 2
+    normalized_rows = np.empty( embedding_matrix.shape, dtype = dtype )
+    for pos in range( 0, embedding_matrix.shape[0], NORMALIZATION_CHUNK_SIZE ):
+        chunk = np.asarray( embedding_matrix[ pos:pos + NORMALIZATION_CHUNK_SIZE ], dtype = np.float32 )
+        normalized_rows[ pos:pos + NORMALIZATION_CHUNK_SIZE ] = chunk /(np.linalg.norm( chunk, axis =1, keepdims=True )+1e-12)
+    return normalized_rows
+
+
+def get_fingerprint( arrays ):
+    fingerprint = hashlib.blake2b( digest_size = 16 )
+    for array in arrays:
+        fingerprint.update( str( ( array.dtype, array.shape ) ).encode("utf-8") )
+        fingerprint.update( np.ascontiguousarray( array ).data )
+    return fingerprint.hexdigest()
+
+
+def remove_embedding_index( path ):
+    ## remove a shard directory or a legacy pickled file
+    if os.path.isdir( path ):
+        shutil.rmtree( path )
+    elif os.path.exists( path ):
+        os.remove( path )
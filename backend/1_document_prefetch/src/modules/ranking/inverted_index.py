@@ -3,19 +3,157 @@ import os,sys,inspect
 # parent_dir = os.path.dirname(current_dir)
 # sys.path.insert(0, parent_dir) 
 from modules.tokenizer.tokenizer import SentenceTokenizer
+from modules.ranking.segment import InvertedIndexSegment, is_segment_file, get_name_token_hash, NAME_FIELD_PREFIXES
+from modules.ranking.bitmap import CompressedBitmap, intersect_sorted
+from modules.ranking.bloom import TermBloomFilter
+from modules.ranking.cache import LRUCache, canonicalize_query
 import numpy as np
 import re
+import heapq
 import spacy
 from nameparser import HumanName
 
 from sqlitedict import SqliteDict
 import threading
-import numba
-from numba import njit
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 
 
+def get_doc_freq( on_disk_dict, term ):
+    if isinstance( on_disk_dict, InvertedIndexSegment ):
+        return on_disk_dict.get_doc_freq( term )
+    return len( on_disk_dict.get( term, [] ) )
+
+def iter_prefix_keys( on_disk_dict, prefix, limit ):
+    """
+        Yield at most limit keys of a SqliteDict shard that start with prefix, in key order. Only the keys are read, not the pickled postings.
+    """
+    ## the keys of a SqliteDict are the primary key of its table, so a range query only reads the terms with this prefix
+    prefix_end = prefix[:-1] + chr( ord(prefix[-1]) + 1 )
+    GET_KEYS = 'SELECT key FROM "%s" WHERE key >= ? AND key < ? ORDER BY key LIMIT ?'%( on_disk_dict.tablename )
+    for ( key, ) in on_disk_dict.conn.select( GET_KEYS, ( prefix, prefix_end, limit ) ):
+        yield key
+
+
+## a wildcard pattern other than a plain prefix scans at most this number of dictionary terms in each shard
+MAX_WILDCARD_SCAN = 100000
+
+def expand_in_shard( on_disk_dict, prefix, regex, max_expansions ):
+    """
+        Return [ ( term, document frequency ) ] of at most max_expansions terms of a shard that start with prefix and fully match regex
+        (None: all the terms with this prefix), preferring the terms with the highest document frequencies.
+        For a plain prefix of a segment, only the selected terms are decoded: the prefix range is found by binary search
+        and the most frequent terms are picked from the document frequency array.
+        The document frequency of a SqliteDict shard is the length of an unpickled posting list, so there the first matching terms
+        in key order are taken instead, and only their postings are read.
+    """
+    if max_expansions <= 0:
+        return []
+    if not isinstance( on_disk_dict, InvertedIndexSegment ):
+        matched = []
+        for term in iter_prefix_keys( on_disk_dict, prefix, MAX_WILDCARD_SCAN ):
+            if regex is None or regex.fullmatch( term ):
+                matched.append( term )
+                if len(matched) >= max_expansions:
+                    break
+        return [ ( term, get_doc_freq( on_disk_dict, term ) ) for term in matched ]
+    if regex is None:
+        start, end = on_disk_dict.get_prefix_range( prefix )
+        ordinals = np.arange( start, end )
+        if len(ordinals) > max_expansions:
+            doc_freqs = on_disk_dict.doc_freqs[start:end].astype( np.int64 )
+            ordinals = ordinals[ np.argpartition( -doc_freqs, max_expansions - 1 )[:max_expansions] ]
+        return [ ( on_disk_dict.get_term_by_ordinal( int(ordinal) ), int( on_disk_dict.doc_freqs[ordinal] ) ) for ordinal in ordinals ]
+    matched = []
+    for count, ( term, ordinal ) in enumerate( on_disk_dict.iter_prefix( prefix ) ):
+        if count >= MAX_WILDCARD_SCAN:
+            break
+        if regex.fullmatch( term ):
+            matched.append( ( term, int( on_disk_dict.doc_freqs[ordinal] ) ) )
+    return heapq.nlargest( max_expansions, matched, key = lambda x: x[1] )
+
+
+class NameGazetteer:
+    """
+        Compact gazetteer of the given names and family names in the inverted index, used to detect author names in queries without spaCy.
+        Each name token is stored as a 64-bit hash in a sorted array (looked up by binary search), together with
+            name_doc_freqs:  number of documents having the token in an author's given name or family name
+            plain_doc_freqs: number of documents having the token anywhere (the author names are indexed as plain unigrams too)
+        The ratio name_doc_freq / plain_doc_freq tells how likely a query word is used as a name.
+        The statistics are computed when the segments are written (see the name token sections in modules/ranking/segment.py),
+        so building the gazetteer only sums the arrays of the shards.
+    """
+    NOT_NAME = 0
+    NAME = 1
+    AMBIGUOUS = 2
+    
+    NAME_FIELD_PREFIXES = NAME_FIELD_PREFIXES
+    
+    def __init__( self, hashes = [], name_doc_freqs = [], plain_doc_freqs = [], name_ratio = 0.3, not_name_ratio = 0.02, max_name_words = 4 ):
+        ## the same token can come from several shards, its document frequencies are summed
+        self.hashes, inverse = np.unique( np.asarray( hashes, dtype = np.uint64 ), return_inverse = True )
+        self.name_doc_freqs = np.zeros( len(self.hashes), dtype = np.int64 )
+        self.plain_doc_freqs = np.zeros( len(self.hashes), dtype = np.int64 )
+        np.add.at( self.name_doc_freqs, inverse, np.asarray( name_doc_freqs, dtype = np.int64 ) )
+        np.add.at( self.plain_doc_freqs, inverse, np.asarray( plain_doc_freqs, dtype = np.int64 ) )
+        
+        ## a query is a name if all its words are used as a name in at least name_ratio of their documents,
+        ## and not a name if one of its words is used as a name in less than not_name_ratio of its documents; otherwise it is ambiguous
+        self.name_ratio = name_ratio
+        self.not_name_ratio = not_name_ratio
+        self.max_name_words = max_name_words
+        
+    @classmethod
+    def from_shards( cls, on_disk_dicts, **kwargs ):
+        """
+            Return None if a shard has no name token statistics (a SqliteDict shard, or a segment written before them),
+            the query parser then falls back to spaCy: scanning the name terms of such shards would make every start slow.
+        """
+        if not all( isinstance( on_disk_dict, InvertedIndexSegment ) and on_disk_dict.name_token_hashes is not None for on_disk_dict in on_disk_dicts ):
+            print("Warning: some shards have no name token statistics, the author names in queries are detected by spaCy")
+            return None
+        return cls( np.concatenate( [ on_disk_dict.name_token_hashes for on_disk_dict in on_disk_dicts ] + [ np.zeros( 0, dtype = np.uint64 ) ] ),
+                    np.concatenate( [ on_disk_dict.name_token_doc_freqs for on_disk_dict in on_disk_dicts ] + [ np.zeros( 0, dtype = np.uint64 ) ] ),
+                    np.concatenate( [ on_disk_dict.name_token_plain_doc_freqs for on_disk_dict in on_disk_dicts ] + [ np.zeros( 0, dtype = np.uint64 ) ] ),
+                    **kwargs )
+    
+    def hash( self, token ):
+        return get_name_token_hash( token )
+    
+    def __len__( self ):
+        return len( self.hashes )
+    
+    def lookup( self, token ):
+        """
+            Return ( name_doc_freq, plain_doc_freq ) of a token
+        """
+        h = np.uint64( self.hash( token ) )
+        pos = np.searchsorted( self.hashes, h )
+        if pos < len(self.hashes) and self.hashes[pos] == h:
+            return int(self.name_doc_freqs[pos]), int(self.plain_doc_freqs[pos])
+        return 0, 0
+    
+    def classify( self, words ):
+        words = [ word.lower().strip(".,") for word in words ]
+        ## initials such as "g." carry no information
+        words = [ word for word in words if len(word) > 1 ]
+        if len(words) == 0 or len(words) > self.max_name_words:
+            return self.NOT_NAME
+        min_ratio = None
+        for word in words:
+            name_doc_freq, plain_doc_freq = self.lookup( word )
+            if name_doc_freq == 0:
+                return self.NOT_NAME
+            ratio = name_doc_freq / max( plain_doc_freq, 1 )
+            min_ratio = ratio if min_ratio is None else min( min_ratio, ratio )
+        if min_ratio >= self.name_ratio:
+            return self.NAME
+        if min_ratio < self.not_name_ratio:
+            return self.NOT_NAME
+        return self.AMBIGUOUS
+    
+
 class QueryParser:
     def __init__( self, ):
         self.sent_tokenizer = SentenceTokenizer() 
@@ -24,12 +162,19 @@ class QueryParser:
         self.not_matcher =  re.compile("<NOT>" )
         self.or_matcher =  re.compile("<OR>" )
         self.and_matcher =  re.compile("<AND>" )
+        self.phrase_matcher = re.compile('^"(.+)"$')
+        ## a word with a "*" (any sequence of characters) is expanded into the indexed terms it matches, if it has a literal prefix of at least this length
+        self.wildcard = "*"
+        self.min_wildcard_prefix_length = 2
         self.year_matcher = re.compile("([^\d]|^)((19[0-9][0-9]|20[0-9][0-9])\.\.(19[0-9][0-9]|20[0-9][0-9]))(?=[^\d]|$)|([^\d]|^)(19[0-9][0-9]|20[0-9][0-9])(?=[^\d]|$)")
         
         self.field_name_and_ngram_matcher = re.compile("([A-Za-z\.]+:)(.+)|(.+)")
         
         self.stopwords_set = set( self.sent_tokenizer.general_stopwords )
-        self.spacy_nlp = spacy.load("en_core_web_sm")
+        ## spaCy NER is only needed for the names that the gazetteer cannot decide, so it is loaded at the first use
+        self.spacy_nlp = None
+        self.spacy_lock = threading.Lock()
+        self.name_gazetteer = None
         
         """
             Allowable field name set
@@ -40,8 +185,40 @@ class QueryParser:
                         "Year:", "PublicationDate.Year:",
                         "AvailableField:"
                     ]) )
+        ## the wildcards are matched against the indexed terms, so these field names are mapped to the prefix of the indexed terms
+        self.wildcard_field_names = { "author:":"author.familyname:", "year:":"publicationdate.year:" }
         
         
+    def set_name_gazetteer( self, name_gazetteer ):
+        self.name_gazetteer = name_gazetteer
+    
+    def get_spacy_nlp( self ):
+        with self.spacy_lock:
+            if self.spacy_nlp is None:
+                self.spacy_nlp = spacy.load("en_core_web_sm")
+        return self.spacy_nlp
+    
+    def find_person_name( self, potential_name ):
+        """
+            Return ( start_pos, end_pos ) of a person name in potential_name, ( 0, 0 ) if there is none.
+            The clear cases are decided by the name gazetteer, spaCy NER is only run on the ambiguous ones.
+        """
+        ## e.g. the empty query "" (counted to get the universe), spaCy is not needed
+        if potential_name.strip() == "":
+            return 0, 0
+        if self.name_gazetteer is not None:
+            name_class = self.name_gazetteer.classify( potential_name.split() )
+            if name_class == NameGazetteer.NAME:
+                return 0, len(potential_name)
+            if name_class == NameGazetteer.NOT_NAME:
+                return 0, 0
+        
+        parsed_potential_name = self.get_spacy_nlp()(potential_name)
+        for ent in parsed_potential_name.ents:
+            if ent.label_ == "PERSON":
+                return ent.start_char, ent.end_char
+        return 0, 0
+    
     def get_bigrams(self, word_list ):
         bigrams = set()
         for pos in range( len(word_list) - 1 ):
@@ -58,6 +235,32 @@ class QueryParser:
                 unigrams.add(w)
         return unigrams
     
+    def is_wildcard( self, word ):
+        pos = word.find( self.wildcard )
+        return pos >= self.min_wildcard_prefix_length
+    
+    def parse_phrase( self, phrase, skip_stages ):
+        """
+            A quoted phrase is matched exactly: the documents containing all its uni/bigrams are the candidates,
+            which are then verified against the token positions of its words (stopwords only keep their place).
+            If the phrase is a single word or a bigram, the bigram already matches it exactly.
+        """
+        ## the phrase is taken literally, it is not parsed as an author name, a DOI or a year
+        query_element = self.parse( phrase, skip_stages | set([ "Wildcard-parse", "Name-parse", "DOI-parse", "Year-parse", "AvailableField-parse" ]) )
+        
+        tokenized_words_list = self.sent_tokenizer.tokenize( phrase ).strip().split()
+        offsets = [ pos for pos, w in enumerate( tokenized_words_list ) if w not in self.stopwords_set ]
+        if len(offsets) <= 1 or ( len(offsets) == 2 and offsets[1] - offsets[0] == 1 ) or query_element["operation"] is None:
+            return query_element
+        
+        query_element = {
+            "operation":"PHRASE",
+            "elements":[ query_element ],
+            "terms":[ tokenized_words_list[pos] for pos in offsets ],
+            "offsets":[ pos - offsets[0] for pos in offsets ]
+        }
+        return query_element
+    
     def normalize( self, query_element ):
         if query_element["operation"] is None:
             if len(query_element["elements"]) == 0:
@@ -114,6 +317,12 @@ class QueryParser:
                 self.normalize(query_element)
                 return query_element
             
+        if "Phrase-parse" not in skip_stages:
+            skip_stages = skip_stages | set(["Phrase-parse"])
+            found_phrase = self.phrase_matcher.findall( keys.strip() )
+            if len(found_phrase) > 0 and found_phrase[0].strip() != "":
+                return self.parse_phrase( found_phrase[0], skip_stages )
+            
         keys = keys.strip()
         try:
             found_field_name_and_ngram = self.field_name_and_ngram_matcher.findall( keys )[0]
@@ -132,22 +341,32 @@ class QueryParser:
         """
         word_list = ngram.split()
         
+        if "Wildcard-parse" not in skip_stages:
+            skip_stages = skip_stages | set(["Wildcard-parse"])
+            ## each wildcard word matches any of the terms it expands to, the other words are parsed as usual
+            wildcard_words = [ word for word in word_list if self.is_wildcard( word ) ]
+            if len(wildcard_words) > 0:
+                wildcard_field_name = self.wildcard_field_names.get( field_name, field_name )
+                elements = [ { "operation":"EXPAND", "elements":[ ( wildcard_field_name + word.rstrip(",") ).lower() ] } for word in wildcard_words ]
+                other_words = [ word for word in word_list if not self.is_wildcard( word ) ]
+                if len(other_words) > 0:
+                    elements.append( self.parse( field_name + " ".join( other_words ), skip_stages ) )
+                query_element = {
+                    "operation":"AND",
+                    "elements":elements
+                }
+                self.normalize(query_element)
+                return query_element
+        
         if "Name-parse" not in skip_stages:
             skip_stages = skip_stages | set(["Name-parse"])
             ## check name
             name_word_list = list(  map( lambda x:x.rstrip(","), word_list ) )
             if field_name == "" or field_name.lower() == "author:":
                 # check name
-                ## check if the uni/bigram is a human name using spacy NER
+                ## check if the uni/bigram is a human name using the name gazetteer (or spacy NER for ambiguous cases)
                 potential_name = " ".join( name_word_list )                        
-                parsed_potential_name = self.spacy_nlp(potential_name)
-                start_pos = 0
-                end_pos = 0
-                for ent in parsed_potential_name.ents:
-                    if ent.label_ == "PERSON":
-                        start_pos = ent.start_char
-                        end_pos = ent.end_char
-                        break
+                start_pos, end_pos = self.find_person_name( potential_name )
                 ## NER found a person name
                 if (end_pos - start_pos)/(len(potential_name)+1e-9) > 0.9:
                     human_name_scenario = HumanName( potential_name[ start_pos:end_pos ] )
@@ -271,6 +490,13 @@ class QueryParser:
                             "elements":[ { "operation":None, "elements":[ ("PublicationDate.Year:"+year).lower() ] }  for year in year_range ]
                         }
                         self.normalize(query_element)
+                        ## the shards with a year column answer the range directly, the others evaluate the OR of the years
+                        query_element = {
+                            "operation":"YEAR_RANGE",
+                            "elements":[ query_element ],
+                            "start_year":int(start_year),
+                            "end_year":int(end_year)
+                        }
                         return query_element
                     elif found_year[-1] != "":
                         query_element = {
@@ -320,146 +546,602 @@ class QueryParser:
                         
                 
 
-@njit
-def fast_assign( a, indices, v):
-    a[indices] = v
+## decode only the posting blocks that overlap the candidates when a term has this many times more postings than there are candidates
+SKIP_LIST_RATIO = 8
+## approximate counts are computed on a sample of the documents: the first SAMPLE_RUN_LENGTH doc ids out of every SAMPLE_RUN_LENGTH * SAMPLE_RATE.
+## Contiguous runs of doc ids keep the skip lists of the posting lists effective, so evaluating the sample costs about 1 / SAMPLE_RATE of the full query
+SAMPLE_RUN_LENGTH = 1024
+SAMPLE_RATE = 64
+## BM25 parameters: term frequency saturation and document length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
 
 class OnDiskInvertedIndex:
-    def __init__(self, database_folder ):
+    def __init__(self, database_folder, cache_size = 1024, cache_ttl = 3600, cache_max_nbytes = 512 * 1024**2, num_workers = None, approximate_count_threshold = 1000000,
+                 bm25_k1 = BM25_K1, bm25_b = BM25_B, max_expansions = 128 ):
         self.database_folder = os.path.abspath(database_folder)
+        ## a wildcard word is expanded into at most this number of terms (the ones with the highest document frequencies)
+        self.max_expansions = max_expansions
+        self.bm25_k1 = bm25_k1
+        self.bm25_b = bm25_b
+        ## count( approximate = True ) only samples the queries that are estimated to match at least this number of documents
+        self.approximate_count_threshold = approximate_count_threshold
         self.query_parser = QueryParser()
+        ## persistent pool that evaluates the shards in parallel. The numba kernels of the segments and bitmaps release the GIL,
+        ## so the shards scale with the number of cores (the unpickling of legacy SqliteDict shards still holds the GIL)
+        self.shard_executor = ThreadPoolExecutor( max_workers = num_workers if num_workers is not None else os.cpu_count() )
+        ## key string -> parsed query tree, this avoids the spaCy NER pass for repeated queries
+        self.parse_cache = LRUCache( cache_size, cache_ttl )
+        ## (index version, canonical query tree) -> ( result bitmap, number of matched documents )
+        self.result_cache = LRUCache( cache_size, cache_ttl, cache_max_nbytes, sizeof = lambda value: value[0].nbytes )
+        ## (index version, wildcard pattern) -> expanded terms
+        self.expansion_cache = LRUCache( cache_size, cache_ttl )
+        self.index_version = 0
         self.initiate()
         
+    def invalidate_cache( self ):
+        ## results computed against the old shards are keyed by the old version, so a search that is running right now cannot put a stale entry back
+        self.index_version += 1
+        self.result_cache.clear()
+        self.expansion_cache.clear()
+        
+    def get_cache_stats( self ):
+        return {
+            "result_cache": self.result_cache.get_stats(),
+            "parse_cache": self.parse_cache.get_stats(),
+            "expansion_cache": self.expansion_cache.get_stats()
+        }
+        
     def initiate(self,):
         try:
             self.close()
         except:
             pass
+        self.invalidate_cache()
 
-        self.shards = os.listdir(self.database_folder)
+        ## skip the temporary files of a build in progress (runs, checkpoints, partially written shards)
+        self.shards = [ shard for shard in os.listdir(self.database_folder) 
+                           if not any( tag in shard for tag in [ ".tmp", ".run_", ".checkpoint" ] ) ]
         print("all shards:", self.shards)
-        self.on_disk_dicts = { shard: SqliteDict( "%s/%s"%(self.database_folder, shard ), journal_mode = "OFF" )
-                                 for shard in self.shards 
-                             }
-        self.packed_doc_ids = { shard: self.on_disk_dicts[shard]["INFO:PACKED_DOC_IDS"]  
-                                 for shard in self.shards   
-                              } 
-
+        self.on_disk_dicts = {}
+        self.packed_doc_ids = {}
+        self.shard_doc_ids = {}
+        self.sample_doc_ids = {}
+        self.base_doc_ids = {}
+        self.term_filters = {}
         for shard in self.shards:
-            self.collection = self.on_disk_dicts[shard]["INFO:COLLECTION"]
-            break
+            self.load_shard( shard )
         
-        ### get all available ids when no keyword given and the total number of document in this inverted index
-        filtered_results = self.get( "" )
-        num_matched_documents = 0
-        for c in filtered_results:
-            num_matched_documents += int(np.sum(filtered_results[c] ))
-        
-        self.filtered_results = filtered_results
-        self.num_matched_documents = num_matched_documents
+        ## the author names are detected using the names in the index, so the parsed queries depend on the shards as well;
+        ## set before update_universe(), which parses the empty query
+        self.query_parser.set_name_gazetteer( NameGazetteer.from_shards( [ self.on_disk_dicts[shard] for shard in self.shards ] ) )
+        self.parse_cache.clear()
+        self.update_universe()
         
+    def load_shard( self, shard ):
+        self.on_disk_dicts[shard] = self.open_shard( "%s/%s"%(self.database_folder, shard ) )
+        self.packed_doc_ids[shard] = self.on_disk_dicts[shard]["INFO:PACKED_DOC_IDS"]
+        ## the documents indexed in each shard, used as the universe of the empty query "" and of <NOT>
+        self.shard_doc_ids[shard] = CompressedBitmap.from_packed( self.packed_doc_ids[shard] )
+        sample_starts = np.arange( 0, len( self.packed_doc_ids[shard] ) * 8, SAMPLE_RUN_LENGTH * SAMPLE_RATE )
+        self.sample_doc_ids[shard] = self.shard_doc_ids[shard] & CompressedBitmap.from_ranges( sample_starts, sample_starts + SAMPLE_RUN_LENGTH )
+        ## the doc ids (and packed doc ids) of a merged segment are relative to its base doc id, the results are shifted back before combining them
+        self.base_doc_ids[shard] = int( self.on_disk_dicts[shard].get( "INFO:BASE_DOC_ID", 0 ) )
+        self.collection = self.on_disk_dicts[shard]["INFO:COLLECTION"]
+        self.term_filters[shard] = self.get_term_filter( self.on_disk_dicts[shard] )
+
+    def get_term_filter( self, on_disk_dict ):
+        """
+            Bloom filter of the terms of a shard, None if there is none. Segments carry it in a section;
+            for SqliteDict shards it is built from the keys once when the shard is loaded (this streams the keys, but does not unpickle the postings).
+        """
+        if isinstance( on_disk_dict, InvertedIndexSegment ):
+            return on_disk_dict.term_bloom
+        try:
+            return TermBloomFilter.from_terms( key for key in on_disk_dict.keys() if not key.startswith("INFO:") )
+        except:
+            print("Warning: failed to build the term filter of the shard")
+            return None
+
+    def unload_shard( self, shard ):
+        try:
+            self.on_disk_dicts[shard].close()
+        except:
+            pass
+        for shard_dict in [ self.on_disk_dicts, self.packed_doc_ids, self.shard_doc_ids, self.sample_doc_ids, self.base_doc_ids, self.term_filters ]:
+            shard_dict.pop( shard, None )
+
+    def update_universe( self ):
+        self.max_num_doc_ids = max( [ self.base_doc_ids[shard] + len( self.packed_doc_ids[shard] ) * 8 for shard in self.shards ] + [0] )
+        ### the total number of document in this inverted index (the number of documents matched when no keyword is given)
+        self.invalidate_cache()
+        self.num_matched_documents = self.count( "" )[0]
+
+    def attach_shards( self, shards ):
+        """
+            Attach new shards (e.g. the delta segment of newly added papers) without reopening the existing ones.
+            The name gazetteer is refreshed at the next initiate().
+        """
+        self.replace_shards( [], shards )
+
+    def replace_shards( self, old_shards, new_shards ):
+        """
+            Swap old_shards for new_shards (e.g. after compacting several delta segments into one).
+            The new shards are opened before the shard list is switched, so the searches never see a partial state.
+        """
+        new_shards = [ shard for shard in new_shards if shard not in old_shards ]
+        for shard in new_shards:
+            if shard in self.on_disk_dicts:
+                self.unload_shard( shard )
+            self.load_shard( shard )
+        self.shards = [ shard for shard in self.shards if shard not in old_shards and shard not in new_shards ] + new_shards
+        for shard in old_shards:
+            if shard in self.on_disk_dicts:
+                self.unload_shard( shard )
+        self.update_universe()
         
+    def open_shard( self, shard_path ):
+        ## a shard is either an immutable mmapped segment or a (legacy) SqliteDict of pickled numpy arrays
+        if is_segment_file( shard_path ):
+            return InvertedIndexSegment( shard_path )
+        return SqliteDict( shard_path, journal_mode = "OFF" )
+
     def pause_shards( self, shards ):
         for shard in shards:
             if shard in self.shards:
                 self.shards = list( set(self.shards) - set([shard])  )
+        self.invalidate_cache()
 
-    def zero_pad(self, arr_list ):
-        max_len = max([ len(arr) for arr in arr_list  ])
-        padded_arr_list = []
-        for arr in arr_list:
-            padded_arr_list.append( np.concatenate( [arr, np.zeros( max_len -len(arr), dtype = np.uint8 )] ) )
-        return padded_arr_list
-                
-    def bitwise_or(self, arr_list, optional_after_pos = None ):
-        if len(arr_list) == 0:
-            return np.array([], dtype = np.uint8)
+    def get_term_info( self, shard, term, term_cache ):
+        """
+            Return ( document frequency, ordinal in the segment, postings ) of a term, memoized per query in term_cache.
+            For segment shards the document frequency is stored at build time, so the postings are not decoded yet (None);
+            for SqliteDict shards the postings have to be fetched to know the document frequency (ordinal is None).
+        """
+        if term not in term_cache:
+            on_disk_dict = self.on_disk_dicts[shard]
+            if not self.may_contain( shard, term ):
+                term_cache[term] = ( 0, -1, None ) if isinstance( on_disk_dict, InvertedIndexSegment ) else ( 0, None, np.array([], dtype = np.uint32) )
+            elif isinstance( on_disk_dict, InvertedIndexSegment ):
+                ordinal = on_disk_dict.find( term )
+                doc_freq = int( on_disk_dict.doc_freqs[ordinal] ) if ordinal >= 0 else 0
+                term_cache[term] = ( doc_freq, ordinal, None )
+            else:
+                postings = on_disk_dict.get( term, np.array([], dtype = np.uint32) )
+                term_cache[term] = ( len(postings), None, postings )
+        return term_cache[term]
+    
+    def may_contain( self, shard, term ):
+        ## False only if the term is certainly not in the shard
+        term_filter = self.term_filters.get( shard, None )
+        return term_filter is None or term_filter.may_contain( term )
+    
+    def may_match( self, shard, query ):
+        """
+            False only if query certainly matches nothing in the shard, because a term that it requires is not in the shard.
+            Decided by the term filters alone, without any disk access.
+        """
+        if query["operation"] is None:
+            return query["elements"][0] == "" or self.may_contain( shard, query["elements"][0] )
+        if query["operation"] == "AND":
+            return all( self.may_match( shard, element ) for element in query["elements"] if element["operation"] != "NOT" )
+        if query["operation"] == "OR":
+            return any( self.may_match( shard, element ) for element in query["elements"] )
+        if query["operation"] in [ "PHRASE", "YEAR_RANGE" ]:
+            return self.may_match( shard, query["elements"][0] )
+        return True
+    
+    def get_term_bitmap( self, shard, term, term_cache, candidates = None ):
+        doc_freq, ordinal, postings = self.get_term_info( shard, term, term_cache )
+        if doc_freq == 0:
+            return CompressedBitmap()
+        if ordinal is not None:
+            segment = self.on_disk_dicts[shard]
+            if candidates is not None and candidates.cardinality() * SKIP_LIST_RATIO < doc_freq:
+                ## much fewer candidates than postings: only decode the posting blocks that can contain a candidate
+                postings = segment.get_postings_by_ordinal_within( ordinal, candidates.to_ids() )
+            else:
+                postings = segment.get_postings_by_ordinal( ordinal )
+        bitmap = CompressedBitmap.from_ids( postings )
+        if candidates is not None:
+            bitmap = bitmap & candidates
+        return bitmap
+    
+    def expand( self, pattern ):
+        """
+            The terms matched by a wildcard pattern, at most max_expansions of them, the ones with the highest document frequencies in all the shards.
+            The expansion is the same for all the shards, so that a document matches the same terms in whichever shard it is.
+        """
+        cache_key = ( self.index_version, pattern )
+        terms = self.expansion_cache.get( cache_key )
+        if terms is None:
+            prefix = pattern[ :pattern.find("*") ]
+            regex = None if pattern == prefix + "*" else re.compile( ".*".join( map( re.escape, pattern.split("*") ) ) )
+            doc_freqs = {}
+            for shard in list( self.shards ):
+                for term, doc_freq in expand_in_shard( self.on_disk_dicts[shard], prefix, regex, self.max_expansions ):
+                    doc_freqs[term] = doc_freqs.get( term, 0 ) + doc_freq
+            terms = sorted( doc_freqs, key = lambda term: ( -doc_freqs[term], term ) )[ :self.max_expansions ]
+            self.expansion_cache.put( cache_key, terms )
+        return terms
+    
+    def get_terms_bitmap( self, shard, terms, term_cache, candidates = None ):
+        """
+            Union of the postings of several terms (e.g. the expansion of a wildcard) in one pass:
+            all the posting lists are decoded into one array and converted into a bitmap once, instead of building and merging a bitmap per term.
+        """
+        candidate_ids = None
+        postings_list = []
+        for term in terms:
+            doc_freq, ordinal, postings = self.get_term_info( shard, term, term_cache )
+            if doc_freq == 0:
+                continue
+            if ordinal is not None:
+                segment = self.on_disk_dicts[shard]
+                if candidates is not None and candidates.cardinality() * SKIP_LIST_RATIO < doc_freq:
+                    if candidate_ids is None:
+                        candidate_ids = candidates.to_ids()
+                    postings = segment.get_postings_by_ordinal_within( ordinal, candidate_ids )
+                else:
+                    postings = segment.get_postings_by_ordinal( ordinal )
+            postings_list.append( np.asarray( postings, dtype = np.uint32 ) )
+        if len(postings_list) == 0:
+            return CompressedBitmap()
+        bitmap = CompressedBitmap.from_ids( np.unique( np.concatenate( postings_list ) ) )
+        if candidates is not None:
+            bitmap = bitmap & candidates
+        return bitmap
+    
+    def estimate_cost( self, shard, query, term_cache ):
+        """
+            Estimated number of documents matched by query in this shard, based on the document frequencies of the terms.
+        """
+        num_docs = self.shard_doc_ids[shard].cardinality()
+        if query["operation"] is None:
+            query_text = query["elements"][0]
+            if query_text == "":
+                return num_docs
+            return self.get_term_info( shard, query_text, term_cache )[0]
+        if query["operation"] == "AND":
+            costs = [ self.estimate_cost( shard, element, term_cache ) for element in query["elements"] if element["operation"] != "NOT" ]
+            return min( costs ) if len(costs) > 0 else num_docs
+        if query["operation"] == "OR":
+            ## the optional elements are usually not evaluated, so they do not count
+            elements = query["elements"]
+            if query.get( "optional_after_pos", None ) is not None:
+                elements = elements[ :max( query["optional_after_pos"], 0 ) + 1 ]
+            return min( sum( self.estimate_cost( shard, element, term_cache ) for element in elements ), num_docs )
+        if query["operation"] == "NOT":
+            return max( num_docs - self.estimate_cost( shard, query["elements"][0], term_cache ), 0 )
+        if query["operation"] == "PHRASE":
+            return self.estimate_cost( shard, query["elements"][0], term_cache )
+        if query["operation"] == "EXPAND":
+            return min( sum( self.get_term_info( shard, term, term_cache )[0] for term in self.expand( query["elements"][0] ) ), num_docs )
+        if query["operation"] == "YEAR_RANGE":
+            segment = self.on_disk_dicts[shard]
+            if isinstance( segment, InvertedIndexSegment ) and segment.has_doc_years:
+                return segment.count_year_range( query["start_year"], query["end_year"] )
+            return self.estimate_cost( shard, query["elements"][0], term_cache )
+        return 0
+    
+    def evaluate_and( self, shard, elements, candidates, term_cache ):
+        positive_elements = [ element for element in elements if element["operation"] != "NOT" ]
+        ## a required term is absent from this shard: nothing matches, and none of the other elements is looked up
+        if not all( self.may_match( shard, element ) for element in positive_elements ):
+            return CompressedBitmap()
+        negative_elements = [ element["elements"][0] for element in elements if element["operation"] == "NOT" ]
+        
+        ## evaluate the rarest element first, and every following element only within the documents matched so far
+        positive_elements.sort( key = lambda element: self.estimate_cost( shard, element, term_cache ) )
+        bitmap = candidates
+        for element in positive_elements:
+            bitmap = self.get_from_shard( shard, element, candidates = bitmap, term_cache = term_cache )
+            if bitmap.is_empty():
+                return bitmap
+        if bitmap is None:
+            bitmap = self.shard_doc_ids[shard]
+        
+        ## A <AND> <NOT> B is evaluated as A - ( B within A )
+        for element in negative_elements:
+            bitmap = bitmap - self.get_from_shard( shard, element, candidates = bitmap, term_cache = term_cache )
+            if bitmap.is_empty():
+                break
+        return bitmap
+    
+    def evaluate_or( self, shard, elements, optional_after_pos, candidates, term_cache ):
+        if len(elements) == 0:
+            return CompressedBitmap()
         
         if optional_after_pos is None:
-            optional_after_pos = len( arr_list ) - 1
-        optional_after_pos = min( max( optional_after_pos, 0 ), len( arr_list ) - 1 )
-        
-        arr_list = self.zero_pad(arr_list)
-        res_arr = None
-        for arr in arr_list[0: optional_after_pos+1]:
-            if res_arr is None:
-                res_arr = arr
-            else:
-                res_arr = np.bitwise_or(res_arr,arr)
-        ## if there are some match so far, then just skip all the arr after the position: optional_after_pos
-        if res_arr.sum() > 0:
-            return res_arr
-        
-        for arr in arr_list[optional_after_pos+1 :]:
-            res_arr = np.bitwise_or(res_arr,arr)
-        return res_arr
-            
-    def bitwise_and(self, arr_list ):
-        if len(arr_list) == 0:
-            return np.array([], dtype = np.uint8)
-        if len(arr_list) == 1:
-            return arr_list[0]
-        arr_list = self.zero_pad(arr_list)
-        res_arr = arr_list[0]
-        for arr in arr_list[1:]:
-            res_arr = np.bitwise_and(res_arr,arr)
-        return res_arr
-    
-    def get_from_shard(self, shard, query, results = None ):
-        max_len = len( self.packed_doc_ids[shard] ) * 8
+            optional_after_pos = len( elements ) - 1
+        optional_after_pos = min( max( optional_after_pos, 0 ), len( elements ) - 1 )
+        
+        bitmap = CompressedBitmap.union_all( [ self.get_from_shard( shard, element, candidates = candidates, term_cache = term_cache ) 
+                                               for element in elements[: optional_after_pos+1] ] )
+        if optional_after_pos + 1 == len( elements ) or not bitmap.is_empty():
+            return bitmap
+        
+        ## the elements after the position optional_after_pos are only evaluated if the elements before match nothing in this shard.
+        ## This is decided without the candidates, so that the result is the same as when evaluating this element on its own
+        if candidates is not None:
+            for element in elements[: optional_after_pos+1]:
+                if not self.get_from_shard( shard, element, term_cache = term_cache ).is_empty():
+                    return bitmap
+        return CompressedBitmap.union_all( [bitmap] + [ self.get_from_shard( shard, element, candidates = candidates, term_cache = term_cache )
+                                                         for element in elements[optional_after_pos+1 :] ] )
+    
+    def verify_phrase( self, shard, terms, offsets, candidates, term_cache ):
+        """
+            Keep the candidates in which terms[i] occurs at position p + offsets[i] for all i, for some position p.
+            Each (doc id, p) pair is encoded as doc_id << 32 | p, so the check is an intersection of sorted arrays, starting from the rarest term.
+        """
+        segment = self.on_disk_dicts[shard]
+        doc_ids = candidates.to_ids()
+        phrase_keys = None
+        for i in sorted( range(len(terms)), key = lambda i: self.get_term_info( shard, terms[i], term_cache )[0] ):
+            doc_freq, ordinal, _ = self.get_term_info( shard, terms[i], term_cache )
+            if doc_freq == 0:
+                return CompressedBitmap()
+            term_doc_ids, counts, positions = segment.get_positions_within( ordinal, doc_ids )
+            starts = positions.astype( np.int64 ) - offsets[i]
+            term_keys = ( np.repeat( term_doc_ids.astype( np.int64 ), counts ) << 32 | starts )[ starts >= 0 ]
+            phrase_keys = term_keys if phrase_keys is None else intersect_sorted( phrase_keys, term_keys )
+            doc_ids = np.unique( phrase_keys >> 32 ).astype( np.uint32 )
+            if len(doc_ids) == 0:
+                break
+        return CompressedBitmap.from_ids( doc_ids )
+    
+    def get_year_range_bitmap( self, shard, query, candidates, term_cache ):
+        """
+            Documents published from query["start_year"] to query["end_year"], read from the year column of the segment:
+            a few candidates are checked by looking up their years, otherwise the range is read as a whole and intersected.
+            Shards without a year column evaluate the OR of the single years instead.
+        """
+        segment = self.on_disk_dicts[shard]
+        if not ( isinstance( segment, InvertedIndexSegment ) and segment.has_doc_years ):
+            return self.get_from_shard( shard, query["elements"][0], candidates = candidates, term_cache = term_cache )
+        start_year, end_year = query["start_year"], query["end_year"]
+        if candidates is not None and candidates.cardinality() * SKIP_LIST_RATIO < segment.count_year_range( start_year, end_year ):
+            return CompressedBitmap.from_ids( segment.filter_by_year_range( candidates.to_ids(), start_year, end_year ) )
+        bitmap = CompressedBitmap.from_ids( segment.get_doc_ids_by_year_range( start_year, end_year ) )
+        if candidates is not None:
+            bitmap = bitmap & candidates
+        return bitmap
+    
+    def get_from_shard(self, shard, query, candidates = None, term_cache = None ):
+        """
+            Evaluate query in one shard. If candidates (a bitmap) is given, only the matched documents within candidates are returned.
+        """
+        if term_cache is None:
+            term_cache = {}
         if query["operation"] is None:
             query_text = query["elements"][0]
             if query_text == "":
-                bool_arr = np.ones( max_len, dtype = np.uint8 )
+                bitmap = self.shard_doc_ids[shard] if candidates is None else candidates
             else:
-                bool_arr = np.zeros( max_len, dtype = np.uint8 )
-                ids = self.on_disk_dicts[shard].get( query_text, np.array([]) )
-                if len(ids) > 0:
-                    fast_assign( bool_arr,  ids, 1 )
-            bool_arr = np.packbits( bool_arr, bitorder='little' )
+                bitmap = self.get_term_bitmap( shard, query_text, term_cache, candidates )
+        elif query["operation"] == "AND":
+            bitmap = self.evaluate_and( shard, query["elements"], candidates, term_cache )
+        elif query["operation"] == "OR":
+            bitmap = self.evaluate_or( shard, query["elements"], query.get("optional_after_pos", None), candidates, term_cache )
+        elif query["operation"] == "NOT":
+            ## complement within the documents of this shard only, otherwise the documents of other shards would match
+            universe = self.shard_doc_ids[shard] if candidates is None else candidates
+            bitmap = universe - self.get_from_shard( shard, query["elements"][0], candidates = candidates, term_cache = term_cache )
+        elif query["operation"] == "PHRASE":
+            bitmap = self.get_from_shard( shard, query["elements"][0], candidates = candidates, term_cache = term_cache )
+            ## shards without positions can only return the candidates of the phrase
+            segment = self.on_disk_dicts[shard]
+            if isinstance( segment, InvertedIndexSegment ) and segment.has_positions and not bitmap.is_empty():
+                bitmap = self.verify_phrase( shard, query["terms"], query["offsets"], bitmap, term_cache )
+        elif query["operation"] == "EXPAND":
+            bitmap = self.get_terms_bitmap( shard, self.expand( query["elements"][0] ), term_cache, candidates )
+        elif query["operation"] == "YEAR_RANGE":
+            bitmap = self.get_year_range_bitmap( shard, query, candidates, term_cache )
         else:
-            arr_list = [ self.get_from_shard(shard, element ) for element in query["elements"]  ]
-            if query["operation"] == "AND":
-                bool_arr = self.bitwise_and( arr_list )
-            elif query["operation"] == "OR":
-                bool_arr = self.bitwise_or( arr_list, query.get("optional_after_pos", None) )
-            elif query["operation"] == "NOT":
-                bool_arr = np.bitwise_not( arr_list[0] )
-            else:
-                print("Warning: wrong operation type")
-                bool_arr = np.packbits(np.zeros( max_len, dtype = np.uint8 ), bitorder='little' )
+            print("Warning: wrong operation type")
+            bitmap = CompressedBitmap()
         
-        if results is not None:
-            results[shard] = bool_arr
+        return bitmap
+    
+    def parse( self, key_string ):
+        query = self.parse_cache.get( key_string )
+        if query is None:
+            query = self.query_parser.parse( key_string )
+            self.parse_cache.put( key_string, query )
+        return query
+    
+    def search( self, key_string ):
+        """
+            Return the bitmap of the matched documents and the number of matched documents, using the result cache
+        """
+        query = self.parse( key_string )
+        cache_key = ( self.index_version, canonicalize_query( query ) )
+        cached_result = self.result_cache.get( cache_key )
+        if cached_result is not None:
+            return cached_result
         
-        return bool_arr
+        ## the shards that certainly do not match (e.g. a rare author name or DOI that is only indexed in one shard) are not searched at all
+        futures = { shard: self.shard_executor.submit( self.get_from_shard, shard, query ) for shard in self.shards if self.may_match( shard, query ) }
+        combined_bitmap = CompressedBitmap.union_all( [ futures[shard].result().shift( self.base_doc_ids[shard] ) for shard in futures ] )
+        result = ( combined_bitmap, combined_bitmap.cardinality() )
+        self.result_cache.put( cache_key, result )
+        return result
     
-    def get_bool_array( self, packed_ids):
-        unpacked_ids = np.unpackbits( packed_ids, bitorder = "little" ) == 1
-        return unpacked_ids
+    def count( self, key_string, approximate = False ):
+        """
+            Return ( number of documents matched by key_string, whether the number is exact ), counted on the compressed bitmaps.
+            approximate: if the query is estimated (from the document frequencies) to match at least approximate_count_threshold documents
+                         and its exact result is not cached, it is only evaluated on the sampled documents and the count is extrapolated.
+        """
+        if approximate:
+            query = self.parse( key_string )
+            shards = list( self.shards )
+            estimated_count = sum( self.estimate_cost( shard, query, {} ) for shard in shards )
+            if estimated_count >= self.approximate_count_threshold:
+                cached_result = self.result_cache.get( ( self.index_version, canonicalize_query( query ) ) )
+                if cached_result is not None:
+                    return cached_result[1], True
+                futures = [ self.shard_executor.submit( self.get_from_shard, shard, query, self.sample_doc_ids[shard] ) for shard in shards ]
+                num_sampled_matches = sum( future.result().cardinality() for future in futures )
+                num_sampled_docs = sum( self.sample_doc_ids[shard].cardinality() for shard in shards )
+                num_docs = sum( self.shard_doc_ids[shard].cardinality() for shard in shards )
+                if num_sampled_docs > 0:
+                    return int( round( num_sampled_matches * num_docs / num_sampled_docs ) ), False
+        return self.search( key_string )[1], True
     
-    def get( self, key_string, bool_array = True):
-        query = self.query_parser.parse(key_string)
-        results = {}
-        threads = []
-        for shard in self.shards:
-            t =  threading.Thread(target=self.get_from_shard, args=(shard, query, results ))
-            threads.append(t)
-            t.start()
-        for t in threads:
-            t.join()
+    def get_bm25_terms( self, text ):
+        ## the plain unigrams and bigrams of a free text ranking query
+        words = self.query_parser.sent_tokenizer.tokenize( text ).strip().split()
+        return sorted( self.query_parser.get_unigrams( words ) | self.query_parser.get_bigrams( words ) )
+    
+    def get_term_freqs( self, shard, term, term_cache, candidate_ids = None ):
+        """
+            Return ( relative doc ids, term frequencies ) of a term in a shard, restricted to the sorted (relative) candidate_ids if given.
+            The shards without term frequencies count every occurrence once.
+        """
+        doc_freq, ordinal, postings = self.get_term_info( shard, term, term_cache )
+        if doc_freq == 0:
+            return np.zeros( 0, dtype = np.uint32 ), np.zeros( 0, dtype = np.uint8 )
+        if ordinal is None:
+            doc_ids = postings if candidate_ids is None else np.intersect1d( postings, candidate_ids, assume_unique = True )
+            return doc_ids, np.ones( len(doc_ids), dtype = np.uint8 )
+        segment = self.on_disk_dicts[shard]
+        if candidate_ids is not None and len(candidate_ids) * SKIP_LIST_RATIO < doc_freq:
+            return segment.get_term_freqs_within( ordinal, candidate_ids )
+        doc_ids = segment.get_postings_by_ordinal( ordinal )
+        term_freqs = segment.get_term_freqs_by_ordinal( ordinal )
+        if term_freqs is None:
+            term_freqs = np.ones( len(doc_ids), dtype = np.uint8 )
+        if candidate_ids is not None:
+            pos = np.minimum( np.searchsorted( candidate_ids, doc_ids ), max( len(candidate_ids) - 1, 0 ) )
+            mask = candidate_ids[pos] == doc_ids if len(candidate_ids) > 0 else np.zeros( len(doc_ids), dtype = bool )
+            doc_ids, term_freqs = doc_ids[mask], term_freqs[mask]
+        return doc_ids, term_freqs
+    
+    def get_bm25_stats( self, terms, shards ):
+        """
+            Return ( idf of each term, average document length ) over all the shards, so that the scores of different shards are comparable.
+            The documents of the shards without term frequencies are assumed to have the average length.
+        """
+        num_docs = sum( self.shard_doc_ids[shard].cardinality() for shard in shards )
+        doc_freqs = np.array( [ sum( get_doc_freq( self.on_disk_dicts[shard], term ) for shard in shards ) for term in terms ], dtype = np.float64 )
+        idfs = np.log( 1 + ( num_docs - doc_freqs + 0.5 ) / ( doc_freqs + 0.5 ) )
+        
+        tf_shards = [ shard for shard in shards if getattr( self.on_disk_dicts[shard], "has_term_freqs", False ) ]
+        num_tf_docs = sum( self.shard_doc_ids[shard].cardinality() for shard in tf_shards )
+        avg_doc_length = sum( self.on_disk_dicts[shard].total_doc_length for shard in tf_shards ) / num_tf_docs if num_tf_docs > 0 else 1.0
+        return idfs, max( avg_doc_length, 1.0 )
+    
+    def get_top_n_bm25_in_shard( self, shard, n, terms, idfs, avg_doc_length, key_query = None, candidate_ids = None ):
+        """
+            Top n documents of a shard by their BM25 score for terms (a disjunction), using term-at-a-time MaxScore:
+            the terms are processed from the highest to the lowest score upper bound. Once the upper bounds of the remaining terms sum up
+            to less than the n-th best score so far, no new document can enter the top n, so the remaining terms are only looked up
+            (through the skip lists) for the documents that can still make it.
+            key_query: only rank the documents matched by this parsed query; candidate_ids: only rank these (sorted, relative) doc ids.
+            Return ( absolute doc ids, scores ) and the number of documents matched by key_query.
+        """
+        term_cache = {}
+        if key_query is not None:
+            bitmap = self.get_from_shard( shard, key_query, term_cache = term_cache )
+            num_matched_documents = bitmap.cardinality()
+            candidate_ids = bitmap.to_ids() if candidate_ids is None else intersect_sorted( bitmap.to_ids(), candidate_ids )
+        else:
+            num_matched_documents = self.shard_doc_ids[shard].cardinality()
+        
+        segment = self.on_disk_dicts[shard]
+        doc_lengths = segment.doc_lengths if getattr( segment, "has_term_freqs", False ) else None
+        k1, b = self.bm25_k1, self.bm25_b
+        
+        ## the largest score of a term is reached with its largest term frequency in the shortest possible document
+        term_list = []
+        for term, idf in zip( terms, idfs ):
+            doc_freq, ordinal, _ = self.get_term_info( shard, term, term_cache )
+            if doc_freq == 0:
+                continue
+            max_tf = float( segment.term_max_tfs[ordinal] ) if doc_lengths is not None else 1.0
+            upper_bound = idf * max_tf * ( k1 + 1 ) / ( max_tf + k1 * ( 1 - b ) ) if doc_lengths is not None else idf
+            term_list.append( ( upper_bound, term, idf ) )
+        term_list.sort( key = lambda x: -x[0] )
+        upper_bounds = np.array( [ upper_bound for upper_bound, _, _ in term_list ] )
+        ## remaining_upper_bounds[i]: the largest score that the terms i, i+1, ... can add to a document
+        remaining_upper_bounds = np.cumsum( upper_bounds[::-1] )[::-1] if len(term_list) > 0 else upper_bounds
+        
+        doc_ids = np.zeros( 0, dtype = np.uint32 )
+        scores = np.zeros( 0, dtype = np.float64 )
+        threshold = 0.0
+        for i, ( _, term, idf ) in enumerate( term_list ):
+            essential = len(doc_ids) < n or remaining_upper_bounds[i] > threshold
+            if essential:
+                term_doc_ids, term_freqs = self.get_term_freqs( shard, term, term_cache, candidate_ids )
+            else:
+                ## only the documents that can still reach the top n
+                keep = scores + remaining_upper_bounds[i] > threshold
+                doc_ids, scores = doc_ids[keep], scores[keep]
+                term_doc_ids, term_freqs = self.get_term_freqs( shard, term, term_cache, doc_ids )
+            
+            term_freqs = term_freqs.astype( np.float64 )
+            lengths = doc_lengths[ term_doc_ids ].astype( np.float64 ) if doc_lengths is not None else avg_doc_length
+            term_scores = idf * term_freqs * ( k1 + 1 ) / ( term_freqs + k1 * ( 1 - b + b * lengths / avg_doc_length ) )
+            if essential:
+                doc_ids, inverse = np.unique( np.concatenate( [ doc_ids, term_doc_ids ] ), return_inverse = True )
+                scores = np.bincount( inverse, weights = np.concatenate( [ scores, term_scores ] ) )
+            else:
+                scores[ np.searchsorted( doc_ids, term_doc_ids ) ] += term_scores
+            if len(scores) >= n and n > 0:
+                threshold = np.partition( scores, len(scores) - n )[ len(scores) - n ]
         
-        combined_unpacked_bool_arr = self.get_bool_array( self.bitwise_or( [ results[shard] for shard in results] ))
+        top = np.argsort( -scores, kind = "stable" )[:n]
+        return ( doc_ids[top].astype( np.int64 ) + self.base_doc_ids[shard], scores[top] ), num_matched_documents
+    
+    def get_top_n_bm25( self, n, ranking_source, key_string = "", doc_id_list = None ):
+        """
+            Rank the documents by the BM25 score of the unigrams and bigrams of ranking_source, directly from the inverted index.
+            key_string: only rank the documents matched by these keywords; doc_id_list: only rank these (absolute) doc ids.
+            Return ( absolute doc ids, scores ) of the top n documents, and the number of documents matched by key_string.
+        """
+        shards = list( self.shards )
+        terms = self.get_bm25_terms( ranking_source )
+        key_query = self.parse( key_string ) if key_string.strip() != "" else None
+        idfs, avg_doc_length = self.get_bm25_stats( terms, shards )
+        if doc_id_list is not None:
+            doc_id_list = np.unique( np.asarray( doc_id_list, dtype = np.int64 ) )
+        
+        futures = []
+        for shard in shards:
+            candidate_ids = None
+            if doc_id_list is not None:
+                base_doc_id = self.base_doc_ids[shard]
+                candidate_ids = doc_id_list[ ( doc_id_list >= base_doc_id ) & ( doc_id_list < base_doc_id + len( self.packed_doc_ids[shard] ) * 8 ) ] - base_doc_id
+                candidate_ids = intersect_sorted( self.shard_doc_ids[shard].to_ids(), candidate_ids.astype( np.uint32 ) )
+            futures.append( self.shard_executor.submit( self.get_top_n_bm25_in_shard, shard, n, terms, idfs, avg_doc_length, key_query, candidate_ids ) )
+        results = [ future.result() for future in futures ]
         
-        if bool_array:
-            return { self.collection: combined_unpacked_bool_arr}
+        doc_ids = np.concatenate( [ np.zeros( 0, dtype = np.int64 ) ] + [ result[0][0] for result in results ] )
+        scores = np.concatenate( [ np.zeros( 0, dtype = np.float64 ) ] + [ result[0][1] for result in results ] )
+        top = np.argsort( -scores, kind = "stable" )[:n]
+        return ( doc_ids[top], scores[top] ), sum( result[1] for result in results )
+    
+    def get_with_count( self, key_string, bool_array = True, packed = False ):
+        combined_bitmap, num_matched_documents = self.search( key_string )
+        
+        if packed:
+            ## ( bitmap packed with bitorder = "little", number of doc ids ), which the Ranker ships as is to its shard processes
+            filtered_results = { self.collection: ( combined_bitmap.to_packed( ( self.max_num_doc_ids + 7 ) // 8 ), self.max_num_doc_ids ) }
+        elif bool_array:
+            filtered_results = { self.collection: combined_bitmap.to_bool_array( self.max_num_doc_ids ) }
         else:
-            filtered_indices = np.argwhere( combined_unpacked_bool_arr )[:,0]
-            return { self.collection: filtered_indices }
+            filtered_results = { self.collection: combined_bitmap.to_ids().astype( np.int64 ) }
+        return filtered_results, num_matched_documents
+    
+    def get( self, key_string, bool_array = True):
+        return self.get_with_count( key_string, bool_array )[0]
     
     def close(self):
         for shard in self.on_disk_dicts:
             self.on_disk_dicts[shard].close()
     
     def __del__(self):
-        self.close()
\ No newline at end of file
+        self.close()
+        self.shard_executor.shutdown( wait = False )
\ No newline at end of file
@@ -0,0 +1,221 @@
+import numpy as np
+import threading
+from numba import njit
+
+
+"""
+    Brute-force nearest neighbor search on CPU, without cupy (this module can be imported on the nodes without GPUs).
+
+    The embeddings are kept as compact codes that are scanned in chunks of SCAN_CHUNK_SIZE rows with all the queries at once (threaded across chunks).
+    The best candidates of the scan are then re-scored with the float32 embeddings, which are only read for these rows
+    (from the memory-mapped shard, they do not need to stay in memory).
+
+    BFIndexIPInt8CPU keeps int8 codes with one scale per dimension (symmetric scalar quantization):
+        code[i,d] = round( x[i,d] / scale[d] ), scale[d] = max_i |x[i,d]| / 127,   so that   q.x ~ ( q * scale ).code
+    the queries ( q * scale ) are quantized to int8 as well, with one scale per query, and each chunk is scored by a numba kernel
+    that multiplies the int8 codes with int32 accumulation (no float32 copy of the chunk).
+    BFIndexIPBoolCPU keeps 1-bit sign codes, packed like in DPBool: pack_to_int8( x > 0 ), 32x smaller than float32,
+    and ranks them by the Hamming similarity to the sign code of the query ( vector_dim - popcount( code XOR query code ) ),
+    the codes are padded to a multiple of 64 bits so that the XOR and popcount run on uint64 words.
+"""
+
+SCAN_CHUNK_SIZE = 8192
+## the number of candidates re-scored per query: max( RESCORING_FACTOR * n, MIN_RESCORING_CANDIDATES )
+RESCORING_FACTOR = 4
+MIN_RESCORING_CANDIDATES = 256
+## the sign codes are much coarser than the int8 codes, so that more candidates are re-scored
+BOOL_RESCORING_FACTOR = 10
+BOOL_MIN_RESCORING_CANDIDATES = 1000
+
+## count of 1-bits of each uint8 value, used when np.bitwise_count is not available (numpy < 2.0)
+POPCOUNT_TABLE = np.array( [ bin(i).count("1") for i in range(256) ], dtype = np.uint8 )
+
+
+def popcount( a ):
+    ## number of 1-bits of each element of the unsigned integer array a (2D), or of each of its bytes with the lookup table
+    if hasattr( np, "bitwise_count" ):
+        return np.bitwise_count( a )
+    return POPCOUNT_TABLE[ a.view( np.uint8 ) ]
+
+
+@njit( nogil = True )
+def int8_dot( codes, query_codes, out ):
+    ## out[q,i] = query_codes[q] . codes[i], the int8 products are accumulated in int32;
+    ## each row of codes is widened once and multiplied with all the queries while it is in the cache
+    dim = codes.shape[1]
+    query_codes = query_codes.astype( np.int16 )
+    row = np.zeros( dim, dtype = np.int16 )
+    for i in range( codes.shape[0] ):
+        for d in range( dim ):
+            row[d] = codes[i,d]
+        for q in range( query_codes.shape[0] ):
+            acc = np.int32(0)
+            for d in range( dim ):
+                acc += row[d] * query_codes[q,d]
+            out[q,i] = acc
+
+
+def merge_top_k( I, D, new_I, new_D, k ):
+    ## the k best columns of each row of the concatenation of ( I, D ) and ( new_I, new_D ), unsorted
+    I = np.concatenate( [ I, new_I ], axis = 1 )
+    D = np.concatenate( [ D, new_D ], axis = 1 )
+    if D.shape[1] > k:
+        best = np.argpartition( -D, k-1, axis = 1 )[:,:k]
+        I = np.take_along_axis( I, best, axis = 1 )
+        D = np.take_along_axis( D, best, axis = 1 )
+    return I, D
+
+
+class BFIndexIPQuantizedCPU:
+    """
+        Scan and re-scoring shared by the CPU indices with compact codes. A subclass sets self.codes in its __init__
+        and implements encode_query() and chunk_scores()
+    """
+    def __init__( self, embeddings, vector_dim, normalize = True, num_threads = 1,
+                        rescoring_factor = RESCORING_FACTOR, min_rescoring_candidates = MIN_RESCORING_CANDIDATES ):
+        ## embeddings: float32 or float16 matrix, e.g. the memory-mapped embedding matrix of a shard, only read by chunks;
+        ## normalize: search with the l2-normalized embeddings (the codes and the re-scoring use the normalized rows)
+        self.embeddings = embeddings
+        self.total_num_embeddings = embeddings.shape[0]
+        self.vector_dim = vector_dim
+        self.num_threads = max( num_threads, 1 )
+        self.rescoring_factor = rescoring_factor
+        self.min_rescoring_candidates = min_rescoring_candidates
+
+        ## the inverse norm of each row
+        self.row_scales = np.ones( self.total_num_embeddings, dtype = np.float32 )
+        if normalize:
+            for start, chunk in self.iterate_chunks():
+                self.row_scales[ start:start + SCAN_CHUNK_SIZE ] = 1 / ( np.linalg.norm( chunk, axis = 1 ) + 1e-12 )
+
+    def iterate_chunks( self ):
+        ## ( start, float32 chunk of the embeddings at start ), not normalized
+        for start in range( 0, self.total_num_embeddings, SCAN_CHUNK_SIZE ):
+            yield start, np.asarray( self.embeddings[ start:start + SCAN_CHUNK_SIZE ], dtype = np.float32 )
+
+    def encode_query( self, query_embedding ):
+        ## the form of the queries ( num_queries, ... ) passed to chunk_scores()
+        raise NotImplementedError
+
+    def chunk_scores( self, chunk, encoded_query_embedding ):
+        ## approximate similarities ( num_queries, chunk size ) of a chunk of the codes
+        raise NotImplementedError
+
+    def scan_kernel( self, encoded_query_embedding, num_queries, k, chunk_starts, indices_range, results, thread_number ):
+        ## the k best rows (approximate scores) among the chunks starting at chunk_starts
+        I = np.zeros( ( num_queries, 0 ), dtype = np.int64 )
+        D = np.zeros( ( num_queries, 0 ), dtype = np.float32 )
+        for start in chunk_starts:
+            if indices_range is None:
+                chunk_indices = np.arange( start, min( start + SCAN_CHUNK_SIZE, self.total_num_embeddings ) )
+                chunk = self.codes[ start:start + SCAN_CHUNK_SIZE ]
+            else:
+                chunk_indices = indices_range[ start:start + SCAN_CHUNK_SIZE ]
+                chunk = self.codes[ chunk_indices ]
+            distances = self.chunk_scores( chunk, encoded_query_embedding )
+            if distances.shape[1] > k:
+                best = np.argpartition( -distances, k-1, axis = 1 )[:,:k]
+                I, D = merge_top_k( I, D, chunk_indices[ best ], np.take_along_axis( distances, best, axis = 1 ), k )
+            else:
+                I, D = merge_top_k( I, D, np.tile( chunk_indices, ( num_queries, 1 ) ), distances, k )
+        results[ thread_number ] = ( I, D )
+
+    def rescore( self, query_embedding, I ):
+        ## the exact similarities of the candidates I ( num_queries, k ), each row of the embeddings is read once
+        rows, inverse = np.unique( I, return_inverse = True )
+        sims = np.matmul( np.asarray( self.embeddings[ rows ], dtype = np.float32 ) * self.row_scales[ rows, np.newaxis ], query_embedding.T )
+        return sims[ inverse.reshape( I.shape ), np.arange( I.shape[0] )[:,np.newaxis] ]
+
+    def search( self, query_embedding, n, indices_range = None, requires_precision_conversion = None ):
+        """
+            query_embedding: ( num_queries, vector_dim ); indices_range: the positions to search (None: all of them).
+            Return ( D, I ) of shape ( num_queries, min( n, number of searched positions ) ), sorted by decreasing similarity
+            requires_precision_conversion is not used, like in BFIndexIPCPU.
+            The candidates re-scored per query are max( rescoring_factor * n, min_rescoring_candidates )
+        """
+        query_embedding = np.asarray( query_embedding, dtype = np.float32 )
+        if indices_range is not None:
+            indices_range = np.asarray( indices_range, dtype = np.int64 )
+        num_searched = self.total_num_embeddings if indices_range is None else len( indices_range )
+        n = min( n, num_searched )
+        if n <= 0:
+            return np.zeros( ( query_embedding.shape[0], 0 ), dtype = np.float32 ), np.zeros( ( query_embedding.shape[0], 0 ), dtype = np.int64 )
+        k = min( max( self.rescoring_factor * n, self.min_rescoring_candidates ), num_searched )
+
+        encoded_query_embedding = self.encode_query( query_embedding )
+        chunk_starts = list( range( 0, num_searched, SCAN_CHUNK_SIZE ) )
+        num_threads = min( self.num_threads, len( chunk_starts ) )
+        results = [ None ] * num_threads
+        threads = []
+        for thread_number in range( num_threads ):
+            t = threading.Thread( target = self.scan_kernel, args = ( encoded_query_embedding, query_embedding.shape[0], k, chunk_starts[ thread_number::num_threads ], indices_range, results, thread_number ) )
+            threads.append(t)
+            t.start()
+        for t in threads:
+            t.join()
+        I = np.concatenate( [ res[0] for res in results ], axis = 1 )
+        D = np.concatenate( [ res[1] for res in results ], axis = 1 )
+        I, D = merge_top_k( I[:,:0], D[:,:0], I, D, k )
+
+        D = self.rescore( query_embedding, I )
+        best = np.argsort( -D, axis = 1 )[:,:n]
+        return np.take_along_axis( D, best, axis = 1 ), np.take_along_axis( I, best, axis = 1 ).astype( np.int64 )
+
+
+class BFIndexIPInt8CPU( BFIndexIPQuantizedCPU ):
+    def __init__( self, embeddings, vector_dim, normalize = True, num_threads = 1,
+                        rescoring_factor = RESCORING_FACTOR, min_rescoring_candidates = MIN_RESCORING_CANDIDATES ):
+        super().__init__( embeddings, vector_dim, normalize, num_threads, rescoring_factor, min_rescoring_candidates )
+        ## first pass: the maximum absolute value of each dimension
+        max_abs_values = np.zeros( embeddings.shape[1], dtype = np.float32 )
+        for start, chunk in self.iterate_chunks():
+            chunk = chunk * self.row_scales[ start:start + SCAN_CHUNK_SIZE, np.newaxis ]
+            max_abs_values = np.maximum( max_abs_values, np.abs( chunk ).max( axis = 0 ) )
+        self.scales = np.where( max_abs_values > 0, max_abs_values / 127, 1 ).astype( np.float32 )
+
+        ## second pass: the int8 codes
+        self.codes = np.zeros( embeddings.shape, dtype = np.int8 )
+        for start, chunk in self.iterate_chunks():
+            chunk = chunk * self.row_scales[ start:start + SCAN_CHUNK_SIZE, np.newaxis ]
+            self.codes[ start:start + SCAN_CHUNK_SIZE ] = np.clip( np.rint( chunk / self.scales ), -127, 127 )
+
+    def encode_query( self, query_embedding ):
+        ## ( int8 codes of q * scale, the scale of each query )
+        query_embedding = query_embedding * self.scales
+        query_scales = np.abs( query_embedding ).max( axis = 1 ) / 127
+        query_scales = np.where( query_scales > 0, query_scales, 1 ).astype( np.float32 )
+        query_codes = np.clip( np.rint( query_embedding / query_scales[:,np.newaxis] ), -127, 127 ).astype( np.int8 )
+        return query_codes, query_scales
+
+    def chunk_scores( self, chunk, encoded_query_embedding ):
+        query_codes, query_scales = encoded_query_embedding
+        distances = np.empty( ( query_codes.shape[0], chunk.shape[0] ), dtype = np.int32 )
+        int8_dot( np.ascontiguousarray( chunk ), query_codes, distances )
+        return np.multiply( distances, query_scales[:,np.newaxis], dtype = np.float32 )
+
+
+class BFIndexIPBoolCPU( BFIndexIPQuantizedCPU ):
+    def __init__( self, embeddings, vector_dim, normalize = True, num_threads = 1,
+                        rescoring_factor = BOOL_RESCORING_FACTOR, min_rescoring_candidates = BOOL_MIN_RESCORING_CANDIDATES ):
+        super().__init__( embeddings, vector_dim, normalize, num_threads, rescoring_factor, min_rescoring_candidates )
+        ## the sign of a dimension does not depend on the normalization
+        self.num_words = int( np.ceil( embeddings.shape[1] / 64 ) )
+        self.codes = np.zeros( ( self.total_num_embeddings, self.num_words ), dtype = np.uint64 )
+        for start, chunk in self.iterate_chunks():
+            self.codes[ start:start + SCAN_CHUNK_SIZE ] = self.pack_to_int8( chunk > 0 )
+
+    def pack_to_int8( self, a ):
+        ## same bit layout as DPBool.pack_to_int8(), zero-padded to num_words uint64 words per row (the padding bits never differ)
+        packed_a = np.zeros( ( a.shape[0], self.num_words * 8 ), dtype = np.uint8 )
+        packed_a[ :, :int( np.ceil( a.shape[1] / 8 ) ) ] = np.packbits( a, axis = 1 )
+        return packed_a.view( np.uint64 )
+
+    def encode_query( self, query_embedding ):
+        return self.pack_to_int8( query_embedding > 0 )
+
+    def chunk_scores( self, chunk, encoded_query_embedding ):
+        ## Hamming similarity, computed for one query at a time to keep the ( chunk size, num bytes ) buffer small
+        distances = np.zeros( ( encoded_query_embedding.shape[0], chunk.shape[0] ), dtype = np.float32 )
+        for count, query_code in enumerate( encoded_query_embedding ):
+            distances[count] = self.vector_dim - popcount( np.bitwise_xor( chunk, query_code ) ).sum( axis = 1, dtype = np.int32 )
+        return distances
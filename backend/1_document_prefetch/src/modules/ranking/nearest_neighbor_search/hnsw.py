@@ -0,0 +1,367 @@
+import os
+import json
+import shutil
+import heapq
+import threading
+import numpy as np
+from numba import njit
+from concurrent.futures import ThreadPoolExecutor
+
+
+"""
+    HNSW graph (hierarchical navigable small world) for the inner product search on the normalized embeddings of a shard, on CPU.
+
+    Each node (the pos of a document) has a random level, it has at most 2*M neighbors on level 0 and at most M neighbors on each level above,
+    chosen with the neighbor selection heuristic of the HNSW paper. A search descends greedily from the entry point to level 1,
+    then explores level 0 with a candidate list of ef_search nodes. With an allowed mask (filtered search), all the nodes are traversed,
+    but only the allowed ones are kept as results.
+
+    The nodes are inserted in batches: the candidates of all the nodes of a batch are searched by several threads in the graph of the previous
+    batches, then the nodes are linked one after another, each one also compared exactly with the nodes of its batch inserted before it.
+    The graph does not depend on the number of threads. The build is far slower than a search (per 700-dim node on one core: about 0.25 ms for 20k nodes, 0.7 ms for 100k),
+    so it is done by service_build_index/build_hnsw_indices.py, not when a shard is loaded.
+
+    The graph is stored as arrays, so that it is saved as .npy files next to the shard and memory-mapped at load:
+        levels:             int32 ( num_docs, ), the level of each node
+        neighbors0:         int32 ( num_docs, 2*M ), the neighbors on level 0, padded with -1
+        upper_offsets:      int64 ( num_docs, ), the row of level 1 of each node in upper_neighbors, its row of level l is upper_offsets + l - 1 (-1: level 0 only)
+        upper_neighbors:    int32 ( number of upper levels of all the nodes, M ), padded with -1
+        header.json:        {"entry_point", "max_level", "M", "ef_construction"}
+"""
+
+## the graph is serialized into this subfolder of the embedding index shard
+HNSW_INDEX_FOLDER = "hnsw_index"
+## maximum number of neighbors per node and level (2*M on level 0), and the size of the candidate list when inserting a node
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 100
+## default size of the candidate list of a search (at least n)
+HNSW_EF_SEARCH = 128
+## the nodes are inserted in batches of at most this size: the candidates of the nodes of a batch are searched in parallel in the graph
+## of the previous batches, then the nodes are linked one after another; a batch is at most 1/HNSW_BUILD_BATCH_RATIO of the inserted nodes
+HNSW_BUILD_BATCH_SIZE = 256
+HNSW_BUILD_BATCH_RATIO = 16
+
+
+@njit( nogil = True, fastmath = True )
+def _dot( vectors, a, b ):
+    s = np.float32(0)
+    for d in range( vectors.shape[1] ):
+        s += vectors[a, d] * vectors[b, d]
+    return s
+
+@njit( nogil = True, fastmath = True )
+def _query_dot( vectors, query, a ):
+    s = np.float32(0)
+    for d in range( vectors.shape[1] ):
+        s += vectors[a, d] * query[d]
+    return s
+
+@njit( nogil = True )
+def _get_neighbors( node, level, neighbors0, upper_offsets, upper_neighbors ):
+    if level == 0:
+        return neighbors0[node]
+    return upper_neighbors[ upper_offsets[node] + level - 1 ]
+
+@njit( nogil = True )
+def _greedy_search( query, entry_point, level, vectors, neighbors0, upper_offsets, upper_neighbors ):
+    ## the node of this level closest to the query, moving to the best neighbor as long as it improves
+    current = entry_point
+    current_sim = _query_dot( vectors, query, current )
+    changed = True
+    while changed:
+        changed = False
+        neighbors = _get_neighbors( current, level, neighbors0, upper_offsets, upper_neighbors )
+        for i in range( len(neighbors) ):
+            e = neighbors[i]
+            if e < 0:
+                break
+            s = _query_dot( vectors, query, e )
+            if s > current_sim:
+                current, current_sim, changed = e, s, True
+    return current
+
+@njit( nogil = True )
+def _search_layer( query, entry_points, ef, level, vectors, neighbors0, upper_offsets, upper_neighbors, visited, tag, allowed_mask, use_mask ):
+    """
+        The ef best (allowed) nodes of a level, starting from entry_points; visited[node] == tag marks the visited nodes.
+        Return ( similarities, nodes ), sorted by decreasing similarity
+    """
+    ## candidates: max-heap of ( -similarity, node ); results: min-heap of ( similarity, node ) of the allowed nodes
+    candidates = [ ( np.float32(0), np.int64(0) ) ]
+    results = [ ( np.float32(0), np.int64(0) ) ]
+    candidates.pop()
+    results.pop()
+    for i in range( len(entry_points) ):
+        e = entry_points[i]
+        visited[e] = tag
+        s = _query_dot( vectors, query, e )
+        heapq.heappush( candidates, ( -s, np.int64(e) ) )
+        if not use_mask or allowed_mask[e]:
+            heapq.heappush( results, ( s, np.int64(e) ) )
+            if len(results) > ef:
+                heapq.heappop( results )
+    while len(candidates) > 0:
+        neg_sim, c = heapq.heappop( candidates )
+        if len(results) >= ef and -neg_sim < results[0][0]:
+            break
+        neighbors = _get_neighbors( c, level, neighbors0, upper_offsets, upper_neighbors )
+        for i in range( len(neighbors) ):
+            e = neighbors[i]
+            if e < 0:
+                break
+            if visited[e] == tag:
+                continue
+            visited[e] = tag
+            s = _query_dot( vectors, query, e )
+            if len(results) < ef or s > results[0][0]:
+                heapq.heappush( candidates, ( -s, np.int64(e) ) )
+                if not use_mask or allowed_mask[e]:
+                    heapq.heappush( results, ( s, np.int64(e) ) )
+                    if len(results) > ef:
+                        heapq.heappop( results )
+    sims = np.zeros( len(results), dtype = np.float32 )
+    nodes = np.zeros( len(results), dtype = np.int64 )
+    for i in range( len(results) - 1, -1, -1 ):
+        s, e = heapq.heappop( results )
+        sims[i] = s
+        nodes[i] = e
+    return sims, nodes
+
+@njit( nogil = True )
+def _select_neighbors( base_node, sims, nodes, max_neighbors, vectors ):
+    ## neighbor selection heuristic: a candidate (by decreasing similarity to base_node) is kept if it is closer to base_node than to all the kept ones
+    selected = np.full( max_neighbors, -1, dtype = np.int32 )
+    num_selected = 0
+    for i in range( len(nodes) ):
+        e = nodes[i]
+        if e == base_node:
+            continue
+        is_kept = True
+        for j in range( num_selected ):
+            if _dot( vectors, e, selected[j] ) > sims[i]:
+                is_kept = False
+                break
+        if is_kept:
+            selected[num_selected] = e
+            num_selected += 1
+            if num_selected == max_neighbors:
+                break
+    return selected
+
+@njit( nogil = True )
+def _add_link( node, e, level, vectors, neighbors0, upper_offsets, upper_neighbors ):
+    ## add node to the neighbors of e, re-selecting the neighbors of e if its list is full
+    neighbors = _get_neighbors( e, level, neighbors0, upper_offsets, upper_neighbors )
+    for i in range( len(neighbors) ):
+        if neighbors[i] < 0:
+            neighbors[i] = node
+            return
+    sims = np.zeros( len(neighbors) + 1, dtype = np.float32 )
+    nodes = np.zeros( len(neighbors) + 1, dtype = np.int64 )
+    for i in range( len(neighbors) ):
+        nodes[i] = neighbors[i]
+        sims[i] = _dot( vectors, e, neighbors[i] )
+    nodes[-1] = node
+    sims[-1] = _dot( vectors, e, node )
+    order = np.argsort( -sims )
+    neighbors[:] = _select_neighbors( e, sims[order], nodes[order], len(neighbors), vectors )
+
+@njit( nogil = True )
+def _search_batch( vectors, levels, batch_start, first, end, step, entry_point, max_level, neighbors0, upper_offsets, upper_neighbors, ef_construction,
+                   visited, tag, result_sims, result_nodes, result_counts ):
+    ## the candidates of the nodes first, first + step, ... < end of the batch starting at batch_start on each of their levels up to max_level, in the graph of the nodes inserted
+    ## before the batch (read only), which is searched by several threads at once; return the last tag used in visited
+    for node in range( first, end, step ):
+        query = vectors[node]
+        level = levels[node]
+        current = entry_point
+        for l in range( max_level, level, -1 ):
+            current = _greedy_search( query, current, l, vectors, neighbors0, upper_offsets, upper_neighbors )
+        entry_points = np.array( [ current ], dtype = np.int64 )
+        for l in range( min( level, max_level ), -1, -1 ):
+            if tag == np.iinfo( np.int32 ).max:
+                visited[:] = 0
+                tag = 0
+            tag += 1
+            sims, nodes = _search_layer( query, entry_points, ef_construction, l, vectors, neighbors0, upper_offsets, upper_neighbors,
+                                         visited, tag, np.zeros( 1, dtype = np.bool_ ), False )
+            result_sims[ node - batch_start, l, :len(nodes) ] = sims
+            result_nodes[ node - batch_start, l, :len(nodes) ] = nodes
+            result_counts[ node - batch_start, l ] = len(nodes)
+            entry_points = nodes
+    return tag
+
+@njit( nogil = True )
+def _link_batch( vectors, levels, start, end, entry_point, max_level, neighbors0, upper_offsets, upper_neighbors, M, ef_construction,
+                 result_sims, result_nodes, result_counts ):
+    ## link the nodes start ... end-1 one after another; the nodes of the batch inserted before a node are not in its searched candidates,
+    ## so they are compared with it exactly. Return the new ( entry_point, max_level )
+    batch_max_level = max_level
+    for node in range( start, end ):
+        level = levels[node]
+        for l in range( level, -1, -1 ):
+            num_searched = result_counts[ node - start, l ] if l <= batch_max_level else 0
+            num_candidates = num_searched
+            for other in range( start, node ):
+                if levels[other] >= l:
+                    num_candidates += 1
+            if num_candidates == 0:
+                continue
+            sims = np.zeros( num_candidates, dtype = np.float32 )
+            nodes = np.zeros( num_candidates, dtype = np.int64 )
+            sims[:num_searched] = result_sims[ node - start, l, :num_searched ]
+            nodes[:num_searched] = result_nodes[ node - start, l, :num_searched ]
+            count = num_searched
+            for other in range( start, node ):
+                if levels[other] >= l:
+                    sims[count] = _dot( vectors, node, other )
+                    nodes[count] = other
+                    count += 1
+            order = np.argsort( -sims )[:ef_construction]
+            max_neighbors = 2 * M if l == 0 else M
+            selected = _select_neighbors( node, sims[order], nodes[order], max_neighbors, vectors )
+            _get_neighbors( node, l, neighbors0, upper_offsets, upper_neighbors )[:] = selected
+            for i in range( max_neighbors ):
+                if selected[i] < 0:
+                    break
+                _add_link( node, selected[i], l, vectors, neighbors0, upper_offsets, upper_neighbors )
+        if level > max_level:
+            entry_point = node
+            max_level = level
+    return entry_point, max_level
+
+def _build_graph( vectors, levels, neighbors0, upper_offsets, upper_neighbors, M, ef_construction, num_threads ):
+    ## insert the nodes in batches, node 0 is the first entry point; return ( entry_point, max_level )
+    num_docs = vectors.shape[0]
+    ## one visited buffer per thread, with the last tag used in it
+    visited = [ [ np.zeros( num_docs, dtype = np.int32 ), 0 ] for _ in range( num_threads ) ]
+    max_batch_size = min( HNSW_BUILD_BATCH_SIZE, max( num_docs - 1, 1 ) )
+    result_sims = np.zeros( ( max_batch_size, int( levels.max() ) + 1, ef_construction ), dtype = np.float32 )
+    result_nodes = np.zeros( ( max_batch_size, int( levels.max() ) + 1, ef_construction ), dtype = np.int64 )
+    result_counts = np.zeros( ( max_batch_size, int( levels.max() ) + 1 ), dtype = np.int64 )
+    entry_point = 0
+    max_level = int( levels[0] )
+    
+    def search_batch( start, end, t ):
+        visited[t][1] = _search_batch( vectors, levels, start, start + t, end, num_threads, entry_point, max_level, neighbors0, upper_offsets, upper_neighbors,
+                                       ef_construction, visited[t][0], visited[t][1], result_sims, result_nodes, result_counts )
+    
+    start = 1
+    with ThreadPoolExecutor( max_workers = num_threads ) as executor:
+        while start < num_docs:
+            end = min( start + max( start // HNSW_BUILD_BATCH_RATIO, 1 ), start + max_batch_size, num_docs )
+            ## the result() calls re-raise the exceptions of the threads
+            for future in [ executor.submit( search_batch, start, end, t ) for t in range( num_threads ) ]:
+                future.result()
+            entry_point, max_level = _link_batch( vectors, levels, start, end, entry_point, max_level, neighbors0, upper_offsets, upper_neighbors, M, ef_construction,
+                                                  result_sims, result_nodes, result_counts )
+            start = end
+    return entry_point, max_level
+
+@njit( nogil = True )
+def _search( query, n, ef_search, entry_point, max_level, vectors, neighbors0, upper_offsets, upper_neighbors, allowed_mask, use_mask, visited, tag ):
+    current = entry_point
+    for l in range( max_level, 0, -1 ):
+        current = _greedy_search( query, current, l, vectors, neighbors0, upper_offsets, upper_neighbors )
+    sims, nodes = _search_layer( query, np.array( [ current ], dtype = np.int64 ), max( ef_search, n ), 0, vectors, neighbors0, upper_offsets, upper_neighbors,
+                                 visited, tag, allowed_mask, use_mask )
+    return sims[:n], nodes[:n]
+
+
+class HNSWIndex:
+    def __init__( self, vectors, levels, neighbors0, upper_offsets, upper_neighbors, header ):
+        ## vectors: the normalized float32 embeddings the graph was built on
+        self.vectors = vectors
+        self.levels = levels
+        self.neighbors0 = neighbors0
+        self.upper_offsets = upper_offsets
+        self.upper_neighbors = upper_neighbors
+        self.header = header
+        ## the visited marks of the searches, one buffer per thread
+        self.thread_state = threading.local()
+
+    @classmethod
+    def build( cls, vectors, M = HNSW_M, ef_construction = HNSW_EF_CONSTRUCTION, seed = 0, num_threads = None ):
+        ## num_threads: the threads searching the candidates of a batch (None: the number of cores); the graph does not depend on it
+        num_threads = os.cpu_count() if num_threads is None else max( int(num_threads), 1 )
+        vectors = np.ascontiguousarray( vectors, dtype = np.float32 )
+        num_docs = vectors.shape[0]
+        ## the level of each node follows the geometric distribution of the HNSW paper, with the normalization factor 1/ln(M)
+        rng = np.random.default_rng( seed )
+        levels = np.floor( -np.log( 1 - rng.random( num_docs ) ) / np.log( M ) ).astype( np.int32 )
+        upper_offsets = np.cumsum( levels ) - levels
+        upper_offsets[ levels == 0 ] = -1
+        neighbors0 = np.full( ( num_docs, 2 * M ), -1, dtype = np.int32 )
+        upper_neighbors = np.full( ( int( levels.sum() ), M ), -1, dtype = np.int32 )
+        entry_point, max_level = 0, 0
+        if num_docs > 0:
+            entry_point, max_level = _build_graph( vectors, levels, neighbors0, upper_offsets.astype( np.int64 ), upper_neighbors, M, ef_construction, num_threads )
+        return cls( vectors, levels, neighbors0, upper_offsets.astype( np.int64 ), upper_neighbors,
+                    { "entry_point":int( entry_point ), "max_level":int( max_level ), "M":M, "ef_construction":ef_construction } )
+
+    def search( self, query_embedding, n, ef_search = HNSW_EF_SEARCH, allowed_mask = None ):
+        """
+            query_embedding: ( 1, vector_dim ) or ( vector_dim, ); allowed_mask: boolean mask of the allowed positions (None: all of them).
+            Return ( positions, similarities ) of at most n nodes, sorted by decreasing similarity
+        """
+        query_embedding = np.ascontiguousarray( np.asarray( query_embedding, dtype = np.float32 ).reshape( -1 ) )
+        if self.vectors.shape[0] == 0 or n <= 0:
+            return np.zeros( 0, dtype = np.int64 ), np.zeros( 0, dtype = np.float32 )
+        use_mask = allowed_mask is not None
+        visited, tag = self.get_visited()
+        sims, nodes = _search( query_embedding, int(n), int(ef_search), self.header["entry_point"], self.header["max_level"],
+                               self.vectors, self.neighbors0, self.upper_offsets, self.upper_neighbors,
+                               allowed_mask if use_mask else np.zeros( 1, dtype = np.bool_ ), use_mask, visited, tag )
+        return nodes, sims
+
+    def get_visited( self ):
+        ## ( visited buffer of this thread, tag of the new search ): the buffer is reused, each search marks its nodes with a new tag,
+        ## and it is only cleared when the tags run out
+        state = getattr( self.thread_state, "visited", None )
+        if state is None or state[1] == np.iinfo( np.int32 ).max:
+            state = [ np.zeros( self.vectors.shape[0], dtype = np.int32 ), 0 ]
+            self.thread_state.visited = state
+        state[1] += 1
+        return state[0], state[1]
+
+
+def load_hnsw_index( folder, vectors, fingerprint ):
+    ## the graph serialized in folder, memory-mapped; None if there is none or if it was built for other embeddings or parameters
+    if fingerprint is None or not os.path.exists( folder + "/fingerprint.json" ):
+        return None
+    try:
+        with open( folder + "/fingerprint.json", "r" ) as f:
+            if json.load( f ) != fingerprint:
+                print("The serialized HNSW index in %s is outdated"%( folder ))
+                return None
+        with open( folder + "/header.json", "r" ) as f:
+            header = json.load( f )
+        return HNSWIndex( vectors, np.load( folder + "/levels.npy", mmap_mode = "r" ),
+                                   np.load( folder + "/neighbors0.npy", mmap_mode = "r" ),
+                                   np.load( folder + "/upper_offsets.npy", mmap_mode = "r" ),
+                                   np.load( folder + "/upper_neighbors.npy", mmap_mode = "r" ), header )
+    except:
+        print("Warning: failed to load the serialized HNSW index in %s"%( folder ))
+        return None
+
+def save_hnsw_index( index, folder, fingerprint ):
+    ## write into a temporary folder first, the fingerprint is written last, so a partially written graph is never loaded
+    if fingerprint is None:
+        return
+    tmp_folder = folder + ".tmp"
+    try:
+        shutil.rmtree( tmp_folder, ignore_errors = True )
+        os.makedirs( tmp_folder )
+        np.save( tmp_folder + "/levels.npy", index.levels )
+        np.save( tmp_folder + "/neighbors0.npy", index.neighbors0 )
+        np.save( tmp_folder + "/upper_offsets.npy", index.upper_offsets )
+        np.save( tmp_folder + "/upper_neighbors.npy", index.upper_neighbors )
+        with open( tmp_folder + "/header.json", "w" ) as f:
+            json.dump( index.header, f )
+        with open( tmp_folder + "/fingerprint.json", "w" ) as f:
+            json.dump( fingerprint, f )
+        shutil.rmtree( folder, ignore_errors = True )
+        os.replace( tmp_folder, folder )
+    except:
+        print("Warning: failed to serialize the HNSW index into %s"%( folder ))
+        shutil.rmtree( tmp_folder, ignore_errors = True )
@@ -328,20 +328,17 @@ class BFIndexIPGPU:
         return embeddings
 
 
-    ## Here the query_embedding has two dimensions, but there is only one vectors due to the limitation of current implementation
+    ## query_embedding has the shape [number_of_queries, dim], return the similarities of shape [number_of_queries, number_of_vectors]
     def dp( self, embeddings, query_embedding,  precision, device_id ):
-        if precision == "bool":
-            product = self.dp_pool[device_id]["bool"].dot( embeddings, query_embedding[0] )
-        elif precision == "int4":
-            product = self.dp_pool[device_id]["int4"].dot( embeddings, query_embedding[0] )
-        elif precision == "int8":
-            product = self.dp_pool[device_id]["int8"].dot( embeddings, query_embedding[0] )
+        if precision in [ "bool", "int4", "int8" ]:
+            ## the low precision kernels take a single query vector
+            return cp.stack( [ self.dp_pool[device_id][precision].dot( embeddings, query_embedding[i] ) for i in range( query_embedding.shape[0] ) ], axis = 0 )
         else:
-            product = cp.dot(embeddings, query_embedding[0]  )
-        return product[cp.newaxis,:]
+            ## float32: all the queries in one matmul
+            return cp.dot( query_embedding, embeddings.T )
         
 
-    ## Here the query_embedding has two dimensions, but there is only one vectors due to the limitation of current implementation
+    ## query_embedding has the shape [number_of_queries, dim], all the queries share the same indices_range
     def gpu_ranking_kernel( self, query_embedding, embeddings, n, device_id, indices_range= None):
         if indices_range is None:
             ### Here the distances are actually similarity, as we rank according to rge descending order of the similarity
@@ -366,13 +363,14 @@ class BFIndexIPGPU:
                 D = cp.array([]).reshape( query_embedding.shape[0], 0 )
         return I, D
     
-    ## Here the query_embedding has two dimensions, but there is only one vectors due to the limitation of current implementation
+    ## query_embedding has the shape [number_of_queries, dim], all the queries share the same indices_range
     def search(self, query_embedding, n, indices_range = None, requires_precision_conversion = True ):     
-        assert len(query_embedding.shape)==2 and query_embedding.shape[0] == 1
+        assert len(query_embedding.shape)==2
         
         query_embedding_list = []
         if requires_precision_conversion:
-            query_embedding = self.convert_precision( query_embedding, self.internal_precision)
+            ## each query is quantized with its own scale, like when it is searched alone
+            query_embedding = np.concatenate( [ self.convert_precision( query_embedding[i:i+1], self.internal_precision) for i in range( query_embedding.shape[0] ) ], axis = 0 )
         
         with Device( self.gpu_list[0] ):
             query_embedding = cp.asarray( query_embedding )
@@ -4,25 +4,111 @@ import os,sys,inspect
 # sys.path.insert(0, parent_dir)
 # sys.path.insert(0, current_dir)  
 import numpy as np
-try:
-    import pickle5 as pickle
-except:
-    import pickle
 
 import GPUtil
 
 ## cupy library can only be used when GPUs are available
 if GPUtil.getGPUs():
     from .nearest_neighbor_search.modules import BFIndexIP
+from .nearest_neighbor_search.cpu_modules import BFIndexIPInt8CPU, BFIndexIPBoolCPU
+from .nearest_neighbor_search.hnsw import load_hnsw_index, HNSW_INDEX_FOLDER, HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_SEARCH
 
-import multiprocessing, threading
+import multiprocessing, threading, queue
+import json, shutil
 from multiprocessing import Process,JoinableQueue, Pipe
 import sent2vec
 from modules.tokenizer.tokenizer import SentenceTokenizer
+from modules.ranking.embedding_index import EmbeddingIndexShard
+from modules.ranking.shared_memory import SharedRingBuffer, SharedMemoryReader, RING_BUFFER_SIZE, RESULT_BUFFER_SIZE
 
 import time
 import scann
 
+## parameters of the ScaNN searcher of each shard (CPU)
+SCANN_PARAMS = {
+    "num_neighbors":10,
+    "distance_measure":"dot_product",
+    "max_num_leaves":2000,
+    "num_leaves_to_search":100,
+    "training_sample_size":250000,
+    "dimensions_per_block":2,
+    "anisotropic_quantization_threshold":0.2,
+    "reordering_num_neighbors":100
+}
+## the trained ScaNN searcher is serialized into this subfolder of the embedding index shard
+SCANN_SEARCHER_FOLDER = "scann_searcher"
+## filtered search: the number of ScaNN neighbors is widened up to this budget before falling back to an exact search of the allowed documents
+MAX_FILTERED_SEARCH_NEIGHBORS = 10000
+## adaptive search: the ScaNN search of a shard stops widening once a query has spent this time (in milliseconds, None: no limit)
+SEARCH_LATENCY_BUDGET_MS = 200
+## the Ranker collects the queries of concurrent requests for up to this time (in milliseconds), and sends at most this many queries to the shards at once
+BATCH_WINDOW_MS = 2
+MAX_BATCH_SIZE = 64
+## at most this many batches wait to be sent to a shard process (the scheduler blocks beyond), and at most this many are processed by it at a time
+MAX_QUEUED_BATCHES = 16
+MAX_IN_FLIGHT_BATCHES = 4
+## the exact search scores the allowed documents in chunks of this many rows, so that the copied rows stay small
+EXACT_SEARCH_CHUNK_SIZE = 65536
+## on CPU, these internal precisions select a brute-force search on compact codes with float re-scoring instead of ScaNN
+CPU_QUANTIZED_INDICES = {
+    "int8":BFIndexIPInt8CPU,
+    "bool":BFIndexIPBoolCPU
+}
+
+def build_scann_searcher( doc_embeddings ):
+    # use scann.scann_ops.build() to instead create a TensorFlow-compatible searcher
+    return scann.scann_ops_pybind.builder( doc_embeddings, SCANN_PARAMS["num_neighbors"], SCANN_PARAMS["distance_measure"] ).tree(
+                num_leaves = min( SCANN_PARAMS["max_num_leaves"], doc_embeddings.shape[0] ), num_leaves_to_search = SCANN_PARAMS["num_leaves_to_search"],
+                training_sample_size = SCANN_PARAMS["training_sample_size"] ).score_ah(
+                SCANN_PARAMS["dimensions_per_block"], anisotropic_quantization_threshold = SCANN_PARAMS["anisotropic_quantization_threshold"] ).reorder(
+                SCANN_PARAMS["reordering_num_neighbors"] ).build()
+
+def get_scann_searcher_fingerprint( embedding_index, normalized ):
+    ## a serialized searcher is only valid for the same embeddings, the same normalization and the same ScaNN parameters;
+    ## None if the shard has no fingerprint (legacy format), then the searcher is not persisted
+    if embedding_index.fingerprint is None:
+        return None
+    return { "embedding_fingerprint":embedding_index.fingerprint, "normalized":bool(normalized), "scann_params":SCANN_PARAMS }
+
+def get_hnsw_index_fingerprint( embedding_index, normalized, M, ef_construction ):
+    ## same as get_scann_searcher_fingerprint(), for the HNSW graph of a shard
+    if embedding_index.fingerprint is None:
+        return None
+    return { "embedding_fingerprint":embedding_index.fingerprint, "normalized":bool(normalized), "M":int(M), "ef_construction":int(ef_construction) }
+
+def load_scann_searcher( embedding_path, fingerprint ):
+    ## the searcher serialized next to the shard, None if there is none or if it was built for other embeddings or parameters
+    searcher_folder = embedding_path + "/" + SCANN_SEARCHER_FOLDER
+    if fingerprint is None or not os.path.exists( searcher_folder + "/fingerprint.json" ):
+        return None
+    try:
+        with open( searcher_folder + "/fingerprint.json", "r" ) as f:
+            if json.load( f ) != fingerprint:
+                print("The serialized ScaNN searcher of %s is outdated"%( embedding_path ))
+                return None
+        return scann.scann_ops_pybind.load_searcher( searcher_folder )
+    except:
+        print("Warning: failed to load the serialized ScaNN searcher of %s"%( embedding_path ))
+        return None
+
+def save_scann_searcher( searcher, embedding_path, fingerprint ):
+    ## serialize into a temporary folder first, the fingerprint is written last, so a partially written searcher is never loaded
+    if fingerprint is None:
+        return
+    searcher_folder = embedding_path + "/" + SCANN_SEARCHER_FOLDER
+    tmp_folder = searcher_folder + ".tmp"
+    try:
+        shutil.rmtree( tmp_folder, ignore_errors = True )
+        os.makedirs( tmp_folder )
+        searcher.serialize( tmp_folder )
+        with open( tmp_folder + "/fingerprint.json", "w" ) as f:
+            json.dump( fingerprint, f )
+        shutil.rmtree( searcher_folder, ignore_errors = True )
+        os.replace( tmp_folder, searcher_folder )
+    except:
+        print("Warning: failed to serialize the ScaNN searcher of %s"%( embedding_path ))
+        shutil.rmtree( tmp_folder, ignore_errors = True )
+
 class Sent2vecEncoder:
     def __init__( self, model_path ):
         self.model = sent2vec.Sent2vecModel()
@@ -53,35 +139,78 @@ class BaseRanker:
                     requires_precision_conversion = True,
                     num_threads = 1,
                     normalize_query_embedding = True,
+                    max_filtered_search_neighbors = MAX_FILTERED_SEARCH_NEIGHBORS,
+                    final_num_neighbors = None,
+                    leaves_to_search = SCANN_PARAMS["num_leaves_to_search"],
+                    pre_reorder_num_neighbors = SCANN_PARAMS["reordering_num_neighbors"],
+                    adaptive_search = True,
+                    search_latency_budget_ms = SEARCH_LATENCY_BUDGET_MS,
+                    ann_backend = "scann",
+                    hnsw_m = HNSW_M,
+                    hnsw_ef_construction = HNSW_EF_CONSTRUCTION,
+                    hnsw_ef_search = HNSW_EF_SEARCH,
                     **kwargs
                 ):
+        self.max_filtered_search_neighbors = max_filtered_search_neighbors
+        ## default ScaNN search parameters of this shard, final_num_neighbors None: the n of the query
+        self.default_search_params = {
+            "final_num_neighbors":final_num_neighbors,
+            "leaves_to_search":leaves_to_search,
+            "pre_reorder_num_neighbors":pre_reorder_num_neighbors,
+            "adaptive":bool( adaptive_search ),
+            "latency_budget_ms":search_latency_budget_ms,
+            "ef_search":hnsw_ef_search
+        }
         print("loading embedding!",time.time())
-        with open(embedding_path, "rb") as f:
-            embedding_info = pickle.load(f)
+        ## the shard is memory-mapped, the embedding matrix is only read from disk (or from the page cache shared with the other processes) below
+        embedding_index = EmbeddingIndexShard( embedding_path )
         print("embeding loaded", time.time())
-        doc_embeddings = embedding_info["embedding_matrix"]
-        self.doc_id_to_pos_mapper = embedding_info["doc_id_to_pos_mapper"]
-        self.pos_to_doc_id_mapper = embedding_info["pos_to_doc_id_mapper"]
+        doc_embeddings = embedding_index.embedding_matrix
+        self.doc_id_to_pos_mapper = embedding_index.doc_id_to_pos_mapper
+        self.pos_to_doc_id_mapper = embedding_index.pos_to_doc_id_mapper
+        
+        ## check if GPU is available. If not, then overwrite the gpu_list to empty list [], and do not use BFIndexIP that replies on cupy
+        if not GPUtil.getGPUs():
+            gpu_list = []
+        ## on CPU, the int8 and bool precisions select the search on compact codes instead of ScaNN
+        is_quantized_on_cpu = len(gpu_list) == 0 and internal_precision in CPU_QUANTIZED_INDICES
         
         print("normalization....", time.time())
-        if requires_precision_conversion or internal_precision=="float32":
-            self.doc_embeddings = self.normalize_embeddings( doc_embeddings )
+        if is_quantized_on_cpu:
+            ## not loaded into memory, the quantized index normalizes the rows itself and only reads the rows it re-scores
+            self.doc_embeddings = doc_embeddings
+        elif ( requires_precision_conversion or internal_precision=="float32" ) and embedding_index.is_normalized and doc_embeddings.dtype == np.float32:
+            ## the rows are normalized on disk: the memory-mapped matrix is used as is, so the processes serving this shard share the page cache
+            self.doc_embeddings = doc_embeddings
+        elif requires_precision_conversion or internal_precision=="float32":
+            ## a float16 matrix (or a legacy shard) is converted to float32 and normalized here, for scann and for the precision conversion of BFIndexIP
+            self.doc_embeddings = self.normalize_embeddings( np.asarray( doc_embeddings, dtype = np.float32 ) )
         else:
             self.doc_embeddings = doc_embeddings
         
         print("Loading into the ranking module", time.time())
         
-        ## check if GPU is available. If not, then overwrite the gpu_list to empty list [], and do not use BFIndexIP that replies on cupy
-        if not GPUtil.getGPUs():
-            gpu_list = []
-        
-        if len(gpu_list) == 0:
-            # use scann.scann_ops.build() to instead create a TensorFlow-compatible searcher
-            # scann searcher can only return up to 100 approximate nearest neighbors        
-            self.searcher = scann.scann_ops_pybind.builder(self.doc_embeddings, 10, "dot_product").tree(
-                num_leaves = min(2000, self.doc_embeddings.shape[0]), num_leaves_to_search=100, training_sample_size=250000).score_ah(
-                2, anisotropic_quantization_threshold=0.2).reorder(100).build()
-        else:
+        ## the ScaNN searcher or the HNSW graph on CPU, or the brute-force index
+        self.searcher = None
+        self.hnsw_index = None
+        self.index_ip = None
+        if is_quantized_on_cpu:
+            self.index_ip = CPU_QUANTIZED_INDICES[ internal_precision ]( doc_embeddings, vector_dim, normalize = True, num_threads = num_threads )
+        elif len(gpu_list) == 0 and ann_backend == "hnsw":
+            ## load the graph saved next to the shard (memory-mapped) by build_hnsw_indices.py. It is not built here: building it takes far longer
+            ## than loading a shard, so without an up-to-date graph the shard is served by ScaNN below
+            fingerprint = get_hnsw_index_fingerprint( embedding_index, requires_precision_conversion or internal_precision=="float32", hnsw_m, hnsw_ef_construction )
+            self.hnsw_index = load_hnsw_index( embedding_path + "/" + HNSW_INDEX_FOLDER, self.doc_embeddings, fingerprint )
+            if self.hnsw_index is None:
+                print("Warning: no up-to-date HNSW index in %s, falling back to ScaNN"%( embedding_path ))
+        if self.index_ip is None and self.hnsw_index is None and len(gpu_list) == 0:
+            ## load the searcher trained by the build index service if it matches this shard, otherwise train it and keep it for the next start
+            fingerprint = get_scann_searcher_fingerprint( embedding_index, requires_precision_conversion or internal_precision=="float32" )
+            self.searcher = load_scann_searcher( embedding_path, fingerprint )
+            if self.searcher is None:
+                self.searcher = build_scann_searcher( self.doc_embeddings )
+                save_scann_searcher( self.searcher, embedding_path, fingerprint )
+        elif len(gpu_list) > 0:
             self.index_ip = BFIndexIP( self.doc_embeddings, vector_dim, gpu_list, internal_precision, requires_precision_conversion, num_threads )
         self.gpu_list = gpu_list
         
@@ -103,7 +232,118 @@ class BaseRanker:
         D = sims[I]
         return I, D
 
-    def get_top_n_given_embedding( self, n, query_embedding, indices_range = None ):
+    def get_allowed_mask( self, indices_range = None, packed_indices_range = None ):
+        ## boolean mask over the positions of this shard, from the allowed positions or from their packed bitmap (bitorder = "little")
+        allowed_mask = np.zeros( self.doc_embeddings.shape[0], dtype = bool )
+        if packed_indices_range is not None:
+            bits = np.unpackbits( packed_indices_range, bitorder = "little" )[ :len(allowed_mask) ]
+            allowed_mask[ :len(bits) ] = bits
+        else:
+            allowed_mask[ indices_range ] = True
+        return allowed_mask
+
+    def exact_search( self, n, query_embedding, candidate_indices ):
+        """
+            Exact top n of the candidate positions, scored in chunks of EXACT_SEARCH_CHUNK_SIZE rows, keeping only the best n after each chunk.
+            Return ( positions, similarities ), sorted by decreasing similarity.
+        """
+        top_n_indices = np.zeros( 0, dtype = np.int64 )
+        top_n_similarities = np.zeros( 0, dtype = np.float32 )
+        for pos in range( 0, len(candidate_indices), EXACT_SEARCH_CHUNK_SIZE ):
+            chunk_indices = candidate_indices[ pos:pos + EXACT_SEARCH_CHUNK_SIZE ]
+            sims = np.matmul( self.doc_embeddings[ chunk_indices ], query_embedding[0] ).astype( np.float32 )
+            top_n_indices = np.concatenate( [ top_n_indices, chunk_indices ] )
+            top_n_similarities = np.concatenate( [ top_n_similarities, sims ] )
+            if len(top_n_indices) > n:
+                best = np.argpartition( -top_n_similarities, n-1 )[:n]
+                top_n_indices, top_n_similarities = top_n_indices[best], top_n_similarities[best]
+        order = np.argsort( -top_n_similarities )
+        return top_n_indices[order], top_n_similarities[order]
+
+    def get_search_params( self, n, search_params = None ):
+        """
+            The ScaNN (or HNSW) search parameters of a query: the per-request search_params override the defaults of the shard.
+            search_params keys (all optional): "final_num_neighbors", "leaves_to_search", "pre_reorder_num_neighbors", "adaptive", "latency_budget_ms",
+            and "ef_search" for the HNSW graph
+        """
+        params = dict( self.default_search_params )
+        for key, value in ( search_params or {} ).items():
+            if key not in params:
+                continue
+            try:
+                params[key] = bool( value ) if key == "adaptive" else ( None if value is None else float( value ) )
+            except:
+                print("Warning: invalid search parameter %s: %s"%( key, str(value) ))
+        num_docs = self.doc_embeddings.shape[0]
+        num_leaves = min( SCANN_PARAMS["max_num_leaves"], num_docs )
+        ## by default n neighbors are retrieved, instead of the ScaNN default of SCANN_PARAMS["num_neighbors"]
+        params["final_num_neighbors"] = min( max( int( params["final_num_neighbors"] if params["final_num_neighbors"] is not None else n ), 1 ), num_docs )
+        params["leaves_to_search"] = min( max( int( params["leaves_to_search"] ), 1 ), num_leaves )
+        ## ScaNN cannot return more neighbors than it reorders
+        params["pre_reorder_num_neighbors"] = max( int( params["pre_reorder_num_neighbors"] ), params["final_num_neighbors"] )
+        ## the HNSW candidate list holds at least n nodes
+        params["ef_search"] = max( int( params["ef_search"] if params["ef_search"] is not None else HNSW_EF_SEARCH ), n )
+        return params
+
+    def ann_search( self, n, query_embedding, params, allowed_mask = None, num_allowed = None ):
+        """
+            Top n of the allowed positions (allowed_mask None: all of them) with the ScaNN searcher, using the parameters of get_search_params().
+            In the adaptive mode, the search is widened until n neighbors are found, as long as params["latency_budget_ms"] is not exceeded:
+            more leaves if the searched leaves hold fewer documents than the requested neighbors, otherwise 4x neighbors and 2x leaves, 
+            up to max( max_filtered_search_neighbors, n ) neighbors.
+            Return ( positions, similarities, whether the latency budget was exceeded ), sorted by decreasing similarity.
+        """
+        tic = time.time()
+        num_docs = self.doc_embeddings.shape[0]
+        num_leaves = min( SCANN_PARAMS["max_num_leaves"], num_docs )
+        num_wanted = min( n, num_allowed if allowed_mask is not None else num_docs )
+        max_num_neighbors = min( max( self.max_filtered_search_neighbors, n, params["final_num_neighbors"] ), num_docs )
+        num_neighbors = params["final_num_neighbors"]
+        leaves_to_search = params["leaves_to_search"]
+        is_over_budget = False
+        while True:
+            top_n_indices, top_n_similarities = self.searcher.search_batched( query_embedding, final_num_neighbors = num_neighbors,
+                                                                              pre_reorder_num_neighbors = max( num_neighbors, params["pre_reorder_num_neighbors"] ),
+                                                                              leaves_to_search = leaves_to_search )
+            top_n_indices = top_n_indices[0].astype( np.int64 )
+            top_n_similarities = top_n_similarities[0]
+            is_valid = ( top_n_indices >= 0 ) & ( top_n_indices < num_docs ) & ~np.isnan( top_n_similarities )
+            top_n_indices, top_n_similarities = top_n_indices[is_valid], top_n_similarities[is_valid]
+            num_valid = len( top_n_indices )
+            if allowed_mask is not None:
+                is_allowed = allowed_mask[ top_n_indices ]
+                top_n_indices, top_n_similarities = top_n_indices[is_allowed], top_n_similarities[is_allowed]
+            
+            if len( top_n_indices ) >= num_wanted or not params["adaptive"]:
+                break
+            if params["latency_budget_ms"] is not None and ( time.time() - tic ) * 1000 >= params["latency_budget_ms"]:
+                is_over_budget = True
+                break
+            if num_valid < num_neighbors:
+                ## the searched leaves hold fewer documents than the requested neighbors
+                if leaves_to_search >= num_leaves:
+                    break
+                leaves_to_search = min( leaves_to_search * 2, num_leaves )
+            else:
+                if num_neighbors >= max_num_neighbors:
+                    break
+                num_neighbors = min( num_neighbors * 4, max_num_neighbors )
+                leaves_to_search = min( leaves_to_search * 2, num_leaves )
+        
+        return top_n_indices[:n], top_n_similarities[:n], is_over_budget
+
+    def get_top_n_given_embedding( self, n, query_embedding, indices_range = None, packed_indices_range = None, search_params = None ):
+        """
+            indices_range: the allowed positions (None: all of them); 
+            packed_indices_range: the allowed positions as a packed bitmap (np.packbits with bitorder = "little"), used instead of indices_range if given;
+            search_params: per-request ScaNN or HNSW search parameters (see get_search_params()), not used by the brute-force search
+            Return ( similarities, doc ids )
+        """
+        top_n_similarities, top_n_indices = self.get_top_n_positions_given_embedding( n, query_embedding, indices_range, packed_indices_range, search_params )
+        return top_n_similarities, [ self.pos_to_doc_id_mapper[idx] for idx in top_n_indices ]
+
+    def get_top_n_positions_given_embedding( self, n, query_embedding, indices_range = None, packed_indices_range = None, search_params = None ):
+        ## same as get_top_n_given_embedding(), but return ( similarities, positions ) in this shard
         
         assert len( query_embedding.shape ) <= 2
         if len( query_embedding.shape ) == 1:
@@ -112,60 +352,159 @@ class BaseRanker:
         if self.normalize_query_embedding:
             query_embedding = self.normalize_embeddings( query_embedding )
                 
-        if len( self.gpu_list ) == 0:
-            if indices_range is None:
-                top_n_indices, top_n_similarities = self.searcher.search_batched(query_embedding, final_num_neighbors = 100 )
-                top_n_similarities = top_n_similarities[0]
-                top_n_indices = top_n_indices[0]
-                
-                non_nan_indices = ~np.isnan( top_n_indices )
-                top_n_similarities = top_n_similarities[ non_nan_indices ][:n]
-                top_n_indices = top_n_indices[ non_nan_indices ][:n]
+        if self.hnsw_index is not None:
+            return self.hnsw_search( n, query_embedding, indices_range, packed_indices_range, search_params )
+        
+        if self.searcher is not None:
+            params = self.get_search_params( n, search_params )
+            if indices_range is None and packed_indices_range is None:
+                top_n_indices, top_n_similarities, _ = self.ann_search( n, query_embedding, params )
             
-            elif len(indices_range) == 0:
-                return np.array([]).astype(np.float32), []
             else:
-                if len(indices_range) < max( self.doc_embeddings.shape[0] * 0.01, 10000  ):
-                    doc_embeddings_subset = self.doc_embeddings[ indices_range ]
-                    I, D = self.bfnn( query_embedding, doc_embeddings_subset )    
-                    I = indices_range[I]
-                    top_n_similarities = D[:n]
-                    top_n_indices = I[:n]                    
-                else:                
-                    top_n_indices, top_n_similarities = self.searcher.search_batched(query_embedding, final_num_neighbors = 100 )
-                    top_n_similarities = top_n_similarities[0]
-                    top_n_indices = top_n_indices[0]
-                
-                    non_nan_indices = ~np.isnan( top_n_indices )
-                    top_n_similarities = top_n_similarities[ non_nan_indices ]
-                    top_n_indices = top_n_indices[ non_nan_indices ]
-                    
-                    intersect_indices = np.any( top_n_indices[:,np.newaxis] == indices_range[ np.newaxis,: ], axis =1)
-                    top_n_similarities = top_n_similarities[intersect_indices][:n]
-                    top_n_indices = top_n_indices[intersect_indices][:n]
+                allowed_mask = self.get_allowed_mask( indices_range, packed_indices_range )
+                num_allowed = int( allowed_mask.sum() )
+                if num_allowed == 0:
+                    return np.array([]).astype(np.float32), np.array([]).astype(np.int64)
+                if num_allowed < max( self.doc_embeddings.shape[0] * 0.01, 10000  ):
+                    top_n_indices, top_n_similarities = self.exact_search( n, query_embedding, np.flatnonzero( allowed_mask ) )
+                else:
+                    ## start with the number of neighbors of which about n are expected to be allowed, with some margin
+                    if search_params is None or search_params.get( "final_num_neighbors", None ) is None:
+                        params["final_num_neighbors"] = min( max( int( 1.5 * n * self.doc_embeddings.shape[0] / num_allowed ), SCANN_PARAMS["reordering_num_neighbors"] ), 
+                                                             max( self.max_filtered_search_neighbors, n ), self.doc_embeddings.shape[0] )
+                    top_n_indices, top_n_similarities, is_over_budget = self.ann_search( n, query_embedding, params, allowed_mask, num_allowed )
+                    ## too few of the neighbors are allowed: search the allowed documents exactly, unless the latency budget is already spent
+                    if len( top_n_indices ) < min( n, num_allowed ) and not is_over_budget:
+                        top_n_indices, top_n_similarities = self.exact_search( n, query_embedding, np.flatnonzero( allowed_mask ) )
                             
-            return top_n_similarities.astype(np.float32), [ self.pos_to_doc_id_mapper[idx] for idx in top_n_indices ]
+            return top_n_similarities.astype(np.float32), top_n_indices.astype(np.int64)
         
         else:
+            if packed_indices_range is not None:
+                indices_range = np.argwhere( np.unpackbits( packed_indices_range, bitorder = "little" ) )[:,0]
             top_n_similarities, top_n_indices = self.index_ip.search( query_embedding , n, indices_range )
             top_n_similarities = top_n_similarities[0]
             top_n_indices = top_n_indices[0]
             
-            return top_n_similarities.astype(np.float32), [ self.pos_to_doc_id_mapper[idx] for idx in top_n_indices ]
+            return top_n_similarities.astype(np.float32), top_n_indices.astype(np.int64)
             
     
+    def hnsw_search( self, n, query_embedding, indices_range = None, packed_indices_range = None, search_params = None ):
+        """
+            get_top_n_positions_given_embedding() on the HNSW graph: a filtered query traverses the graph skipping the non-allowed nodes,
+            few allowed documents (or too few allowed results) are searched exactly, like with ScaNN
+        """
+        params = self.get_search_params( n, search_params )
+        if indices_range is None and packed_indices_range is None:
+            top_n_indices, top_n_similarities = self.hnsw_index.search( query_embedding, n, params["ef_search"] )
+        else:
+            allowed_mask = self.get_allowed_mask( indices_range, packed_indices_range )
+            num_allowed = int( allowed_mask.sum() )
+            if num_allowed == 0:
+                return np.array([]).astype(np.float32), np.array([]).astype(np.int64)
+            if num_allowed < max( self.doc_embeddings.shape[0] * 0.01, 10000  ):
+                top_n_indices, top_n_similarities = self.exact_search( n, query_embedding, np.flatnonzero( allowed_mask ) )
+            else:
+                top_n_indices, top_n_similarities = self.hnsw_index.search( query_embedding, n, params["ef_search"], allowed_mask )
+                if len( top_n_indices ) < min( n, num_allowed ):
+                    top_n_indices, top_n_similarities = self.exact_search( n, query_embedding, np.flatnonzero( allowed_mask ) )
+        return top_n_similarities.astype(np.float32), top_n_indices.astype(np.int64)
+
+    def get_top_n_given_embeddings( self, queries ):
+        """
+            Batched get_top_n_positions_given_embedding(): queries is a list of its keyword arguments, 
+            the results ( similarities, positions ) are returned in the same order.
+            On CPU the unfiltered queries with the same search parameters are stacked into one matrix and searched with a single search_batched() call,
+            with the int8 or bool index all the unfiltered queries are searched in one scan of the codes, and on GPU in one ( B, dim ) matmul;
+            the filtered queries, the ones that still miss results in the adaptive mode and all the queries on the HNSW graph are searched one by one.
+            A failed query gets an empty result instead of failing the whole batch.
+        """
+        results = [ None ] * len( queries )
+        if self.index_ip is not None:
+            self.get_top_n_given_embeddings_brute_force( queries, results )
+        
+        batches = {}
+        if self.searcher is not None:
+            for count, query in enumerate( queries ):
+                if query.get( "indices_range", None ) is not None or query.get( "packed_indices_range", None ) is not None:
+                    continue
+                try:
+                    params = self.get_search_params( query["n"], query.get( "search_params", None ) )
+                    query_embedding = np.asarray( query["query_embedding"] ).reshape( 1, -1 )
+                    if self.normalize_query_embedding:
+                        query_embedding = self.normalize_embeddings( query_embedding )
+                except:
+                    continue
+                batch_key = ( params["final_num_neighbors"], params["leaves_to_search"], params["pre_reorder_num_neighbors"] )
+                batches.setdefault( batch_key, [] ).append( ( count, query_embedding, params ) )
+
+        num_docs = self.doc_embeddings.shape[0]
+        for ( final_num_neighbors, leaves_to_search, pre_reorder_num_neighbors ), batch in batches.items():
+            try:
+                batch_indices, batch_similarities = self.searcher.search_batched( np.concatenate( [ query_embedding for _, query_embedding, _ in batch ], axis = 0 ),
+                                                                                  final_num_neighbors = final_num_neighbors,
+                                                                                  pre_reorder_num_neighbors = pre_reorder_num_neighbors,
+                                                                                  leaves_to_search = leaves_to_search )
+            except:
+                print("Warning: batched search failed, searching the queries one by one")
+                continue
+            for row, ( count, _, params ) in enumerate( batch ):
+                n = queries[count]["n"]
+                top_n_indices = batch_indices[row].astype( np.int64 )
+                top_n_similarities = batch_similarities[row]
+                is_valid = ( top_n_indices >= 0 ) & ( top_n_indices < num_docs ) & ~np.isnan( top_n_similarities )
+                top_n_indices, top_n_similarities = top_n_indices[is_valid][:n], top_n_similarities[is_valid][:n]
+                ## in the adaptive mode, a query that misses results is widened on its own below
+                if len( top_n_indices ) < min( n, num_docs ) and params["adaptive"]:
+                    continue
+                results[count] = ( top_n_similarities.astype(np.float32), top_n_indices )
+
+        for count, query in enumerate( queries ):
+            if results[count] is not None:
+                continue
+            try:
+                results[count] = self.get_top_n_positions_given_embedding( **query )
+            except:
+                print("Warning: query failed!")
+                results[count] = ( np.array([]).astype(np.float32), np.array([]).astype(np.int64) )
+        return results
+
+    def get_top_n_given_embeddings_brute_force( self, queries, results ):
+        ## the unfiltered queries of get_top_n_given_embeddings() on the int8 or bool index or on the GPU index, searched at once with the largest n of the batch
+        batch = []
+        for count, query in enumerate( queries ):
+            if query.get( "indices_range", None ) is not None or query.get( "packed_indices_range", None ) is not None:
+                continue
+            try:
+                query_embedding = np.asarray( query["query_embedding"] ).reshape( 1, -1 )
+                if self.normalize_query_embedding:
+                    query_embedding = self.normalize_embeddings( query_embedding )
+            except:
+                continue
+            batch.append( ( count, query_embedding ) )
+        if len( batch ) == 0:
+            return
+        try:
+            batch_similarities, batch_indices = self.index_ip.search( np.concatenate( [ query_embedding for _, query_embedding in batch ], axis = 0 ),
+                                                                      max( queries[count]["n"] for count, _ in batch ) )
+        except:
+            print("Warning: batched search failed, searching the queries one by one")
+            return
+        for row, ( count, _ ) in enumerate( batch ):
+            n = queries[count]["n"]
+            results[count] = ( batch_similarities[row][:n].astype(np.float32), batch_indices[row][:n].astype(np.int64) )
+    
     def warmup( self ):
         self.get_top_n_given_embedding( 10, np.random.randn( self.vector_dim ).astype(np.float32) )
 
 
 class LocalIndexParser:
     def __init__( self, embedding_path ):
-        with open(embedding_path, "rb") as f:
-            embedding_info = pickle.load(f)
-        self.doc_id_to_pos_mapper = embedding_info["doc_id_to_pos_mapper"]
-        self.pos_to_doc_id_mapper = embedding_info["pos_to_doc_id_mapper"]
-        self.num_docs = embedding_info["embedding_matrix"].shape[0]
-        del embedding_info["embedding_matrix"]
+        ## only the id mappings are used, the embedding matrix of a memory-mapped shard is never read here
+        embedding_index = EmbeddingIndexShard( embedding_path )
+        self.doc_id_to_pos_mapper = embedding_index.doc_id_to_pos_mapper
+        self.pos_to_doc_id_mapper = embedding_index.pos_to_doc_id_mapper
+        self.num_docs = embedding_index.num_docs
         
         self.pre_converted_doc_id_info = {}
         for collection in self.doc_id_to_pos_mapper:
@@ -184,8 +523,10 @@ class LocalIndexParser:
                 "valid_doc_id_to_pos_mapper":valid_doc_id_to_pos_mapper
             }
         
-    def get_indices_range( self, keyword_filtering_results = None, doc_id_list = None ):
-        """ doc_id_list structure:
+    def get_indices_range( self, keyword_filtering_results = None, doc_id_list = None, is_packed = False ):
+        """ is_packed: the values of keyword_filtering_results are ( np.packbits of the bool array with bitorder = "little", length of the bool array ),
+            only the bytes of the doc id range of this shard are unpacked
+            doc_id_list structure:
             [ { "collection": "pubmed/arxiv/pmcoa",
                 "id_field": "id_int",
                 "id_value": 2000
@@ -207,7 +548,12 @@ class LocalIndexParser:
                 indices_mask = self.pre_converted_doc_id_info[collection]["indices_mask"]
                 valid_doc_id_to_pos_mapper = self.pre_converted_doc_id_info[collection]["valid_doc_id_to_pos_mapper"]
                 
-                k_filter = keyword_filtering_results[collection][min_idx:max_idx+1]
+                if is_packed:
+                    packed_filter, num_doc_ids = keyword_filtering_results[collection]
+                    k_filter = np.unpackbits( packed_filter[ min_idx//8 : max_idx//8+1 ], bitorder = "little" )[ min_idx%8 : min_idx%8 + max_idx-min_idx+1 ].astype(np.bool)
+                    k_filter = k_filter[ :max( num_doc_ids - min_idx, 0 ) ]
+                else:
+                    k_filter = keyword_filtering_results[collection][min_idx:max_idx+1]
                 if len(k_filter) < len(indices_mask):
                     k_filter = np.concatenate([k_filter, np.zeros( len(indices_mask)-len(k_filter) ).astype(np.bool)   ] )
                 k_filter = indices_mask & k_filter
@@ -239,16 +585,118 @@ class LocalIndexParser:
         return indices_range
 
 
+class ShardChannel:
+    """
+        The pipe to a shard process, shared by all the requests in flight. 
+        The batches wait in a bounded queue (submit() blocks when it is full), a sender thread sends them as long as 
+        fewer than max_in_flight_batches are waiting for their results, and a receiver thread hands each reply to on_results( context, results ).
+        If the shard process is gone, the batches still waiting get the results None.
+    """
+    def __init__( self, conn, on_results, max_queued_batches = MAX_QUEUED_BATCHES, max_in_flight_batches = MAX_IN_FLIGHT_BATCHES ):
+        self.conn = conn
+        self.on_results = on_results
+        self.batch_queue = queue.Queue( maxsize = max_queued_batches )
+        self.in_flight = threading.Semaphore( max_in_flight_batches )
+        ## batch id -> context, of the batches sent and not answered yet
+        self.pending_batches = {}
+        self.lock = threading.Lock()
+        self.is_closed = False
+        ## the results are read from the result buffer of the shard process
+        self.reader = SharedMemoryReader()
+        threading.Thread( target = self.send_loop, daemon = True ).start()
+        self.receiver = threading.Thread( target = self.receive_loop, daemon = True )
+        self.receiver.start()
+
+    def submit( self, batch_id, queries, context ):
+        self.batch_queue.put( ( batch_id, queries, context ) )
+
+    def close( self ):
+        ## the shard process stops after answering the batches submitted before
+        self.batch_queue.put( None )
+
+    def join( self, timeout = None ):
+        ## wait until the shard process has answered its batches and is gone (after close())
+        self.receiver.join( timeout )
+
+    def send_loop( self ):
+        while True:
+            item = self.batch_queue.get()
+            if item is None:
+                try:
+                    self.conn.send( None )
+                except:
+                    pass
+                break
+            batch_id, queries, context = item
+            self.in_flight.acquire()
+            with self.lock:
+                is_closed = self.is_closed
+                if not is_closed:
+                    self.pending_batches[ batch_id ] = context
+            if is_closed:
+                self.on_results( context, None )
+                continue
+            try:
+                self.conn.send( { "batch_id":batch_id, "queries":queries } )
+            except:
+                print("Warning: sending a batch to a shard process failed!")
+
+    def receive_loop( self ):
+        while True:
+            try:
+                reply = self.conn.recv()
+            except:
+                break
+            with self.lock:
+                context = self.pending_batches.pop( reply["batch_id"], None )
+            if context is not None:
+                self.on_results( context, [ ( request_id, self.reader.get( similarities ), self.reader.get( positions ) ) 
+                                            for request_id, similarities, positions in reply["results"] ] )
+            self.in_flight.release()
+        
+        with self.lock:
+            self.is_closed = True
+            pending_contexts = list( self.pending_batches.values() )
+            self.pending_batches = {}
+        for context in pending_contexts:
+            self.on_results( context, None )
+        ## unblock the sender, the batches it still gets are answered with None
+        for _ in range( len( pending_contexts ) + 1 ):
+            self.in_flight.release()
+        for name in list( self.reader.attached.keys() ):
+            self.reader.detach( name )
+
+
 class Ranker:
-    def __init__( self, base_ranker_para_list, num_of_processes_of_gpu = {} ):
+    def __init__( self, base_ranker_para_list, num_of_processes_of_gpu = {}, batch_window_ms = BATCH_WINDOW_MS, max_batch_size = MAX_BATCH_SIZE, 
+                        ring_buffer_size = RING_BUFFER_SIZE, max_queued_batches = MAX_QUEUED_BATCHES, max_in_flight_batches = MAX_IN_FLIGHT_BATCHES ):
         
         ## convert embedding path to absolute path
         for base_ranker_para in base_ranker_para_list:
             base_ranker_para["embedding_path"] = os.path.abspath( base_ranker_para["embedding_path"]  )
         
         rank_process_dict = {}
-        self.parsed_index = {}
         self.index_parser_dict = {}
+        ## the queries of concurrent requests are batched by a scheduler thread, started at the first query;
+        ## shard_lock keeps the shards from being attached/detached while a batch is being dispatched
+        self.batch_window_ms = batch_window_ms
+        self.max_batch_size = max_batch_size
+        self.request_queue = queue.Queue()
+        self.scheduler = None
+        self.scheduler_lock = threading.Lock()
+        self.shard_lock = threading.Lock()
+        ## the query vectors and keyword filters go to the shard processes through a shared ring buffer (created with the scheduler),
+        ## the results come back through the result buffer of each shard process; only the descriptors are sent through the pipes
+        self.ring_buffer_size = ring_buffer_size
+        self.ring_buffer = None
+        ## each shard process has its own channel, so the batches are pipelined independently on each shard;
+        ## the requests in flight are found by their request ids when the results of a shard come back
+        self.max_queued_batches = max_queued_batches
+        self.max_in_flight_batches = max_in_flight_batches
+        self.shard_channels = {}
+        self.pending_lock = threading.Lock()
+        self.num_requests = 0
+        self.num_batches = 0
         
 
         self.num_of_processes_of_gpu = num_of_processes_of_gpu
@@ -265,7 +713,8 @@ class Ranker:
                 self.num_of_processes_of_gpu[ n_processes_list[0][0] ] = self.num_of_processes_of_gpu.get(n_processes_list[0][0], 0 )+1
 
             query_q, res_q = Pipe()
-            rank_process = Process(target=self.base_rank, args=( res_q, base_ranker_para,))
+            ## the target is not a bound method, since the Ranker (with its locks and threads) cannot be pickled into the spawned process
+            rank_process = Process(target=Ranker.base_rank, args=( res_q, base_ranker_para, max_in_flight_batches ))
             
             rank_process.deamon = True
             if len(base_ranker_para.get("gpu_list", [])) >0:
@@ -302,24 +751,53 @@ class Ranker:
 
     def update_shards( self, updating_ranker ):
 
-        self.index_parser_dict.update( updating_ranker.index_parser_dict )
-        self.num_of_processes_of_gpu.update(updating_ranker.num_of_processes_of_gpu )
-        self.rank_process_dict.update( updating_ranker.rank_process_dict )
+        with self.shard_lock:
+            self.index_parser_dict.update( updating_ranker.index_parser_dict )
+            self.num_of_processes_of_gpu.update(updating_ranker.num_of_processes_of_gpu )
+            self.rank_process_dict.update( updating_ranker.rank_process_dict )
 
 
     def delete_shard( self, shard_id ):
 
-        if shard_id in self.rank_process_dict:
-            self.rank_process_dict[shard_id][0].send( None )            
-            gpu_id = self.rank_process_dict[shard_id][1]
-            if gpu_id is not None:
-                self.num_of_processes_of_gpu[gpu_id] = max(self.num_of_processes_of_gpu.get(gpu_id,0)-1,0)
-            del self.rank_process_dict[shard_id]
+        with self.shard_lock:
+            if shard_id in self.rank_process_dict:
+                if shard_id in self.shard_channels:
+                    ## after the batches already submitted to this shard
+                    self.shard_channels.pop( shard_id ).close()
+                else:
+                    self.rank_process_dict[shard_id][0].send( None )            
+                gpu_id = self.rank_process_dict[shard_id][1]
+                if gpu_id is not None:
+                    self.num_of_processes_of_gpu[gpu_id] = max(self.num_of_processes_of_gpu.get(gpu_id,0)-1,0)
+                del self.rank_process_dict[shard_id]
 
-        if shard_id in self.index_parser_dict:
-            del self.index_parser_dict[shard_id]
+            if shard_id in self.index_parser_dict:
+                del self.index_parser_dict[shard_id]
                 
            
+    def close( self ):
+        """
+            Stop the scheduler and the shard processes once the requests already queued are answered, then release the shared ring buffer
+        """
+        with self.scheduler_lock:
+            if self.scheduler is not None:
+                self.request_queue.put( None )
+                self.scheduler.join()
+                self.scheduler = None
+        with self.shard_lock:
+            shard_channels = list( self.shard_channels.values() )
+        for shard_id in list( self.rank_process_dict.keys() ):
+            self.delete_shard( shard_id )
+        ## the shard processes read the queries of their last batches from the ring buffer
+        for shard_channel in shard_channels:
+            shard_channel.join()
+        if self.ring_buffer is not None:
+            try:
+                self.ring_buffer.close()
+            except:
+                print("Warning: failed to release the shared ring buffer")
+            self.ring_buffer = None
+
     def assign_index_parser_dict( self, shard_id, embedding_path ):
         try:
             self.index_parser_dict[shard_id] = LocalIndexParser(embedding_path)
@@ -327,100 +805,217 @@ class Ranker:
             print("Error: LocalIndexParser initialization failed!")
             self.index_parser_dict[shard_id] = None
     
-    def parse_local_index( self, shard_id , keyword_filtering_results = None , doc_id_list = None  ):
-        if shard_id in self.index_parser_dict:
-            local_index = self.index_parser_dict[shard_id].get_indices_range( keyword_filtering_results  , doc_id_list )
-        else:
-            local_index = None
-
-        if local_index is None:
-            self.parsed_index[shard_id] = {"packed":False, "value": None}
-        else:
-            if shard_id in self.index_parser_dict and len(local_index) > int(self.index_parser_dict[shard_id].num_docs / 32):
-                bool_arr = np.zeros( np.max(local_index)+1 , dtype = np.uint8)
-                bool_arr[local_index] = 1
-                packed_local_index = np.packbits(bool_arr)
-                self.parsed_index[shard_id] = { "packed":True, "value":packed_local_index}
-            else:
-                self.parsed_index[shard_id] = {"packed":False, "value": local_index}
-                
-    
-    def base_rank(self, res_q, base_ranker_para ):
+    @staticmethod
+    def base_rank( res_q, base_ranker_para, max_in_flight_batches = MAX_IN_FLIGHT_BATCHES ):
         try:
             base_ranker = BaseRanker( **base_ranker_para )
+            ## the keyword filters are converted into the positions of this shard here, from the packed bitmaps shared by all the shard processes
+            index_parser = LocalIndexParser( base_ranker_para["embedding_path"] )
             print( "shard id: %s is waiting for response ..."%(str( base_ranker_para["shard_id"] )), flush = True )
             is_running = True
         except:
             print( "Error: shard id: %s initialization failed!"%(str( base_ranker_para["shard_id"] )), flush = True  )
             is_running = False
         
+        reader = SharedMemoryReader()
+        result_buffer = None
+        if is_running:
+            try:
+                ## the results of a batch are copied by the Ranker before it sends more than max_in_flight_batches newer batches
+                result_buffer = SharedRingBuffer( RESULT_BUFFER_SIZE, max_live_batches = max_in_flight_batches + 1 )
+            except:
+                print("Warning: shared memory is not available, the results are sent through the pipe")
+
         res_q.send( is_running )
         
         while is_running:
             
-            query = res_q.recv()
+            ## { "batch_id", "queries" }: a batch of queries from concurrent requests, each one with its "request_id"
+            batch = res_q.recv()
 
-            if query is None:
+            if batch is None:
                 break
             
-            indices_range = query["indices_range"]
-            if not indices_range["packed"]:
-                query["indices_range"] = indices_range["value"]
-            else:
-                query["indices_range"] = np.argwhere( np.unpackbits(indices_range["value"]))[:,0]
+            queries = batch["queries"]
+            request_ids = [ query.pop( "request_id" ) for query in queries ]
+            for query in queries:
+                query["query_embedding"] = np.array( reader.get( query["query_embedding"] ) )
+                keyword_filtering_results = query.pop( "keyword_filtering_results" )
+                if keyword_filtering_results is not None:
+                    keyword_filtering_results = { collection: ( reader.get( descriptor ), num_doc_ids ) 
+                                                  for collection, ( descriptor, num_doc_ids ) in keyword_filtering_results.items() }
+                try:
+                    query["indices_range"] = index_parser.get_indices_range( keyword_filtering_results, query.pop( "doc_id_list" ), is_packed = True )
+                except:
+                    print("Warning: parsing the keyword filter failed!")
+                    query["indices_range"] = np.array([]).astype(np.int64)
                     
-            rank_res = base_ranker.get_top_n_given_embedding( **query )
+            rank_res = base_ranker.get_top_n_given_embeddings( queries )
+
+            if result_buffer is not None:
+                result_buffer.begin_batch()
+                put = result_buffer.put
+            else:
+                put = lambda array: ( "array", array )
+            res_q.send( { "batch_id":batch["batch_id"], 
+                          "results":[ ( request_id, put( top_n_similarities ), put( top_n_indices ) ) 
+                                      for request_id, ( top_n_similarities, top_n_indices ) in zip( request_ids, rank_res ) ] } )
 
-            res_q.send( rank_res )
+        if result_buffer is not None:
+            result_buffer.close()
 
     
-    def get_top_n_given_embedding( self, n, query_embedding, keyword_filtering_results = None , doc_id_list = None, ranking_shard_id_list = None ):
+    def start_scheduler( self ):
+        with self.scheduler_lock:
+            if self.scheduler is None:
+                try:
+                    self.ring_buffer = SharedRingBuffer( self.ring_buffer_size )
+                except:
+                    print("Warning: shared memory is not available, the queries are sent through the pipes")
+                self.scheduler = threading.Thread( target = self.schedule, daemon = True )
+                self.scheduler.start()
 
+    def schedule( self ):
+        """
+            Collect the queries that arrive within batch_window_ms of the first one (at most max_batch_size of them),
+            and submit them to the shards as one batch; the scheduler does not wait for the results
+        """
+        is_running = True
+        while is_running:
+            ## None: stop after the requests queued before (see close())
+            rank_request = self.request_queue.get()
+            if rank_request is None:
+                break
+            batch = [ rank_request ]
+            deadline = time.time() + self.batch_window_ms / 1000
+            while len( batch ) < self.max_batch_size:
+                try:
+                    rank_request = self.request_queue.get( timeout = max( deadline - time.time(), 0 ) )
+                except queue.Empty:
+                    break
+                if rank_request is None:
+                    is_running = False
+                    break
+                batch.append( rank_request )
+            self.rank_batch( batch )
+
+    def rank_batch( self, batch ):
+        """
+            Submit to each shard the queries of the batch that search it. 
+            The query vectors and the keyword filters are written once into the ring buffer, whatever the number of shards reading them;
+            the space of the batch in the ring buffer is released once all these shards have answered.
+            The requests and the ring buffer batch count one pending answer more (this dispatch) until all the shards are submitted.
+        """
+        ring_batch = { "batch_id":None, "num_pending_shards":1 }
+        try:
+            with self.shard_lock:
+                if self.ring_buffer is not None:
+                    ring_batch["batch_id"] = self.ring_buffer.begin_batch()
+                    put = self.ring_buffer.put
+                else:
+                    put = lambda array: ( "array", array )
+
+                shard_queries = {}
+                for rank_request in batch:
+                    query = { "request_id":rank_request["request_id"],
+                              "n":rank_request["n"], 
+                              "query_embedding":put( np.asarray( rank_request["query_embedding"], dtype = np.float32 ) ), 
+                              "keyword_filtering_results":None,
+                              "doc_id_list":rank_request["doc_id_list"],
+                              "search_params":rank_request["search_params"] }
+                    if rank_request["packed_keyword_filtering_results"] is not None:
+                        query["keyword_filtering_results"] = { collection: ( put( packed_filter ), num_doc_ids ) 
+                                                               for collection, ( packed_filter, num_doc_ids ) in rank_request["packed_keyword_filtering_results"].items() }
+                    for shard_id in rank_request["ranking_shard_id_list"]:
+                        if self.rank_process_dict.get(shard_id,None) is not None:
+                            shard_queries.setdefault( shard_id, [] ).append( ( rank_request, query ) )
+
+                for shard_id in shard_queries:
+                    if shard_id not in self.shard_channels:
+                        self.shard_channels[shard_id] = ShardChannel( self.rank_process_dict[shard_id][0], self.collect_results, self.max_queued_batches, self.max_in_flight_batches )
+                    context = { "requests":{ rank_request["request_id"]:rank_request for rank_request, _ in shard_queries[shard_id] },
+                                "pos_to_doc_id_mapper":self.index_parser_dict[shard_id].pos_to_doc_id_mapper,
+                                "ring_batch":ring_batch }
+                    with self.pending_lock:
+                        for rank_request in context["requests"].values():
+                            rank_request["num_pending_shards"] += 1
+                        ring_batch["num_pending_shards"] += 1
+                        self.num_batches += 1
+                        batch_id = self.num_batches
+                    self.shard_channels[shard_id].submit( batch_id, [ query for _, query in shard_queries[shard_id] ], context )
+        except:
+            print("Error: submitting a batch of %d queries failed!"%( len(batch) ))
+        
+        ## the answer of this dispatch: the requests that were not submitted to any shard are done here
+        self.collect_results( { "requests":{ rank_request["request_id"]:rank_request for rank_request in batch }, "ring_batch":ring_batch }, None )
+
+    def collect_results( self, context, results ):
+        """
+            Called by the shard channels: hand the results of a shard to the requests of the batch, by their request ids (results None: the shard failed)
+        """
+        for request_id, similarities, positions in ( results or [] ):
+            rank_request = context["requests"].get( request_id, None )
+            if rank_request is not None:
+                ## copied, the shard process reuses its result buffer for the next batches
+                rank_request["res_list"].append( ( np.array( similarities ), np.array( positions ), context["pos_to_doc_id_mapper"] ) )
+
+        done_requests = []
+        with self.pending_lock:
+            for rank_request in context["requests"].values():
+                rank_request["num_pending_shards"] -= 1
+                if rank_request["num_pending_shards"] == 0:
+                    done_requests.append( rank_request )
+            context["ring_batch"]["num_pending_shards"] -= 1
+            is_ring_batch_done = context["ring_batch"]["num_pending_shards"] == 0
+        
+        if is_ring_batch_done and context["ring_batch"]["batch_id"] is not None:
+            self.ring_buffer.release_batch( context["ring_batch"]["batch_id"] )
+        for rank_request in done_requests:
+            rank_request["is_done"].set()
+    
+    def get_top_n_given_embedding( self, n, query_embedding, keyword_filtering_results = None , doc_id_list = None, ranking_shard_id_list = None, search_params = None ):
+        """
+            Thread-safe: the queries of concurrent calls are batched by the scheduler thread, and several batches are in flight on each shard
+        """
         if ranking_shard_id_list is None:
             ranking_shard_id_list = list(self.rank_process_dict.keys())
         else:
             ranking_shard_id_list = list(set(ranking_shard_id_list) & set(self.rank_process_dict.keys()))
 
-        tic = time.time()
-        threads = []
-        for shard_id in ranking_shard_id_list:
-            t = threading.Thread( target = self.parse_local_index, args = ( shard_id, keyword_filtering_results, doc_id_list )  )
-            threads.append(t)
-            t.start()
-        for t in threads:
-            t.join()
-        tac = time.time()
-        print("parsing time",tac-tic)
+        ## the keyword filter of each collection is either a bool array, packed here, or already packed by the inverted index ( packed bitmap, length ), shipped as is;
+        ## each shard process unpacks the doc id range of its shard (bitorder = "little")
+        if keyword_filtering_results is not None:
+            packed_keyword_filtering_results = { collection: keyword_filtering_results[collection] if isinstance( keyword_filtering_results[collection], tuple ) else
+                                                             ( np.packbits( np.asarray( keyword_filtering_results[collection], dtype = bool ), bitorder = "little" ), len( keyword_filtering_results[collection] ) )
+                                                 for collection in keyword_filtering_results }
+        else:
+            packed_keyword_filtering_results = None
         
         tic = time.time()
-        
-        for shard_id in ranking_shard_id_list:
-            if self.rank_process_dict.get(shard_id,None) is not None and self.parsed_index.get( shard_id, None ) is not None:
-                self.rank_process_dict[shard_id][0].send(  { "n":n, "query_embedding":query_embedding, "indices_range":self.parsed_index[shard_id] }  )   
-                
+        self.start_scheduler()
+        with self.pending_lock:
+            self.num_requests += 1
+            request_id = self.num_requests
+        rank_request = { "request_id":request_id, "n":n, "query_embedding":query_embedding, "packed_keyword_filtering_results":packed_keyword_filtering_results, 
+                         "doc_id_list":doc_id_list, "search_params":search_params, "ranking_shard_id_list":ranking_shard_id_list, 
+                         "num_pending_shards":1, "res_list":[], "is_done":threading.Event() }
+        self.request_queue.put( rank_request )
+        rank_request["is_done"].wait()
         tac = time.time()
-        print("sending query time",tac-tic)
+        print("ranking time",tac-tic)
 
-        self.parsed_index = {}
-        
-        res_list = []
-        for shard_id in ranking_shard_id_list:
-            if shard_id in self.rank_process_dict:
-                res_list.append(self.rank_process_dict[shard_id][0].recv())
+        res_list = rank_request["res_list"]
         
-        sim_list = []
-        doc_id_list = []
-        for res in res_list:
-            sim_list.append( res[0] )
-            doc_id_list += res[1]
-        if len(sim_list)>0:
-            sim_list = np.concatenate( sim_list )
+        ## the doc ids are only looked up for the top n of all the shards
+        if len(res_list)>0:
+            sim_list = np.concatenate( [ res[0] for res in res_list ] )
+            pos_list = np.concatenate( [ res[1] for res in res_list ] )
+            res_numbers = np.concatenate( [ np.full( len(res[0]), count ) for count, res in enumerate( res_list ) ] )
             top_n_indices = np.argsort( -sim_list )[:n]
         else:
-            sim_list = np.array([])
             top_n_indices = np.array([])
                     
-        return [ doc_id_list[idx] for idx in top_n_indices  ]
+        return [ res_list[ res_numbers[idx] ][2][ pos_list[idx] ] for idx in top_n_indices  ]
     
 class SentenceRanker:
     def __init__( self, model_path ):
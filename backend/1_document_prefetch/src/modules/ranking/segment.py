@@ -0,0 +1,1039 @@
+import os
+import json
+import heapq
+import mmap
+import numpy as np
+from numba import njit
+from modules.ranking.bloom import TermBloomFilter, get_term_digest, NUM_HASHES
+
+
+"""
+    Immutable on-disk inverted index segment.
+
+    File layout (all integers are little-endian):
+        magic (8 bytes) | header length (uint64) | header (json, utf-8) | sections ...
+    Every section starts at an 8-byte aligned offset. The offset, dtype and length of each section is recorded in the header,
+    so that the reader can map each section as a numpy array directly on top of the mmapped file (no copy, no unpickling).
+
+    Term dictionary:
+        Terms are sorted by their utf-8 bytes and front coded in blocks of "dict_block_size" terms.
+        The first term of a block is stored as varint(len) + bytes, the following terms as varint(shared_prefix_len) + varint(suffix_len) + suffix bytes.
+        "dict_block_offsets" points to the beginning of each block in "dict_bytes". The ordinal of a term is its position in the sorted term list.
+    Posting lists:
+        The (sorted) doc ids of a term are split into blocks of "posting_block_size" ids.
+        The first and the last doc id of each block are stored uncompressed in "block_first_ids" and "block_last_ids" (they work as a skip list),
+        the remaining doc ids of the block are stored as varint-encoded deltas in "postings".
+        The blocks of the term with ordinal t are term_block_starts[t] ... term_block_starts[t+1]-1.
+    Positions (optional, header field "has_positions"):
+        The token positions of a term in each document of its posting list, in the same order as the doc ids.
+        For each doc id, varint(number of positions) + the varint-encoded deltas of the sorted positions (the first one is stored as is).
+        "block_position_offsets" points to the positions of the first document of each posting block in "positions",
+        so that the positions of a document are found by decoding its posting block only. Terms indexed without positions have empty blocks.
+    Term frequencies (optional, header field "has_term_freqs"):
+        The number of occurrences of a term in each document of its posting list (capped at 255), one byte per posting in "term_freqs",
+        in the same order as the doc ids. The term frequencies of the term with ordinal t are term_tf_offsets[t] ... term_tf_offsets[t+1]-1,
+        "term_max_tfs" holds the largest one of each term. "doc_lengths" holds the number of tokens (capped at 65535) of each relative doc id,
+        and the header field "total_doc_length" their sum. They are the statistics needed for BM25 ranking.
+    Publication years (optional, header field "has_doc_years"):
+        "doc_years" holds the publication year of each relative doc id (0 if unknown). "year_doc_ids" holds the relative doc ids with a known year
+        sorted by year (and by doc id within a year), and year_offsets[y - min_year] the number of those documents published before the year y
+        (header field "min_year"), so that the documents of any year range are a contiguous slice of "year_doc_ids".
+    Term Bloom filter:
+        "term_bloom" holds a Bloom filter of all the terms (see modules/ranking/bloom.py, header field "bloom_num_hashes"),
+        so that the absent terms are rejected without reading the term dictionary. Segments written before it have no such section.
+    Name tokens:
+        The tokens of the author given names and family names (terms starting with one of NAME_FIELD_PREFIXES), as the sorted 64-bit hashes
+        "name_token_hashes" (see get_name_token_hash()), with "name_token_doc_freqs", the summed document frequencies of the name terms containing the token,
+        and "name_token_plain_doc_freqs", the document frequency of the token as a plain unigram. They are the statistics of the name gazetteer
+        of the query parser, collected while the terms are added. Segments written before them have no such sections.
+    Doc ids:
+        A segment covers the doc ids starting at "base_doc_id" (header field, 0 by default). The postings and "packed_doc_ids"
+        are relative to it, so that a segment of a high doc id range does not carry a zero-padded bitmap of all the lower doc ids.
+"""
+
+SEGMENT_MAGIC = b"SCLTSEG1"
+SEGMENT_VERSION = 1
+
+DICT_BLOCK_SIZE = 16
+POSTING_BLOCK_SIZE = 128
+
+SECTION_DTYPES = {
+    "packed_doc_ids":"uint8",
+    "dict_bytes":"uint8",
+    "dict_block_offsets":"uint64",
+    "doc_freqs":"uint32",
+    "term_block_starts":"uint64",
+    "block_first_ids":"uint32",
+    "block_last_ids":"uint32",
+    "block_byte_offsets":"uint64",
+    "postings":"uint8",
+    "block_position_offsets":"uint64",
+    "positions":"uint8",
+    "term_tf_offsets":"uint64",
+    "term_freqs":"uint8",
+    "term_max_tfs":"uint8",
+    "doc_lengths":"uint16",
+    "doc_years":"uint16",
+    "year_doc_ids":"uint32",
+    "year_offsets":"uint64",
+    "term_bloom":"uint8",
+    "name_token_hashes":"uint64",
+    "name_token_doc_freqs":"uint64",
+    "name_token_plain_doc_freqs":"uint64",
+}
+## sections that are only written when the segment has positions
+POSITION_SECTIONS = [ "block_position_offsets", "positions" ]
+## sections that are only written when the segment has term frequencies
+TERM_FREQ_SECTIONS = [ "term_tf_offsets", "term_freqs", "term_max_tfs", "doc_lengths" ]
+## sections that are only written when the publication years of the documents are given
+YEAR_SECTIONS = [ "doc_years", "year_doc_ids", "year_offsets" ]
+MAX_TERM_FREQ = 255
+MAX_DOC_LENGTH = 65535
+MAX_DOC_YEAR = 65535
+## sections that are computed in close(), like "term_bloom"
+NAME_TOKEN_SECTIONS = [ "name_token_hashes", "name_token_doc_freqs", "name_token_plain_doc_freqs" ]
+## the fields of the author name tokens of the name gazetteer
+NAME_FIELD_PREFIXES = [ "author.givenname:", "author.familyname:" ]
+## rows of ( hash, plain document frequency ) of the unigrams matched against the name tokens at once in close()
+NAME_TOKEN_MATCH_CHUNK_SIZE = 4194304
+
+
+def get_name_token_hash( token ):
+    ## the first 8 bytes of the term digest as a little-endian uint64, stable across processes (unlike the builtin hash)
+    return int.from_bytes( get_term_digest( token )[:8], "little" )
+
+
+def is_segment_file( path ):
+    try:
+        with open( path, "rb" ) as f:
+            return f.read( len(SEGMENT_MAGIC) ) == SEGMENT_MAGIC
+    except:
+        return False
+
+
+@njit( nogil = True )
+def _read_varint( buf, pos ):
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= ( np.int64(byte) & 127 ) << shift
+        if byte < 128:
+            break
+        shift += 7
+    return value, pos
+
+@njit( nogil = True )
+def _compare_bytes( a, a_len, b ):
+    ## lexicographic comparison of a[:a_len] and b, returns -1, 0 or 1
+    n = min( a_len, len(b) )
+    for i in range(n):
+        if a[i] < b[i]:
+            return -1
+        if a[i] > b[i]:
+            return 1
+    if a_len < len(b):
+        return -1
+    if a_len > len(b):
+        return 1
+    return 0
+
+@njit( nogil = True )
+def _dict_lower_bound( dict_bytes, dict_block_offsets, num_terms, dict_block_size, query, buf ):
+    ## return the ordinal of the first term >= query, and whether that term is equal to query
+    num_blocks = len(dict_block_offsets) - 1
+    if num_blocks == 0:
+        return 0, False
+    ## binary search the last block whose head term is <= query
+    lo = 0
+    hi = num_blocks - 1
+    block = -1
+    while lo <= hi:
+        mid = ( lo + hi ) // 2
+        length, pos = _read_varint( dict_bytes, np.int64( dict_block_offsets[mid] ) )
+        if _compare_bytes( dict_bytes[pos:pos+length], length, query ) <= 0:
+            block = mid
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    if block < 0:
+        return 0, False
+
+    ## scan the terms inside the block
+    start_ordinal = block * dict_block_size
+    end_ordinal = min( start_ordinal + dict_block_size, num_terms )
+    pos = np.int64( dict_block_offsets[block] )
+    cur_len = 0
+    for ordinal in range( start_ordinal, end_ordinal ):
+        if ordinal == start_ordinal:
+            shared = 0
+            suffix_len, pos = _read_varint( dict_bytes, pos )
+        else:
+            shared, pos = _read_varint( dict_bytes, pos )
+            suffix_len, pos = _read_varint( dict_bytes, pos )
+        buf[shared:shared+suffix_len] = dict_bytes[pos:pos+suffix_len]
+        pos += suffix_len
+        cur_len = shared + suffix_len
+        c = _compare_bytes( buf, cur_len, query )
+        if c >= 0:
+            return ordinal, c == 0
+    return end_ordinal, False
+
+@njit( nogil = True )
+def _encode_postings( ids, block_size, out, first_ids, last_ids, byte_offsets, byte_start ):
+    ## ids must be sorted and unique; returns the number of bytes written to out
+    n = len(ids)
+    pos = 0
+    block = 0
+    for start in range( 0, n, block_size ):
+        end = min( start + block_size, n )
+        first_ids[block] = ids[start]
+        last_ids[block] = ids[end-1]
+        byte_offsets[block] = byte_start + pos
+        prev = np.int64( ids[start] )
+        for i in range( start + 1, end ):
+            cur = np.int64( ids[i] )
+            delta = cur - prev
+            prev = cur
+            while delta >= 128:
+                out[pos] = np.uint8( ( delta & 127 ) | 128 )
+                pos += 1
+                delta >>= 7
+            out[pos] = np.uint8( delta )
+            pos += 1
+        block += 1
+    return pos
+
+@njit( nogil = True )
+def _decode_blocks( postings, block_byte_offsets, block_first_ids, block_start, block_end, out ):
+    ## decode the posting blocks [block_start, block_end) into out, returns the number of decoded ids
+    k = 0
+    for block in range( block_start, block_end ):
+        cur = np.int64( block_first_ids[block] )
+        out[k] = cur
+        k += 1
+        pos = np.int64( block_byte_offsets[block] )
+        end = np.int64( block_byte_offsets[block+1] )
+        while pos < end:
+            delta, pos = _read_varint( postings, pos )
+            cur += delta
+            out[k] = cur
+            k += 1
+    return k
+
+@njit( nogil = True )
+def _decode_block_list( postings, block_byte_offsets, block_first_ids, blocks, out ):
+    ## decode the (sorted) posting blocks listed in blocks into out, returns the number of decoded ids
+    k = 0
+    for i in range( len(blocks) ):
+        k += _decode_blocks( postings, block_byte_offsets, block_first_ids, blocks[i], blocks[i] + 1, out[k:] )
+    return k
+
+
+@njit( nogil = True )
+def _write_varint( out, pos, value ):
+    while value >= 128:
+        out[pos] = np.uint8( ( value & 127 ) | 128 )
+        pos += 1
+        value >>= 7
+    out[pos] = np.uint8( value )
+    return pos + 1
+
+@njit( nogil = True )
+def _encode_positions( counts, flat_positions, block_size, out, block_offsets, byte_start ):
+    ## the counts[i] positions of the i-th doc id are the next values of flat_positions; returns the number of bytes written to out
+    pos = 0
+    k = 0
+    for i in range( len(counts) ):
+        if i % block_size == 0:
+            block_offsets[ i // block_size ] = byte_start + pos
+        pos = _write_varint( out, pos, counts[i] )
+        prev = np.int64(0)
+        for j in range( counts[i] ):
+            cur = np.int64( flat_positions[k] )
+            pos = _write_varint( out, pos, cur - prev )
+            prev = cur
+            k += 1
+    return pos
+
+@njit( nogil = True )
+def _decode_positions( positions, start, end, counts, flat_positions ):
+    ## decode the positions of consecutive documents in positions[start:end], returns the number of decoded positions
+    pos = np.int64( start )
+    i = 0
+    k = 0
+    while pos < end:
+        count, pos = _read_varint( positions, pos )
+        counts[i] = count
+        cur = np.int64(0)
+        for j in range( count ):
+            delta, pos = _read_varint( positions, pos )
+            cur += delta
+            flat_positions[k] = cur
+            k += 1
+        i += 1
+    return k
+
+@njit( nogil = True )
+def _gather_positions( postings, block_byte_offsets, block_first_ids, positions, block_position_offsets, blocks, candidate_ids,
+                       out_ids, out_counts, out_positions ):
+    """
+        Positions of the sorted candidate_ids in the posting blocks listed in blocks (sorted).
+        Returns the number of matched doc ids and the number of positions written to the output arrays.
+    """
+    n = 0
+    k = 0
+    c = 0
+    for i in range( len(blocks) ):
+        block = blocks[i]
+        pos = np.int64( block_byte_offsets[block] )
+        end = np.int64( block_byte_offsets[block+1] )
+        position_pos = np.int64( block_position_offsets[block] )
+        position_end = np.int64( block_position_offsets[block+1] )
+        cur = np.int64( block_first_ids[block] )
+        first = True
+        while True:
+            if not first:
+                if pos >= end:
+                    break
+                delta, pos = _read_varint( postings, pos )
+                cur += delta
+            first = False
+            count = 0
+            if position_pos < position_end:
+                count, position_pos = _read_varint( positions, position_pos )
+            while c < len(candidate_ids) and candidate_ids[c] < cur:
+                c += 1
+            if c < len(candidate_ids) and candidate_ids[c] == cur and count > 0:
+                out_ids[n] = cur
+                out_counts[n] = count
+                n += 1
+                value = np.int64(0)
+                for j in range( count ):
+                    delta, position_pos = _read_varint( positions, position_pos )
+                    value += delta
+                    out_positions[k] = value
+                    k += 1
+            else:
+                for j in range( count ):
+                    _, position_pos = _read_varint( positions, position_pos )
+    return n, k
+
+@njit( nogil = True )
+def _gather_term_freqs( postings, block_byte_offsets, block_first_ids, term_freqs, blocks, block_tf_starts, candidate_ids, out_ids, out_tfs ):
+    """
+        Term frequencies of the sorted candidate_ids in the posting blocks listed in blocks (sorted);
+        the term frequencies of blocks[i] start at term_freqs[ block_tf_starts[i] ]. Returns the number of matched doc ids.
+    """
+    n = 0
+    c = 0
+    for i in range( len(blocks) ):
+        block = blocks[i]
+        pos = np.int64( block_byte_offsets[block] )
+        end = np.int64( block_byte_offsets[block+1] )
+        tf_pos = np.int64( block_tf_starts[i] )
+        cur = np.int64( block_first_ids[block] )
+        first = True
+        while True:
+            if not first:
+                if pos >= end:
+                    break
+                delta, pos = _read_varint( postings, pos )
+                cur += delta
+                tf_pos += 1
+            first = False
+            while c < len(candidate_ids) and candidate_ids[c] < cur:
+                c += 1
+            if c < len(candidate_ids) and candidate_ids[c] == cur:
+                out_ids[n] = cur
+                out_tfs[n] = term_freqs[tf_pos]
+                n += 1
+    return n
+
+
+def slice_positions( positions, start, end ):
+    ## the positions ( counts, flat positions ) of the doc ids start ... end-1 of a posting list
+    counts, flat_positions = positions
+    offsets = np.concatenate( [ [0], np.cumsum( counts, dtype = np.int64 ) ] )
+    return counts[start:end], flat_positions[ offsets[start]:offsets[end] ]
+
+def slice_payloads( item, start, end ):
+    ## the item ( term, doc ids, positions or None, term frequencies or None ) restricted to the doc ids start ... end-1
+    term, doc_ids, positions, term_freqs = item
+    return ( term, doc_ids[start:end], 
+             slice_positions( positions, start, end ) if positions is not None else None, 
+             term_freqs[start:end] if term_freqs is not None else None )
+
+def merge_positional_postings( id_list, positions_list ):
+    """
+        Union of several posting lists with positions (None: the list has no positions).
+        A doc id that occurs in several lists keeps the positions of the first list.
+    """
+    counts = np.concatenate( [ positions[0] if positions is not None else np.zeros( len(ids), dtype = np.uint32 )
+                               for ids, positions in zip( id_list, positions_list ) ] ).astype( np.int64 )
+    flat_positions = np.concatenate( [ positions[1] for positions in positions_list if positions is not None ] + [ np.zeros( 0, dtype = np.uint32 ) ] )
+    offsets = np.cumsum( counts ) - counts
+    doc_ids, first = np.unique( np.concatenate( id_list ), return_index = True )
+    counts, offsets = counts[first], offsets[first]
+    ## index of every kept position in flat_positions
+    position_indices = np.repeat( offsets - ( np.cumsum( counts ) - counts ), counts ) + np.arange( counts.sum() )
+    return doc_ids.astype( np.uint32 ), ( counts.astype( np.uint32 ), flat_positions[ position_indices ].astype( np.uint32 ) )
+
+def merge_postings_with_payloads( items ):
+    """
+        Union of the posting lists of several items ( term, doc ids, positions or None, term frequencies or None ) of the same term.
+        A doc id that occurs in several lists keeps the positions and the term frequency of the first list;
+        missing term frequencies count as 1.
+    """
+    id_list = [ item[1] for item in items ]
+    positions_list = [ item[2] for item in items ]
+    term_freqs_list = [ item[3] for item in items ]
+    if all( positions is None for positions in positions_list ):
+        doc_ids, first = np.unique( np.concatenate( id_list ), return_index = True )
+        doc_ids, positions = doc_ids.astype( np.uint32 ), None
+    else:
+        doc_ids, positions = merge_positional_postings( id_list, positions_list )
+        _, first = np.unique( np.concatenate( id_list ), return_index = True )
+    if all( term_freqs is None for term_freqs in term_freqs_list ):
+        term_freqs = None
+    else:
+        term_freqs = np.concatenate( [ term_freqs if term_freqs is not None else np.ones( len(ids), dtype = np.uint8 )
+                                       for ids, term_freqs in zip( id_list, term_freqs_list ) ] ).astype( np.uint8 )[first]
+    return items[0][0], doc_ids, positions, term_freqs
+
+
+def merge_sorted_postings( *iterables ):
+    """
+        k-way merge of several iterables of ( term, sorted doc ids ), each sorted by term, into one iterable sorted by term.
+        Posting lists of the same term are unioned.
+        If the items are ( term, sorted doc ids, positions, term frequencies ) (see InvertedIndexSegment.items( with_payloads = True )),
+        the merged items carry the merged positions and term frequencies as well.
+    """
+    iterators = [ iter(it) for it in iterables ]
+    ## heap of ( term, iterable index, item ); the index breaks ties, so the doc ids are never compared
+    heap = []
+    for i, it in enumerate(iterators):
+        item = next( it, None )
+        if item is not None:
+            heap.append( ( item[0], i, item ) )
+    heapq.heapify( heap )
+    while len(heap) > 0:
+        term = heap[0][0]
+        items = []
+        while len(heap) > 0 and heap[0][0] == term:
+            _, i, item = heapq.heappop( heap )
+            items.append( item )
+            next_item = next( iterators[i], None )
+            if next_item is not None:
+                heapq.heappush( heap, ( next_item[0], i, next_item ) )
+        if len(items) == 1:
+            yield items[0]
+        elif len(items[0]) == 4:
+            yield merge_postings_with_payloads( items )
+        else:
+            yield term, np.unique( np.concatenate( [ item[1] for item in items ] ) ).astype(np.uint32)
+
+
+class InvertedIndexSegmentWriter:
+    """
+        Write a segment in one pass. Terms must be added in strictly increasing order.
+        Sections are streamed into temporary files and concatenated on close(), so that memory usage does not grow with the index size.
+    """
+    def __init__( self, path, collection, packed_doc_ids, dict_block_size = DICT_BLOCK_SIZE, posting_block_size = POSTING_BLOCK_SIZE, base_doc_id = 0, has_positions = False,
+                  has_term_freqs = False, doc_lengths = None, doc_years = None ):
+        """
+            packed_doc_ids and the doc ids passed to add() are relative to base_doc_id
+            has_positions: write the position sections, the positions of each term are passed to add()
+            has_term_freqs: write the term frequency sections, the term frequencies of each term are passed to add()
+            doc_lengths: the number of tokens of each document, indexed by the relative doc id (only used if has_term_freqs)
+            doc_years: the publication year of each document (0 if unknown), indexed by the relative doc id; None: no year sections
+        """
+        self.path = path
+        self.collection = collection
+        self.packed_doc_ids = np.asarray( packed_doc_ids, dtype = np.uint8 )
+        self.base_doc_id = int(base_doc_id)
+        self.dict_block_size = dict_block_size
+        self.posting_block_size = posting_block_size
+        self.has_positions = has_positions
+        self.has_term_freqs = has_term_freqs
+        self.has_doc_years = doc_years is not None
+        self.section_names = [ name for name in SECTION_DTYPES if ( has_positions or name not in POSITION_SECTIONS ) and
+                                                                  ( has_term_freqs or name not in TERM_FREQ_SECTIONS ) and
+                                                                  ( self.has_doc_years or name not in YEAR_SECTIONS ) ]
+        ## the sections that are known in advance are kept in memory, the others are streamed into temporary files
+        self.memory_sections = { "packed_doc_ids": self.packed_doc_ids }
+        if has_term_freqs:
+            self.memory_sections["doc_lengths"] = self.get_doc_column( doc_lengths, MAX_DOC_LENGTH )
+            self.total_doc_length = int( self.memory_sections["doc_lengths"].sum( dtype = np.int64 ) )
+        self.min_year = 0
+        if self.has_doc_years:
+            doc_years = self.get_doc_column( doc_years, MAX_DOC_YEAR )
+            year_doc_ids = np.flatnonzero( doc_years ).astype( np.uint32 )
+            years = doc_years[ year_doc_ids ]
+            ## a stable sort keeps the doc ids of the same year sorted
+            order = np.argsort( years, kind = "stable" )
+            year_doc_ids, years = year_doc_ids[order], years[order]
+            self.min_year = int( years[0] ) if len(years) > 0 else 0
+            max_year = int( years[-1] ) if len(years) > 0 else -1
+            self.memory_sections["doc_years"] = doc_years
+            self.memory_sections["year_doc_ids"] = year_doc_ids
+            self.memory_sections["year_offsets"] = np.searchsorted( years, np.arange( self.min_year, max_year + 2 ) ).astype( np.uint64 )
+
+        self.section_files = { name: open( self.get_section_path(name), "wb" ) for name in self.section_names if name not in self.memory_sections and name != "term_bloom" and name not in NAME_TOKEN_SECTIONS }
+        ## the size of the Bloom filter depends on the number of terms, so the digests of the terms are collected first
+        self.term_digest_file = open( self.get_section_path("term_digests"), "wb" )
+        ## the name tokens are counted in memory, the ( hash, doc freq ) of the unigrams are streamed and matched against them in close()
+        self.name_token_doc_freqs = {}
+        self.unigram_file = open( self.get_section_path("unigram_doc_freqs"), "wb" )
+        self.num_terms = 0
+        self.num_blocks = 0
+        self.num_dict_bytes = 0
+        self.num_posting_bytes = 0
+        self.num_position_bytes = 0
+        self.num_postings = 0
+        self.max_term_length = 0
+        self.prev_term = None
+
+        np.zeros( 1, dtype = np.uint64 ).tofile( self.section_files["term_block_starts"] )
+        if has_term_freqs:
+            np.zeros( 1, dtype = np.uint64 ).tofile( self.section_files["term_tf_offsets"] )
+        self.closed = False
+
+    def get_doc_column( self, values, max_value ):
+        ## a per document uint16 column of the doc ids covered by packed_doc_ids
+        column = np.zeros( len(self.packed_doc_ids) * 8, dtype = np.uint16 )
+        if values is not None:
+            values = np.clip( np.asarray( values )[ :len(column) ], 0, max_value )
+            column[ :len(values) ] = values
+        return column
+
+    def get_section_path( self, name ):
+        return self.path + ".tmp." + name
+
+    def encode_varint( self, value ):
+        out = bytearray()
+        while value >= 128:
+            out.append( ( value & 127 ) | 128 )
+            value >>= 7
+        out.append( value )
+        return out
+
+    def add( self, term, doc_ids, positions = None, term_freqs = None ):
+        """
+            positions: ( counts, flat positions ), the positions of the i-th doc id are the next counts[i] values of flat positions;
+                       None if the term has no positions
+            term_freqs: the number of occurrences of the term in each doc id; None if unknown (they count as 1)
+        """
+        term_bytes = term.encode("utf-8")
+        assert self.prev_term is None or term_bytes > self.prev_term, "Terms must be added in strictly increasing order!"
+        doc_ids = np.asarray( doc_ids, dtype = np.uint32 )
+        if len(doc_ids) == 0:
+            return
+
+        ## term dictionary
+        if self.num_terms % self.dict_block_size == 0:
+            np.array( [self.num_dict_bytes], dtype = np.uint64 ).tofile( self.section_files["dict_block_offsets"] )
+            encoded = self.encode_varint( len(term_bytes) ) + term_bytes
+        else:
+            shared = 0
+            max_shared = min( len(term_bytes), len(self.prev_term) )
+            while shared < max_shared and term_bytes[shared] == self.prev_term[shared]:
+                shared += 1
+            encoded = self.encode_varint( shared ) + self.encode_varint( len(term_bytes) - shared ) + term_bytes[shared:]
+        self.section_files["dict_bytes"].write( encoded )
+        term_digest = get_term_digest( term )
+        self.term_digest_file.write( term_digest )
+        self.add_name_token_stats( term, term_digest, len(doc_ids) )
+        self.num_dict_bytes += len(encoded)
+        self.max_term_length = max( self.max_term_length, len(term_bytes) )
+        self.prev_term = term_bytes
+
+        ## posting list
+        num_blocks = int(np.ceil( len(doc_ids) / self.posting_block_size ))
+        out = np.zeros( len(doc_ids) * 5, dtype = np.uint8 )
+        first_ids = np.zeros( num_blocks, dtype = np.uint32 )
+        last_ids = np.zeros( num_blocks, dtype = np.uint32 )
+        byte_offsets = np.zeros( num_blocks, dtype = np.uint64 )
+        num_bytes = _encode_postings( doc_ids, self.posting_block_size, out, first_ids, last_ids, byte_offsets, self.num_posting_bytes )
+
+        out[:num_bytes].tofile( self.section_files["postings"] )
+        first_ids.tofile( self.section_files["block_first_ids"] )
+        last_ids.tofile( self.section_files["block_last_ids"] )
+        byte_offsets.tofile( self.section_files["block_byte_offsets"] )
+        np.array( [len(doc_ids)], dtype = np.uint32 ).tofile( self.section_files["doc_freqs"] )
+
+        if self.has_positions:
+            position_offsets = np.full( num_blocks, self.num_position_bytes, dtype = np.uint64 )
+            if positions is not None:
+                counts = np.asarray( positions[0], dtype = np.int64 )
+                flat_positions = np.asarray( positions[1], dtype = np.int64 )
+                assert len(counts) == len(doc_ids)
+                position_out = np.zeros( ( len(counts) + len(flat_positions) ) * 5, dtype = np.uint8 )
+                num_position_bytes = _encode_positions( counts, flat_positions, self.posting_block_size, position_out, position_offsets, self.num_position_bytes )
+                position_out[:num_position_bytes].tofile( self.section_files["positions"] )
+                self.num_position_bytes += num_position_bytes
+            position_offsets.tofile( self.section_files["block_position_offsets"] )
+
+        if self.has_term_freqs:
+            if term_freqs is None:
+                term_freqs = np.ones( len(doc_ids), dtype = np.uint8 )
+            else:
+                assert len(term_freqs) == len(doc_ids)
+                term_freqs = np.clip( np.asarray( term_freqs ), 1, MAX_TERM_FREQ ).astype( np.uint8 )
+            term_freqs.tofile( self.section_files["term_freqs"] )
+            np.array( [ term_freqs.max() ], dtype = np.uint8 ).tofile( self.section_files["term_max_tfs"] )
+            self.num_postings += len(doc_ids)
+            np.array( [self.num_postings], dtype = np.uint64 ).tofile( self.section_files["term_tf_offsets"] )
+
+        self.num_posting_bytes += num_bytes
+        self.num_blocks += num_blocks
+        self.num_terms += 1
+        np.array( [self.num_blocks], dtype = np.uint64 ).tofile( self.section_files["term_block_starts"] )
+
+    def add_name_token_stats( self, term, term_digest, doc_freq ):
+        for field_prefix in NAME_FIELD_PREFIXES:
+            if term.startswith( field_prefix ):
+                for token in term[ len(field_prefix): ].split():
+                    self.name_token_doc_freqs[token] = self.name_token_doc_freqs.get( token, 0 ) + doc_freq
+                return
+        if ":" not in term and " " not in term:
+            self.unigram_file.write( term_digest[:8] + doc_freq.to_bytes( 8, "little" ) )
+
+    def get_name_token_sections( self ):
+        tokens = list( self.name_token_doc_freqs.keys() )
+        hashes = np.array( [ get_name_token_hash( token ) for token in tokens ], dtype = np.uint64 )
+        order = np.argsort( hashes )
+        hashes = hashes[order]
+        name_doc_freqs = np.array( [ self.name_token_doc_freqs[token] for token in tokens ], dtype = np.uint64 )[order]
+        plain_doc_freqs = np.zeros( len(hashes), dtype = np.uint64 )
+        if len(hashes) > 0:
+            with open( self.get_section_path("unigram_doc_freqs"), "rb" ) as f:
+                while True:
+                    rows = np.frombuffer( f.read( NAME_TOKEN_MATCH_CHUNK_SIZE * 16 ), dtype = "<u8" ).reshape( -1, 2 )
+                    if len(rows) == 0:
+                        break
+                    pos = np.minimum( np.searchsorted( hashes, rows[:,0] ), len(hashes) - 1 )
+                    matched = hashes[pos] == rows[:,0]
+                    np.add.at( plain_doc_freqs, pos[matched], rows[matched,1] )
+        return { "name_token_hashes":hashes, "name_token_doc_freqs":name_doc_freqs, "name_token_plain_doc_freqs":plain_doc_freqs }
+
+    def close( self ):
+        if self.closed:
+            return
+        self.closed = True
+
+        ## close the offset arrays with their end positions
+        np.array( [self.num_dict_bytes], dtype = np.uint64 ).tofile( self.section_files["dict_block_offsets"] )
+        np.array( [self.num_posting_bytes], dtype = np.uint64 ).tofile( self.section_files["block_byte_offsets"] )
+        if self.has_positions:
+            np.array( [self.num_position_bytes], dtype = np.uint64 ).tofile( self.section_files["block_position_offsets"] )
+        for name in self.section_files:
+            self.section_files[name].close()
+        self.term_digest_file.close()
+        with open( self.get_section_path("term_digests"), "rb" ) as f:
+            self.memory_sections["term_bloom"] = TermBloomFilter.from_digests( f.read(), num_hashes = NUM_HASHES ).bits
+        os.remove( self.get_section_path("term_digests") )
+        self.unigram_file.close()
+        self.memory_sections.update( self.get_name_token_sections() )
+        self.name_token_doc_freqs = {}
+        os.remove( self.get_section_path("unigram_doc_freqs") )
+
+        section_lengths = { name: os.path.getsize( self.get_section_path(name) ) // np.dtype(SECTION_DTYPES[name]).itemsize  for name in self.section_files }
+        for name in self.memory_sections:
+            section_lengths[name] = len(self.memory_sections[name])
+
+        header = {
+            "version":SEGMENT_VERSION,
+            "collection":self.collection,
+            "num_terms":self.num_terms,
+            "num_blocks":self.num_blocks,
+            "dict_block_size":self.dict_block_size,
+            "posting_block_size":self.posting_block_size,
+            "max_term_length":self.max_term_length,
+            "base_doc_id":self.base_doc_id,
+            "has_positions":self.has_positions,
+            "has_term_freqs":self.has_term_freqs,
+            "total_doc_length":self.total_doc_length if self.has_term_freqs else 0,
+            "has_doc_years":self.has_doc_years,
+            "min_year":self.min_year,
+            "bloom_num_hashes":NUM_HASHES,
+            "sections":{}
+        }
+        ## the header size depends on the section offsets, so compute the offsets with a fixed-width placeholder first
+        offset = 0
+        for name in self.section_names:
+            header["sections"][name] = { "offset":0, "dtype":SECTION_DTYPES[name], "length":section_lengths[name] }
+        header_size = len( json.dumps( header ).encode("utf-8") ) + 20 * len(self.section_names)
+        offset = self.align( len(SEGMENT_MAGIC) + 8 + header_size )
+        for name in self.section_names:
+            header["sections"][name]["offset"] = offset
+            offset = self.align( offset + section_lengths[name] * np.dtype(SECTION_DTYPES[name]).itemsize )
+        header_bytes = json.dumps( header ).encode("utf-8")
+        header_bytes += b" " * ( header_size - len(header_bytes) )
+
+        tmp_path = self.path + ".tmp"
+        with open( tmp_path, "wb" ) as f:
+            f.write( SEGMENT_MAGIC )
+            f.write( np.array( [len(header_bytes)], dtype = np.uint64 ).tobytes() )
+            f.write( header_bytes )
+            for name in self.section_names:
+                f.write( b"\x00" * ( header["sections"][name]["offset"] - f.tell() ) )
+                if name in self.memory_sections:
+                    f.write( self.memory_sections[name].tobytes() )
+                else:
+                    with open( self.get_section_path(name), "rb" ) as section_f:
+                        while True:
+                            chunk = section_f.read( 64 * 1024 * 1024 )
+                            if not chunk:
+                                break
+                            f.write( chunk )
+        for name in self.section_files:
+            os.remove( self.get_section_path(name) )
+        ## atomically replace the old file (if any)
+        os.replace( tmp_path, self.path )
+
+    def align( self, offset, alignment = 8 ):
+        return int(np.ceil( offset / alignment )) * alignment
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc_value, traceback ):
+        self.close()
+
+
+class InvertedIndexSegment:
+    """
+        Read-only, memory-mapped view of a segment. It exposes the same dict-like interface as the SqliteDict shards
+        (get(), [], "INFO:PACKED_DOC_IDS" and "INFO:COLLECTION"), so that it can be used by OnDiskInvertedIndex transparently.
+        get(), [] and items() return absolute doc ids; get_postings_by_ordinal*() and "INFO:PACKED_DOC_IDS" are relative to "INFO:BASE_DOC_ID".
+    """
+    def __init__( self, path ):
+        self.path = path
+        self.file = open( path, "rb" )
+        self.mm = mmap.mmap( self.file.fileno(), 0, access = mmap.ACCESS_READ )
+        assert self.mm[:len(SEGMENT_MAGIC)] == SEGMENT_MAGIC, "%s is not an inverted index segment!"%( path )
+        header_length = int( np.frombuffer( self.mm, dtype = np.uint64, count = 1, offset = len(SEGMENT_MAGIC) )[0] )
+        header_start = len(SEGMENT_MAGIC) + 8
+        self.header = json.loads( self.mm[ header_start: header_start + header_length ].decode("utf-8") )
+
+        self.collection = self.header["collection"]
+        self.num_terms = self.header["num_terms"]
+        self.dict_block_size = self.header["dict_block_size"]
+        self.posting_block_size = self.header["posting_block_size"]
+        self.base_doc_id = self.header.get( "base_doc_id", 0 )
+        self.has_positions = self.header.get( "has_positions", False )
+        self.has_term_freqs = self.header.get( "has_term_freqs", False )
+        self.total_doc_length = self.header.get( "total_doc_length", 0 )
+        self.has_doc_years = self.header.get( "has_doc_years", False )
+        self.min_year = self.header.get( "min_year", 0 )
+
+        self.sections = {}
+        for name, info in self.header["sections"].items():
+            if info["length"] == 0:
+                self.sections[name] = np.zeros( 0, dtype = info["dtype"] )
+            else:
+                self.sections[name] = np.frombuffer( self.mm, dtype = info["dtype"], count = info["length"], offset = info["offset"] )
+
+        self.packed_doc_ids = self.sections["packed_doc_ids"]
+        self.dict_bytes = self.sections["dict_bytes"]
+        self.dict_block_offsets = self.sections["dict_block_offsets"]
+        self.doc_freqs = self.sections["doc_freqs"]
+        self.term_block_starts = self.sections["term_block_starts"]
+        self.block_first_ids = self.sections["block_first_ids"]
+        self.block_last_ids = self.sections["block_last_ids"]
+        self.block_byte_offsets = self.sections["block_byte_offsets"]
+        self.postings = self.sections["postings"]
+        self.block_position_offsets = self.sections.get( "block_position_offsets", None )
+        self.positions = self.sections.get( "positions", None )
+        self.term_tf_offsets = self.sections.get( "term_tf_offsets", None )
+        self.term_freqs = self.sections.get( "term_freqs", None )
+        self.term_max_tfs = self.sections.get( "term_max_tfs", None )
+        self.doc_lengths = self.sections.get( "doc_lengths", None )
+        self.doc_years = self.sections.get( "doc_years", None )
+        self.year_doc_ids = self.sections.get( "year_doc_ids", None )
+        self.year_offsets = self.sections.get( "year_offsets", None )
+        self.term_bloom = TermBloomFilter( self.sections["term_bloom"], self.header["bloom_num_hashes"] ) if "term_bloom" in self.sections else None
+        self.name_token_hashes = self.sections.get( "name_token_hashes", None )
+        self.name_token_doc_freqs = self.sections.get( "name_token_doc_freqs", None )
+        self.name_token_plain_doc_freqs = self.sections.get( "name_token_plain_doc_freqs", None )
+
+    def lower_bound( self, term ):
+        ## return the ordinal of the first term >= term (a string or utf-8 bytes), and whether that term is equal to term
+        query = np.frombuffer( term.encode("utf-8") if isinstance( term, str ) else term, dtype = np.uint8 )
+        buf = np.zeros( self.header["max_term_length"] + 1, dtype = np.uint8 )
+        ordinal, found = _dict_lower_bound( self.dict_bytes, self.dict_block_offsets, self.num_terms, self.dict_block_size, query, buf )
+        return ordinal, found
+
+    def find( self, term ):
+        ## return the ordinal of term, or -1 if the term is not in the segment
+        if len( term.encode("utf-8") ) > self.header["max_term_length"]:
+            return -1
+        ordinal, found = self.lower_bound( term )
+        return ordinal if found else -1
+
+    def iter_prefix( self, prefix ):
+        """
+            Yield ( term, ordinal ) of all the terms starting with prefix, in sorted order.
+            The terms are sorted, so they form a contiguous range starting at the lower bound of prefix.
+        """
+        ordinal, _ = self.lower_bound( prefix )
+        block = ordinal // self.dict_block_size
+        pos_in_block = ordinal % self.dict_block_size
+        while block < len(self.dict_block_offsets) - 1:
+            terms = self.decode_dict_block( block )
+            for pos in range( pos_in_block, len(terms) ):
+                if not terms[pos].startswith( prefix ):
+                    return
+                yield terms[pos], block * self.dict_block_size + pos
+            block += 1
+            pos_in_block = 0
+
+    def get_prefix_range( self, prefix ):
+        """
+            Return the ordinals [start, end) of the terms starting with prefix. The terms are sorted by their utf-8 bytes,
+            so they form a contiguous range that is found by two binary searches, without decoding the terms in between.
+        """
+        prefix_bytes = prefix.encode("utf-8")
+        start, _ = self.lower_bound( prefix_bytes )
+        ## the smallest byte string that is larger than all the strings starting with prefix
+        end_bytes = prefix_bytes.rstrip( b"\xff" )
+        if len(end_bytes) == 0:
+            return start, self.num_terms
+        end, _ = self.lower_bound( end_bytes[:-1] + bytes( [ end_bytes[-1] + 1 ] ) )
+        return start, end
+
+    def get_term_by_ordinal( self, ordinal ):
+        return self.decode_dict_block( ordinal // self.dict_block_size )[ ordinal % self.dict_block_size ]
+
+    def get_doc_freq( self, term ):
+        ordinal = self.find( term )
+        if ordinal < 0:
+            return 0
+        return int(self.doc_freqs[ordinal])
+
+    def get_postings_by_ordinal( self, ordinal ):
+        block_start = int(self.term_block_starts[ordinal])
+        block_end = int(self.term_block_starts[ordinal+1])
+        out = np.zeros( int(self.doc_freqs[ordinal]), dtype = np.uint32 )
+        _decode_blocks( self.postings, self.block_byte_offsets, self.block_first_ids, block_start, block_end, out )
+        return out
+
+    def get_candidate_blocks( self, ordinal, candidate_ids ):
+        """
+            Use the first/last id of each posting block as a skip list: return the (sorted) blocks of the term whose id range contains
+            one of the sorted candidate_ids.
+        """
+        block_start = int(self.term_block_starts[ordinal])
+        block_end = int(self.term_block_starts[ordinal+1])
+        first_ids = self.block_first_ids[ block_start:block_end ]
+        last_ids = self.block_last_ids[ block_start:block_end ]
+        ## the first candidate >= the first id of the block must also be <= the last id of the block
+        pos = np.minimum( np.searchsorted( candidate_ids, first_ids ), len(candidate_ids) - 1 )
+        return ( block_start + np.flatnonzero( ( candidate_ids[pos] >= first_ids ) & ( candidate_ids[pos] <= last_ids ) ) ).astype( np.int64 )
+
+    def get_postings_by_ordinal_within( self, ordinal, candidate_ids ):
+        """
+            Only the posting blocks that can contain one of the sorted candidate_ids are decoded. The result still has to be intersected with candidate_ids.
+        """
+        if len(candidate_ids) == 0:
+            return np.zeros( 0, dtype = np.uint32 )
+        blocks = self.get_candidate_blocks( ordinal, candidate_ids )
+        out = np.zeros( len(blocks) * self.posting_block_size, dtype = np.uint32 )
+        k = _decode_block_list( self.postings, self.block_byte_offsets, self.block_first_ids, blocks, out )
+        return out[:k]
+
+    def get_term_freqs_by_ordinal( self, ordinal ):
+        """
+            Return the term frequencies of all the doc ids of the term (in the order of get_postings_by_ordinal), or None if the segment has none
+        """
+        if not self.has_term_freqs:
+            return None
+        return self.term_freqs[ int(self.term_tf_offsets[ordinal]): int(self.term_tf_offsets[ordinal+1]) ]
+
+    def get_term_freqs_within( self, ordinal, candidate_ids ):
+        """
+            Return ( doc ids, term frequencies ) of the sorted (relative) candidate_ids that contain the term.
+            Only the posting blocks that can contain a candidate are decoded.
+        """
+        if len(candidate_ids) == 0:
+            return np.zeros( 0, dtype = np.uint32 ), np.zeros( 0, dtype = np.uint8 )
+        candidate_ids = np.asarray( candidate_ids, dtype = np.uint32 )
+        if not self.has_term_freqs:
+            doc_ids = np.intersect1d( self.get_postings_by_ordinal_within( ordinal, candidate_ids ), candidate_ids, assume_unique = True )
+            return doc_ids, np.ones( len(doc_ids), dtype = np.uint8 )
+        blocks = self.get_candidate_blocks( ordinal, candidate_ids )
+        ## all the blocks of a term but the last one are full
+        block_tf_starts = int(self.term_tf_offsets[ordinal]) + ( blocks - int(self.term_block_starts[ordinal]) ) * self.posting_block_size
+        out_ids = np.zeros( min( len(blocks) * self.posting_block_size, len(candidate_ids) ), dtype = np.uint32 )
+        out_tfs = np.zeros( len(out_ids), dtype = np.uint8 )
+        n = _gather_term_freqs( self.postings, self.block_byte_offsets, self.block_first_ids, self.term_freqs, blocks, block_tf_starts, candidate_ids, out_ids, out_tfs )
+        return out_ids[:n], out_tfs[:n]
+
+    def get_positions_by_ordinal( self, ordinal ):
+        """
+            Return the positions ( counts, flat positions ) of all the doc ids of the term, or None if the term has no positions
+        """
+        if not self.has_positions:
+            return None
+        start = int( self.block_position_offsets[ int(self.term_block_starts[ordinal]) ] )
+        end = int( self.block_position_offsets[ int(self.term_block_starts[ordinal+1]) ] )
+        if start == end:
+            return None
+        counts = np.zeros( int(self.doc_freqs[ordinal]), dtype = np.uint32 )
+        ## every position takes at least one byte
+        flat_positions = np.zeros( end - start, dtype = np.uint32 )
+        k = _decode_positions( self.positions, start, end, counts, flat_positions )
+        return counts, flat_positions[:k]
+
+    def get_positions_within( self, ordinal, candidate_ids ):
+        """
+            Return ( doc ids, counts, flat positions ) of the sorted (relative) candidate_ids that contain the term at least once
+            in the positional fields. Only the posting blocks that can contain a candidate are decoded.
+        """
+        if not self.has_positions or len(candidate_ids) == 0:
+            return np.zeros( 0, dtype = np.uint32 ), np.zeros( 0, dtype = np.uint32 ), np.zeros( 0, dtype = np.uint32 )
+        blocks = self.get_candidate_blocks( ordinal, candidate_ids )
+        num_position_bytes = int( np.sum( self.block_position_offsets[ blocks + 1 ].astype(np.int64) - self.block_position_offsets[ blocks ].astype(np.int64) ) )
+        out_ids = np.zeros( min( len(blocks) * self.posting_block_size, len(candidate_ids) ), dtype = np.uint32 )
+        out_counts = np.zeros( len(out_ids), dtype = np.uint32 )
+        out_positions = np.zeros( num_position_bytes, dtype = np.uint32 )
+        n, k = _gather_positions( self.postings, self.block_byte_offsets, self.block_first_ids, self.positions, self.block_position_offsets,
+                                  blocks, np.asarray( candidate_ids, dtype = np.uint32 ), out_ids, out_counts, out_positions )
+        return out_ids[:n], out_counts[:n], out_positions[:k]
+
+    def get( self, key, default = None ):
+        if key == "INFO:PACKED_DOC_IDS":
+            return self.packed_doc_ids
+        if key == "INFO:COLLECTION":
+            return self.collection
+        if key == "INFO:BASE_DOC_ID":
+            return self.base_doc_id
+        ordinal = self.find( key )
+        if ordinal < 0:
+            return default
+        return self.to_absolute_doc_ids( self.get_postings_by_ordinal( ordinal ) )
+
+    def __getitem__( self, key ):
+        value = self.get( key )
+        if value is None:
+            raise KeyError( key )
+        return value
+
+    def __contains__( self, key ):
+        return key in [ "INFO:PACKED_DOC_IDS", "INFO:COLLECTION", "INFO:BASE_DOC_ID" ] or self.find( key ) >= 0
+
+    def __len__( self ):
+        return self.num_terms
+
+    def decode_dict_block( self, block ):
+        start = int(self.dict_block_offsets[block])
+        end = int(self.dict_block_offsets[block+1])
+        block_bytes = self.dict_bytes[start:end].tobytes()
+        terms = []
+        pos = 0
+        prev = b""
+        while pos < len(block_bytes):
+            if len(terms) == 0:
+                shared = 0
+            else:
+                shared, pos = self.decode_varint( block_bytes, pos )
+            suffix_len, pos = self.decode_varint( block_bytes, pos )
+            term = prev[:shared] + block_bytes[pos:pos+suffix_len]
+            pos += suffix_len
+            terms.append( term.decode("utf-8") )
+            prev = term
+        return terms
+
+    def decode_varint( self, buf, pos ):
+        value = 0
+        shift = 0
+        while True:
+            byte = buf[pos]
+            pos += 1
+            value |= ( byte & 127 ) << shift
+            if byte < 128:
+                break
+            shift += 7
+        return value, pos
+
+    def keys( self ):
+        for block in range( len(self.dict_block_offsets) - 1 ):
+            for term in self.decode_dict_block( block ):
+                yield term
+
+    def __iter__( self ):
+        return self.keys()
+
+    def items( self, with_payloads = False ):
+        ## ( term, absolute doc ids ), or ( term, absolute doc ids, positions or None, term frequencies or None ) if with_payloads
+        for ordinal, term in enumerate( self.keys() ):
+            if with_payloads:
+                yield term, self.to_absolute_doc_ids( self.get_postings_by_ordinal( ordinal ) ), self.get_positions_by_ordinal( ordinal ), self.get_term_freqs_by_ordinal( ordinal )
+            else:
+                yield term, self.to_absolute_doc_ids( self.get_postings_by_ordinal( ordinal ) )
+
+    def to_absolute_doc_ids( self, doc_ids ):
+        if self.base_doc_id == 0:
+            return doc_ids
+        return doc_ids + np.uint32( self.base_doc_id )
+
+    def get_doc_ids( self ):
+        ## absolute ids of all the documents indexed in this segment
+        return self.to_absolute_doc_ids( np.flatnonzero( np.unpackbits( self.packed_doc_ids, bitorder = "little" ) ).astype( np.uint32 ) )
+
+    def get_doc_column( self, name ):
+        ## ( absolute doc ids, values ) of a per document column ("doc_lengths" or "doc_years") for all the documents indexed in this segment,
+        ## None if the segment does not have this column
+        if name not in self.sections:
+            return None
+        doc_ids = np.flatnonzero( np.unpackbits( self.packed_doc_ids, bitorder = "little" ) )
+        return self.to_absolute_doc_ids( doc_ids.astype( np.uint32 ) ), self.sections[name][ doc_ids ]
+
+    def get_year_range( self, start_year, end_year ):
+        ## the slice [start, end) of year_doc_ids holding the documents published from start_year to end_year (inclusive)
+        num_years = len(self.year_offsets) - 1
+        start = int( self.year_offsets[ min( max( start_year - self.min_year, 0 ), num_years ) ] )
+        end = int( self.year_offsets[ min( max( end_year - self.min_year + 1, 0 ), num_years ) ] )
+        return start, max( end, start )
+
+    def count_year_range( self, start_year, end_year ):
+        start, end = self.get_year_range( start_year, end_year )
+        return end - start
+
+    def get_doc_ids_by_year_range( self, start_year, end_year ):
+        """
+            Sorted relative doc ids of the documents published from start_year to end_year (inclusive).
+            A narrow range is read from the year sorted doc ids, a wide one by a vectorized scan of the year column.
+        """
+        start, end = self.get_year_range( start_year, end_year )
+        if ( end - start ) * 8 < len(self.doc_years):
+            return np.sort( self.year_doc_ids[start:end] )
+        return np.flatnonzero( ( self.doc_years >= start_year ) & ( self.doc_years <= end_year ) ).astype( np.uint32 )
+
+    def filter_by_year_range( self, doc_ids, start_year, end_year ):
+        ## the sorted relative doc ids published from start_year to end_year (inclusive)
+        years = self.doc_years[ doc_ids ]
+        return doc_ids[ ( years >= start_year ) & ( years <= end_year ) ]
+
+    def close( self ):
+        self.sections = {}
+        self.packed_doc_ids = self.dict_bytes = self.dict_block_offsets = self.doc_freqs = None
+        self.term_block_starts = self.block_first_ids = self.block_last_ids = self.block_byte_offsets = self.postings = None
+        self.block_position_offsets = self.positions = None
+        self.term_tf_offsets = self.term_freqs = self.term_max_tfs = self.doc_lengths = None
+        self.doc_years = self.year_doc_ids = self.year_offsets = None
+        self.term_bloom = None
+        try:
+            self.mm.close()
+        except:
+            ## numpy views of the mmap are still referenced somewhere; the mapping is released once they are garbage collected
+            pass
+        self.file.close()
+
+    def __del__( self ):
+        try:
+            self.close()
+        except:
+            pass
@@ -0,0 +1,102 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+
+"""
+    Transport of numpy arrays between the Ranker and its shard processes through shared memory,
+    so that only small descriptors are pickled through the pipes.
+
+    The writer of a SharedRingBuffer puts the arrays one after another into a shared memory block and wraps around to its start when the end is reached.
+    A descriptor is ( "shm", name, offset, shape, dtype ) for an array in the block "name", or ( "array", array ) if the array did not fit,
+    in that case the array itself goes through the pipe. The reader attaches each block once (by its name) and reads the arrays without a copy.
+"""
+
+## the Ranker writes the query vectors and the keyword filters of a batch into this ring buffer, read by all the shard processes
+RING_BUFFER_SIZE = 256 * 1024**2
+## each shard process writes the ( similarity, pos ) arrays of its results into its own ring buffer of this size
+RESULT_BUFFER_SIZE = 16 * 1024**2
+ALIGNMENT = 64
+
+
+class SharedRingBuffer:
+    """
+        Thread-safe. The arrays are put into batches (begin_batch()); the space of a batch is only reused once the batch is released (release_batch()),
+        or, with max_live_batches, once max_live_batches newer batches have begun.
+    """
+    def __init__( self, size = RING_BUFFER_SIZE, max_live_batches = None ):
+        self.shm = shared_memory.SharedMemory( create = True, size = size )
+        self.name = self.shm.name
+        self.size = size
+        self.max_live_batches = max_live_batches
+        self.lock = threading.Lock()
+        self.offset = 0
+        ## batch id -> offset of its first array (None: no array yet), from the oldest to the newest batch
+        self.live_batches = OrderedDict()
+        self.num_batches = 0
+        self.current_batch_id = None
+
+    def begin_batch( self ):
+        with self.lock:
+            batch_id = self.num_batches
+            self.num_batches += 1
+            self.live_batches[ batch_id ] = None
+            self.current_batch_id = batch_id
+            if self.max_live_batches is not None:
+                while len( self.live_batches ) > self.max_live_batches:
+                    self.live_batches.popitem( last = False )
+            return batch_id
+
+    def release_batch( self, batch_id ):
+        with self.lock:
+            self.live_batches.pop( batch_id, None )
+
+    def put( self, array ):
+        array = np.ascontiguousarray( array )
+        if array.nbytes == 0:
+            return ( "array", array )
+        with self.lock:
+            ## the start of the oldest data still in use: the free space is [ offset, tail ), wrapping around at the end
+            tail = next( ( start for start in self.live_batches.values() if start is not None ), None )
+            start = int( np.ceil( self.offset / ALIGNMENT ) * ALIGNMENT )
+            if tail is None or tail < self.offset:
+                if start + array.nbytes > self.size:
+                    start = 0
+                    if array.nbytes > ( tail if tail is not None else self.size ):
+                        return ( "array", array )
+            elif start + array.nbytes > tail:
+                return ( "array", array )
+            np.ndarray( array.shape, dtype = array.dtype, buffer = self.shm.buf, offset = start )[...] = array
+            self.offset = start + array.nbytes
+            if self.live_batches.get( self.current_batch_id, 0 ) is None:
+                self.live_batches[ self.current_batch_id ] = start
+        return ( "shm", self.name, start, array.shape, array.dtype.str )
+
+    def close( self ):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedMemoryReader:
+    """
+        Reads the arrays of descriptors, attaching the shared memory blocks by their names
+    """
+    def __init__( self ):
+        self.attached = {}
+
+    def get( self, descriptor ):
+        ## a view into the shared memory, valid until the writer reuses this part of the ring buffer
+        if descriptor[0] == "array":
+            return descriptor[1]
+        _, name, offset, shape, dtype = descriptor
+        if name not in self.attached:
+            self.attached[name] = shared_memory.SharedMemory( name = name )
+        return np.ndarray( shape, dtype = np.dtype( dtype ), buffer = self.attached[name].buf, offset = offset )
+
+    def detach( self, name ):
+        if name in self.attached:
+            try:
+                self.attached.pop( name ).close()
+            except:
+                print("Warning: the shared memory %s is still in use"%( name ))
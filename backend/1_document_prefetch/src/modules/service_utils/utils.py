@@ -1,4 +1,5 @@
 import time
+import threading
 import socket
 from urllib.parse import urlparse
 
@@ -13,4 +14,39 @@ def wait_for_service( service_url ):
             with socket.create_connection( (host, port) ):
                 break
         except:
-            time.sleep(1)
\ No newline at end of file
+            time.sleep(1)
+
+class ReadWriteLock:
+    """
+        Many readers or one writer. A waiting writer blocks the new readers, so that a shard update is not starved by a stream of searches.
+    """
+    def __init__( self ):
+        self.condition = threading.Condition()
+        self.num_readers = 0
+        self.num_waiting_writers = 0
+        self.is_writing = False
+
+    def acquire_read( self ):
+        with self.condition:
+            while self.is_writing or self.num_waiting_writers > 0:
+                self.condition.wait()
+            self.num_readers += 1
+
+    def release_read( self ):
+        with self.condition:
+            self.num_readers -= 1
+            if self.num_readers == 0:
+                self.condition.notify_all()
+
+    def acquire_write( self ):
+        with self.condition:
+            self.num_waiting_writers += 1
+            while self.is_writing or self.num_readers > 0:
+                self.condition.wait()
+            self.num_waiting_writers -= 1
+            self.is_writing = True
+
+    def release_write( self ):
+        with self.condition:
+            self.is_writing = False
+            self.condition.notify_all()
@@ -17,16 +17,21 @@ if __name__ == "__main__":
     parser.add_argument( "-db_address", default = ROOT_DATA_PATH + "/sqlite_database/DB.db" )
     parser.add_argument( "-duplicate_checking_database_path", default = ROOT_DATA_PATH + "/duplicate_checking_buffer/data.db" )
     parser.add_argument( "-batch_size", type = int, default = 500000 )
+    ## 0: append the papers to the existing duplicate checking database, e.g. when indexing newly added papers
+    parser.add_argument( "-overwrite", type = int, default = 1 )
+    parser.add_argument( "-start", type = int, default = 0 )
+    parser.add_argument( "-size", type = int, default = 0 )
     args = parser.parse_args()
     
     
     ## deal with missing folders
-    data_folder = os.path.dirname( args.duplicate_checking_database_path )
-    try:
-        shutil.rmtree(data_folder)
-    except:
-        pass
-    os.makedirs( data_folder )
+    if args.overwrite:
+        data_folder = os.path.dirname( args.duplicate_checking_database_path )
+        try:
+            shutil.rmtree(data_folder)
+        except:
+            pass
+        os.makedirs( data_folder )
     
     
     duplicate_checker = DuplicateChecker( args.duplicate_checking_database_path )
@@ -36,8 +41,11 @@ if __name__ == "__main__":
     args.collection = list(sql.collections)[0]
     
     max_row_id = sql.get_max_rowid( args.collection )
+    if args.size == 0:
+        args.size = max_row_id
+    end = min( args.start + args.size, max_row_id )
     data_buffer = []
-    for count in tqdm(range(0,max_row_id)):
+    for count in tqdm(range(args.start,end)):
         idx = count +1
         paper_info = sql.get_papers( [ { "collection":args.collection, "id_field":"id_int", "id_type":"int","id_value":idx } ],
                                      {"Title":1, "Author":1, "MD5":1, "DOI":1, "RequireIndexing":1}
@@ -21,6 +21,8 @@ NUM_PROCESSES = int(os.getenv("NUM_PROCESSES"))
 NUM_EMBEDDING_INDEX_SHARDS = int(os.getenv("NUM_EMBEDDING_INDEX_SHARDS"))
 
 SENT2VEC_MODEL_PATH = os.getenv("SENT2VEC_MODEL_PATH")
+## approximate nearest neighbor search of the ranking service on CPU: "scann" or "hnsw"
+ANN_BACKEND = os.getenv("ANN_BACKEND", "scann")
 
 
 if __name__ == "__main__":
@@ -106,6 +108,20 @@ if __name__ == "__main__":
                      "-num_shards", str( NUM_EMBEDDING_INDEX_SHARDS )
                     ] )
     
+    ## train the ScaNN searchers (or build the HNSW graphs) here, so that the ranking service only has to load them
+    if ANN_BACKEND == "hnsw":
+        print("Building HNSW indices ...")
+        subprocess.run( ["python", "build_hnsw_indices.py",
+                         "-embedding_index_folder", ROOT_DATA_PATH + "/ranking_buffer/embedding_index/",
+                         "-embedding_index_name_prefix", "embedding_index.db_"
+                        ] )
+    else:
+        print("Building ScaNN searchers ...")
+        subprocess.run( ["python", "build_scann_searchers.py",
+                         "-embedding_index_folder", ROOT_DATA_PATH + "/ranking_buffer/embedding_index/",
+                         "-embedding_index_name_prefix", "embedding_index.db_"
+                        ] )
+    
     print("All Done!")
 
     
\ No newline at end of file
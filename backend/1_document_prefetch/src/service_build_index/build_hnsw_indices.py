@@ -0,0 +1,67 @@
+import os
+import time
+import numpy as np
+from glob import glob
+
+from modules.ranking.embedding_index import EmbeddingIndexShard
+from modules.ranking.rankers import get_hnsw_index_fingerprint
+from modules.ranking.nearest_neighbor_search.hnsw import HNSWIndex, load_hnsw_index, save_hnsw_index, HNSW_INDEX_FOLDER, HNSW_M, HNSW_EF_CONSTRUCTION
+import json
+import argparse
+
+"""
+    Build the HNSW graph of each embedding index shard and save it next to the shard, for the ranking service started with -ann_backend hnsw.
+    The graphs are built on the normalized float32 embeddings, like in BaseRanker with the default precision settings.
+    The ranking service never builds a graph itself (a shard without an up-to-date graph is served by ScaNN), so this script has to run
+    after every change of the shards. The candidates of the inserted nodes are searched by -num_threads threads (0: all the cores).
+    With -num_benchmark_queries, the recall@n of the graph against the exact search and its latency are printed for each shard and each ef_search,
+    sampling the queries among the embeddings of the shard.
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-embedding_index_folder" )
+    parser.add_argument("-embedding_index_name_prefix", default = "embedding_index.db_" )
+    parser.add_argument("-hnsw_m", type = int, default = HNSW_M )
+    parser.add_argument("-hnsw_ef_construction", type = int, default = HNSW_EF_CONSTRUCTION )
+    ## 0: skip the shards that already have an up-to-date graph
+    parser.add_argument("-overwrite", type = int, default = 0 )
+    parser.add_argument("-num_threads", type = int, default = 0 )
+    parser.add_argument("-num_benchmark_queries", type = int, default = 0 )
+    parser.add_argument("-benchmark_n", type = int, default = 100 )
+    parser.add_argument("-benchmark_ef_search_list", type = int, nargs = "+", default = [ 128, 256, 512 ] )
+    args = parser.parse_args()
+
+    embedding_index_names = [ fname for fname in glob( args.embedding_index_folder + "/" + args.embedding_index_name_prefix + "*" ) if os.path.isdir( fname ) ]
+    embedding_index_names.sort()
+
+    for fname in embedding_index_names:
+        try:
+            embedding_index = EmbeddingIndexShard( fname )
+            fingerprint = get_hnsw_index_fingerprint( embedding_index, True, args.hnsw_m, args.hnsw_ef_construction )
+            doc_embeddings = np.asarray( embedding_index.embedding_matrix, dtype = np.float32 )
+            doc_embeddings = doc_embeddings /(np.linalg.norm( doc_embeddings, axis =1, keepdims=True )+1e-12)
+
+            hnsw_index = None if args.overwrite else load_hnsw_index( fname + "/" + HNSW_INDEX_FOLDER, doc_embeddings, fingerprint )
+            if hnsw_index is not None:
+                print("HNSW index of %s is up to date"%( fname ))
+            else:
+                print("Building HNSW index of %s ..."%( fname ), time.time())
+                hnsw_index = HNSWIndex.build( doc_embeddings, args.hnsw_m, args.hnsw_ef_construction, num_threads = args.num_threads if args.num_threads > 0 else None )
+                save_hnsw_index( hnsw_index, fname + "/" + HNSW_INDEX_FOLDER, fingerprint )
+                print("Done", time.time())
+
+            if args.num_benchmark_queries > 0 and len( doc_embeddings ) > 0:
+                queries = doc_embeddings[ np.random.default_rng(0).choice( len( doc_embeddings ), min( args.num_benchmark_queries, len( doc_embeddings ) ), replace = False ) ]
+                n = min( args.benchmark_n, len( doc_embeddings ) )
+                exact_results = [ set( np.argpartition( -np.matmul( doc_embeddings, query ), n-1 )[:n] ) for query in queries ]
+                ## the first search compiles the numba functions
+                hnsw_index.search( queries[0], n )
+                for ef_search in args.benchmark_ef_search_list:
+                    tic = time.time()
+                    results = [ hnsw_index.search( query, n, ef_search )[0] for query in queries ]
+                    latency_ms = ( time.time() - tic ) * 1000 / len( queries )
+                    recall = np.mean( [ len( exact_results[count] & set( positions ) ) / n for count, positions in enumerate( results ) ] )
+                    print( json.dumps( { "shard":os.path.basename( fname ), "ef_search":ef_search, "recall@%d"%( n ):float( recall ), "latency_ms":latency_ms } ) )
+        except:
+            print("Warning: building the HNSW index of %s failed!"%( fname ))
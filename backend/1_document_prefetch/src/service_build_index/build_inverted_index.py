@@ -22,6 +22,12 @@ import argparse
 
 ROOT_DATA_PATH = os.getenv("ROOT_DATA_PATH")
 NUM_INVERTED_INDEX_SHARDS = int(os.getenv("NUM_INVERTED_INDEX_SHARDS"))
+## if > 0, the per-process shards are merged into this number of serving segments with contiguous doc id ranges
+NUM_INVERTED_INDEX_SERVING_SEGMENTS = int(os.getenv("NUM_INVERTED_INDEX_SERVING_SEGMENTS", 0))
+## if 1, the token positions are indexed as well, so that quoted phrase queries are matched exactly
+INDEX_POSITIONS = int(os.getenv("INDEX_POSITIONS", 0))
+## if 1, the term frequencies and the document lengths are indexed as well, so that keyword queries can be ranked with BM25
+INDEX_TERM_FREQUENCIES = int(os.getenv("INDEX_TERM_FREQUENCIES", 0))
 
 
 if __name__ == "__main__":
@@ -34,6 +40,14 @@ if __name__ == "__main__":
     parser.add_argument("-size", type = int, default = None)
     parser.add_argument("-n_processes", type = int, default = NUM_INVERTED_INDEX_SHARDS )
     parser.add_argument("-n_docs_per_process", type = int, default = None )
+    parser.add_argument("-index_format", default = "segment", choices = [ "segment", "sqlitedict" ])
+    ## memory budget of each subprocess, see compute_inverted_index.py
+    parser.add_argument("-memory_budget_mb", type = float, default = 4096)
+    ## resume an interrupted build from the checkpoints in the inverted index folder instead of starting from scratch
+    parser.add_argument("-resume", type = int, default = 0)
+    parser.add_argument("-num_serving_segments", type = int, default = NUM_INVERTED_INDEX_SERVING_SEGMENTS )
+    parser.add_argument("-index_positions", type = int, default = INDEX_POSITIONS )
+    parser.add_argument("-index_term_frequencies", type = int, default = INDEX_TERM_FREQUENCIES )
     
     args = parser.parse_args()
 
@@ -63,11 +77,13 @@ if __name__ == "__main__":
     
     ## deal with missing folders
     inv_idx_folder = os.path.dirname( args.inv_idx_file_name )
-    try:
-        shutil.rmtree(inv_idx_folder)
-    except:
-        pass
-    os.makedirs( inv_idx_folder )
+    if not args.resume:
+        try:
+            shutil.rmtree(inv_idx_folder)
+        except:
+            pass
+    if not os.path.exists( inv_idx_folder ):
+        os.makedirs( inv_idx_folder )
     
         
     print("Start multiple subprocesses ...")
@@ -84,6 +100,11 @@ if __name__ == "__main__":
                     "-inv_idx_file_name_suffix", "_%d"%( count ),
                     "-commit_per_num_of_keys", args.commit_per_num_of_keys,
                     "-overwrite", args.overwrite,
+                    "-index_format", args.index_format,
+                    "-memory_budget_mb", args.memory_budget_mb,
+                    "-resume", args.resume,
+                    "-index_positions", args.index_positions,
+                    "-index_term_frequencies", args.index_term_frequencies,
                     "-start", offset,
                     "-size", min(args.n_docs_per_process, args.start + args.size -  offset )
                    ] ) ) ,
@@ -99,4 +120,22 @@ if __name__ == "__main__":
     for t in threads:
         t.join()
     
+    if args.num_serving_segments > 0:
+        print("Merging the shards into serving segments ...")
+        merged_inv_idx_folder = inv_idx_folder + "_merged"
+        try:
+            shutil.rmtree( merged_inv_idx_folder )
+        except:
+            pass
+        subprocess.run( [
+            "python",
+            "merge_inverted_index.py",
+            "-inv_idx_folder", inv_idx_folder,
+            "-output_folder", merged_inv_idx_folder,
+            "-inv_idx_name_prefix", os.path.basename( args.inv_idx_file_name ) + "_",
+            "-num_segments", str( args.num_serving_segments )
+        ], check = True )
+        shutil.rmtree( inv_idx_folder )
+        shutil.move( merged_inv_idx_folder, inv_idx_folder )
+    
     print("All Done!")
\ No newline at end of file
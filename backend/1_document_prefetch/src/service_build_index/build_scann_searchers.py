@@ -0,0 +1,45 @@
+import os
+import time
+import numpy as np
+from glob import glob
+
+from modules.ranking.embedding_index import EmbeddingIndexShard
+from modules.ranking.rankers import build_scann_searcher, get_scann_searcher_fingerprint, save_scann_searcher, SCANN_SEARCHER_FOLDER
+import json
+import argparse
+
+"""
+    Train the ScaNN searcher of each embedding index shard and serialize it next to the shard,
+    so that the ranking service loads it instead of training it at every start.
+    The searchers are built on the normalized float32 embeddings, like in BaseRanker with the default precision settings.
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-embedding_index_folder" )
+    parser.add_argument("-embedding_index_name_prefix", default = "embedding_index.db_" )
+    ## 0: skip the shards that already have an up-to-date searcher
+    parser.add_argument("-overwrite", type = int, default = 0 )
+    args = parser.parse_args()
+
+    embedding_index_names = [ fname for fname in glob( args.embedding_index_folder + "/" + args.embedding_index_name_prefix + "*" ) if os.path.isdir( fname ) ]
+    embedding_index_names.sort()
+
+    for fname in embedding_index_names:
+        try:
+            embedding_index = EmbeddingIndexShard( fname )
+            fingerprint = get_scann_searcher_fingerprint( embedding_index, normalized = True )
+            fingerprint_path = fname + "/" + SCANN_SEARCHER_FOLDER + "/fingerprint.json"
+            if not args.overwrite and os.path.exists( fingerprint_path ):
+                with open( fingerprint_path, "r" ) as f:
+                    if json.load( f ) == fingerprint:
+                        print("ScaNN searcher of %s is up to date"%( fname ))
+                        continue
+
+            print("Building ScaNN searcher of %s ..."%( fname ), time.time())
+            doc_embeddings = np.asarray( embedding_index.embedding_matrix, dtype = np.float32 )
+            doc_embeddings = doc_embeddings /(np.linalg.norm( doc_embeddings, axis =1, keepdims=True )+1e-12)
+            save_scann_searcher( build_scann_searcher( doc_embeddings ), fname, fingerprint )
+            print("Done", time.time())
+        except:
+            print("Warning: building the ScaNN searcher of %s failed!"%( fname ))
@@ -4,11 +4,10 @@ from tqdm import tqdm
 import time
 import numpy as np
 
-import pickle
-
 from modules.paper_database.database_managers import SqliteClient
 from modules.tokenizer.tokenizer import SentenceTokenizer
 from modules.ranking.rankers import Sent2vecEncoder
+from modules.ranking.embedding_index import save_embedding_index
 
 import argparse
 
@@ -46,6 +45,8 @@ if __name__ == "__main__":
     parser.add_argument("-text_encoder_model_path" )
     parser.add_argument("-start", type = int, default = 0)
     parser.add_argument("-size", type = int, default = 1000000)
+    ## precision of the embedding matrix on disk
+    parser.add_argument("-precision", default = "float32", choices = [ "float32", "float16" ])
     args = parser.parse_args()
     
     
@@ -66,11 +67,7 @@ if __name__ == "__main__":
     end = min( args.start + args.size, max_rowid)
     
     embedding_matrix = []
-    doc_id_to_pos_array = -np.ones( max_rowid+1000, dtype = np.int32  )  
-    ## make sure 1000 is just a number > 1+8, so that the final len of doc_id_to_pos_array can be a multiple of 8
     pos_to_doc_id_mapper = []
-    
-    doc_id_list = []
             
     for count in tqdm(range( args.start, end )):
         
@@ -81,8 +78,6 @@ if __name__ == "__main__":
             continue
             
         pos_to_doc_id_mapper.append( { "collection":args.collection,"id_field": "id_int", "id_type":"int", "id_value": doc_id } )
-        doc_id_to_pos_array[ doc_id ] = len( pos_to_doc_id_mapper ) - 1
-        doc_id_list.append( doc_id )
             
             
         ## Key part: get the text from document to encode. This may vary over different collections, e.g. for GeneralIndex  
@@ -92,16 +87,6 @@ if __name__ == "__main__":
     
     embedding_matrix = np.asarray( embedding_matrix ).astype(np.float32)
         
-    ## update the actual max_rowid in the current shard    
-    if len(doc_id_list) > 0:
-        max_rowid = np.max( doc_id_list )
-        doc_id_to_pos_array =  doc_id_to_pos_array[ : int(np.ceil( (max_rowid +1) / 8 ) * 8)]    
-    
-        with open( args.embedding_file_name, "wb" ) as f:
-            pickle.dump(  
-                {
-                    "embedding_matrix":embedding_matrix,
-                    "doc_id_to_pos_mapper":{  args.collection : doc_id_to_pos_array  },
-                    "pos_to_doc_id_mapper":pos_to_doc_id_mapper
-                }, f, -1
-            )
\ No newline at end of file
+    ## the doc id -> pos mapping is derived from pos_to_doc_id_mapper when the shard is saved
+    if len(pos_to_doc_id_mapper) > 0:
+        save_embedding_index( args.embedding_file_name, embedding_matrix, pos_to_doc_id_mapper, args.precision )
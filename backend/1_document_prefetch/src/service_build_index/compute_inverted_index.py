@@ -12,36 +12,191 @@ import numpy as np
 from more_itertools import unique_everseen
 
 from modules.tokenizer.tokenizer import SentenceTokenizer
+from modules.ranking.segment import InvertedIndexSegment, InvertedIndexSegmentWriter, merge_sorted_postings, MAX_TERM_FREQ, MAX_DOC_YEAR
+from modules.ranking.bitmap import CHUNK_SIZE
 from sqlitedict import SqliteDict
 import argparse
 
 
-def add_ngrams( inv_idx, ngram_set, doc_id ):
+## rough memory footprint of an in-memory posting list: the dict entry, the term string and the array object, plus 4 bytes per doc id
+TERM_OVERHEAD_BYTES = 200
+DOC_ID_BYTES = 4
+## the positions of consecutive sentences (and of the title and the body) are separated by this gap, so that a phrase never matches across them
+POSITION_GAP = 16
+
+def add_ngrams( inv_idx, ngram_set, doc_id, inv_tf = None, term_freqs = None ):
     #ngram_set is a set of ngrams
+    ## return the (estimated) number of bytes added to inv_idx
+    ## inv_tf: term -> term frequencies, aligned with the doc ids of inv_idx[term]; the ngrams missing in term_freqs count once
+    added_bytes = 0
     for ngram in ngram_set:
         if ngram not in inv_idx:
             inv_idx[ngram] = array.array("I", [doc_id] )
+            added_bytes += TERM_OVERHEAD_BYTES + len(ngram) + DOC_ID_BYTES
         else:
             inv_idx[ngram].append( doc_id )
+            added_bytes += DOC_ID_BYTES
+        if inv_tf is not None:
+            if ngram not in inv_tf:
+                inv_tf[ngram] = array.array("B")
+            inv_tf[ngram].append( min( term_freqs.get( ngram, 1 ), MAX_TERM_FREQ ) )
+            added_bytes += 1
+    return added_bytes
+
+def add_positions( inv_pos, term_positions, doc_id ):
+    ## inv_pos: term -> ( doc ids, number of positions per doc id, positions ); return the (estimated) number of bytes added
+    added_bytes = 0
+    for term, positions in term_positions.items():
+        if term not in inv_pos:
+            inv_pos[term] = ( array.array("I"), array.array("I"), array.array("I") )
+            added_bytes += TERM_OVERHEAD_BYTES + len(term)
+        doc_ids, counts, flat_positions = inv_pos[term]
+        doc_ids.append( doc_id )
+        counts.append( len(positions) )
+        flat_positions.extend( positions )
+        added_bytes += DOC_ID_BYTES * ( 2 + len(positions) )
+    return added_bytes
+
+## dtype of the per document columns while indexing (the segment stores them as uint16, capped)
+DOC_COLUMN_DTYPES = { "doc_years":np.uint16, "doc_lengths":np.uint32 }
+
+def pack_doc_ids( doc_ids, base_doc_id = 0 ):
+    ## packed bitmap of the doc ids relative to base_doc_id (a multiple of 8), so that its size does not depend on the absolute doc ids
+    doc_ids = np.asarray( doc_ids, dtype = np.int64 ) - base_doc_id
+    bool_arr = np.zeros( np.max(doc_ids) +1 if len(doc_ids) > 0 else 0, dtype = np.uint8 )
+    bool_arr[ doc_ids ] = 1
+    return np.packbits( bool_arr,  bitorder = "little")
+
+def bitwise_or_packed_doc_ids( packed_doc_ids_list ):
+    max_len = max( [ len(packed_doc_ids) for packed_doc_ids in packed_doc_ids_list ] )
+    res = np.zeros( max_len, dtype = np.uint8 )
+    for packed_doc_ids in packed_doc_ids_list:
+        res[ :len(packed_doc_ids) ] |= packed_doc_ids
+    return res
+
+def get_doc_length( term_freqs ):
+    ## the number of (non-stopword) tokens counted in term_freqs, i.e. the total frequency of its unigrams
+    return sum( tf for term, tf in term_freqs.items() if " " not in term )
+
+def iter_inv_idx_postings( inv_idx, inv_pos = None, inv_tf = None ):
+    """
+        ( term, sorted doc ids ) of an in-memory inv_idx, sorted by term;
+        ( term, sorted doc ids, positions or None, term frequencies or None ) if inv_pos or inv_tf is given
+    """
+    for word in sorted( inv_idx.keys() ):
+        ## the documents are processed in increasing order and each document adds a term once, so the doc ids are already sorted and unique
+        doc_ids = np.frombuffer( inv_idx[word], dtype = np.uint32 )
+        if inv_pos is None and inv_tf is None:
+            yield word, doc_ids
+            continue
+        positions = None
+        if inv_pos is not None and word in inv_pos:
+            ## the positional doc ids are a subset of doc_ids
+            pos_doc_ids, pos_counts, flat_positions = inv_pos[word]
+            counts = np.zeros( len(doc_ids), dtype = np.uint32 )
+            counts[ np.searchsorted( doc_ids, np.frombuffer( pos_doc_ids, dtype = np.uint32 ) ) ] = np.frombuffer( pos_counts, dtype = np.uint32 )
+            positions = ( counts, np.frombuffer( flat_positions, dtype = np.uint32 ) )
+        term_freqs = np.frombuffer( inv_tf[word], dtype = np.uint8 ) if inv_tf is not None else None
+        yield word, doc_ids, positions, term_freqs
 
 """
-save inv_idx (in memory) to inv_idx_on_disk
-The basic logic is to first create an inv_idx in memory, processing a few documents, 
-adding unigrams and bigrams to inv_idx, then dump the inv_idx to inv_idx_on_disk.
+SPIMI (single-pass in-memory indexing): documents are indexed in memory until the memory budget is reached,
+then the in-memory inv_idx is flushed to disk as a sorted run (a segment file) and cleared.
+At the end, all runs are k-way merged into the final index. The list of flushed runs and the next document to process
+are saved in a checkpoint file after each flush, so that an interrupted computation can be resumed from the last run.
 """
-def dump_inv_idx( inv_idx, inv_idx_on_disk, overwrite = True, key_list = None ):
-    if key_list is None:
-        key_list = inv_idx.keys()
-    for word in tqdm(key_list):
-        if overwrite or word not in inv_idx_on_disk:
-            doc_id_list = np.unique(inv_idx[word])
-            # doc_id_list.sort()  ## this is time consuming! and not really necessary..
-            inv_idx_on_disk[word] = doc_id_list
-        else:
-            doc_id_list = list(set(inv_idx_on_disk[word].tolist()+inv_idx[word].tolist()))
-            doc_id_list = np.array( doc_id_list )
-            doc_id_list.sort()
-            inv_idx_on_disk[word] = doc_id_list
+def flush_run( inv_idx, run_path, collection, doc_ids, inv_pos = None, inv_tf = None, doc_columns = {}, base_doc_id = 0 ):
+    ## doc_columns: column name ("doc_lengths", "doc_years") -> the values of doc_ids; the run is relative to base_doc_id, like the final segment
+    with InvertedIndexSegmentWriter( run_path, collection, pack_doc_ids( doc_ids, base_doc_id ), base_doc_id = base_doc_id, has_positions = inv_pos is not None, 
+                                     has_term_freqs = inv_tf is not None, **get_dense_doc_columns( doc_ids, doc_columns, base_doc_id ) ) as writer:
+        for item in iter_inv_idx_postings( inv_idx, inv_pos, inv_tf ):
+            writer.add( item[0], item[1] - np.uint32( base_doc_id ), *item[2:] )
+
+def get_dense_doc_columns( doc_ids, doc_columns, base_doc_id = 0 ):
+    ## the per document columns as arrays indexed by the doc id relative to base_doc_id
+    doc_ids = np.asarray( doc_ids, dtype = np.int64 ) - base_doc_id
+    dense_doc_columns = {}
+    for name, values in doc_columns.items():
+        dtype = DOC_COLUMN_DTYPES.get( name, np.int64 )
+        dense_doc_columns[name] = np.zeros( int( np.max( doc_ids ) ) + 1 if len(doc_ids) > 0 else 0, dtype = dtype )
+        dense_doc_columns[name][ doc_ids ] = np.minimum( np.asarray( values, dtype = np.int64 ), np.iinfo( dtype ).max )
+    return dense_doc_columns
+
+def get_doc_year( doc_data ):
+    ## the publication year of a document, 0 if unknown
+    year = str(doc_data.get("PublicationDate",{}).get("Year", "")).strip()
+    return int(year) if year.isdigit() and 0 < int(year) <= MAX_DOC_YEAR else 0
+
+def save_checkpoint( checkpoint, checkpoint_path ):
+    with open( checkpoint_path + ".tmp", "w" ) as f:
+        json.dump( checkpoint, f )
+    os.replace( checkpoint_path + ".tmp", checkpoint_path )
+
+def load_checkpoint( checkpoint_path, checkpoint_info ):
+    ## return the saved checkpoint if it belongs to the same computation (the same collection, document range and format) and all its runs exist
+    try:
+        with open( checkpoint_path, "r" ) as f:
+            checkpoint = json.load( f )
+        assert all( checkpoint[key] == value for key, value in checkpoint_info.items() )
+        assert all( os.path.exists( run_path ) for run_path in checkpoint["runs"] )
+        return checkpoint
+    except:
+        return None
+
+"""
+save the merged postings ( term, sorted doc ids ) to inv_idx_on_disk (SqliteDict, legacy format)
+"""
+def dump_postings( postings, inv_idx_on_disk, overwrite = True, commit_per_num_of_keys = 10000000 ):
+    num_keys = 0
+    for word, doc_id_list in tqdm( postings ):
+        if not overwrite and word in inv_idx_on_disk:
+            doc_id_list = np.unique( np.concatenate( [ inv_idx_on_disk[word], doc_id_list ] ) )
+        inv_idx_on_disk[word] = doc_id_list
+        num_keys += 1
+        if num_keys % commit_per_num_of_keys == 0:
+            inv_idx_on_disk.commit()
+            print("Number of stored keys:", num_keys )
+    inv_idx_on_disk.commit()
+    print("Number of stored keys:", num_keys )
+
+"""
+save the merged postings as an immutable segment file (see modules/ranking/segment.py).
+If overwrite is False and the segment already exists, the old postings are merged in.
+If has_positions or has_term_freqs, the postings are ( term, sorted doc ids, positions, term frequencies ) and the positions and/or
+the term frequencies are saved as well. packed_doc_ids and dense_doc_columns (the per document columns "doc_lengths", "doc_years")
+are relative to base_doc_id, a multiple of 8; the postings have absolute doc ids.
+"""
+def dump_postings_to_segment( postings, segment_path, collection, packed_doc_ids, overwrite = True, base_doc_id = 0, has_positions = False,
+                              has_term_freqs = False, dense_doc_columns = {} ):
+    if not overwrite and os.path.exists( segment_path ):
+        existing_segment = InvertedIndexSegment( segment_path )
+        ## the merged segment starts at the smaller one of the two base doc ids
+        merged_base_doc_id = min( base_doc_id, existing_segment.base_doc_id )
+        shift = base_doc_id - merged_base_doc_id
+        packed_doc_ids = bitwise_or_packed_doc_ids( [ pack_doc_ids( existing_segment.get_doc_ids(), merged_base_doc_id ),
+                                                      np.concatenate( [ np.zeros( shift // 8, dtype = np.uint8 ), packed_doc_ids ] ) ] )
+        postings = merge_sorted_postings( existing_segment.items( with_payloads = has_positions or has_term_freqs ), postings )
+        merged_doc_columns = {}
+        for name, dense_values in dense_doc_columns.items():
+            merged_doc_columns[name] = np.zeros( len(packed_doc_ids) * 8, dtype = dense_values.dtype )
+            existing_column = existing_segment.get_doc_column( name )
+            if existing_column is not None:
+                merged_doc_columns[name][ existing_column[0].astype( np.int64 ) - merged_base_doc_id ] = existing_column[1]
+            ## the newly indexed documents override the old ones
+            new_doc_ids = np.flatnonzero( dense_values )
+            merged_doc_columns[name][ new_doc_ids + shift ] = dense_values[ new_doc_ids ]
+        dense_doc_columns = merged_doc_columns
+        base_doc_id = merged_base_doc_id
+    else:
+        existing_segment = None
+        
+    with InvertedIndexSegmentWriter( segment_path, collection, packed_doc_ids, base_doc_id = base_doc_id, has_positions = has_positions,
+                                     has_term_freqs = has_term_freqs, **dense_doc_columns ) as writer:
+        for item in tqdm( postings ):
+            writer.add( item[0], np.asarray( item[1], dtype = np.uint32 ) - np.uint32( base_doc_id ), *item[2:] )
+    
+    if existing_segment is not None:
+        existing_segment.close()
             
 
 def get_unigrams( word_list, stopwords ):
@@ -69,8 +224,31 @@ def get_sentence_list_from_parsed( parsed ):
                 sentence_list.append( str(sen.get("sentence_text","")) )
     return sentence_list
 
-def parse_document( doc_data, sent_tokenizer, stopwords ):
+def add_term_positions( term_positions, word_list, stopwords, start_position ):
+    ## record the positions of the (non-stopword) words, return the position after word_list
+    for pos, w in enumerate( word_list ):
+        if w not in stopwords:
+            term_positions.setdefault( w, [] ).append( start_position + pos )
+    return start_position + len(word_list) + POSITION_GAP
+
+def count_ngrams( term_freqs, word_list, stopwords ):
+    ## count the occurrences of the unigrams and bigrams of word_list (the same ones as get_unigrams() and get_bigrams())
+    for pos, w in enumerate( word_list ):
+        if w not in stopwords:
+            term_freqs[w] = term_freqs.get( w, 0 ) + 1
+            if pos + 1 < len(word_list) and word_list[pos+1] not in stopwords:
+                bigram = w + " " + word_list[pos+1]
+                term_freqs[bigram] = term_freqs.get( bigram, 0 ) + 1
+
+def parse_document( doc_data, sent_tokenizer, stopwords, term_positions = None, term_freqs = None ):
+    """
+        Return the set of ngrams of the document.
+        If term_positions (a dict) is given, the token positions of the unigrams in the title, the abstract and the fullbody are added to it
+        If term_freqs (a dict) is given, the number of occurrences of the plain unigrams and bigrams in the author names, the title, the venue,
+        the abstract and the fullbody are added to it
+    """
     ngram_set = set()
+    position = 0
     
     ## Author
     for author in doc_data.get("Author", []):
@@ -96,6 +274,8 @@ def parse_document( doc_data, sent_tokenizer, stopwords ):
             ngram_set.update( get_bigrams( word_list, stopwords ) )
             ## get reversed bigrams
             ngram_set.update( get_bigrams( list(reversed(word_list)), stopwords ) )
+            if term_freqs is not None:
+                count_ngrams( term_freqs, word_list, stopwords )
     if len(doc_data.get("Author", [])) > 0:
         ngram_set.add( "AvailableField:Author" )
         
@@ -113,6 +293,10 @@ def parse_document( doc_data, sent_tokenizer, stopwords ):
         ngram_set.update( [ "Title:"+word for word in bigrams ] )
         
         ngram_set.add( "AvailableField:Title" )
+        if term_positions is not None:
+            position = add_term_positions( term_positions, word_list, stopwords, position )
+        if term_freqs is not None:
+            count_ngrams( term_freqs, word_list, stopwords )
     
     ## Venue    
     venue = sent_tokenizer.tokenize( str(doc_data.get("Venue", ""))).strip()
@@ -128,6 +312,8 @@ def parse_document( doc_data, sent_tokenizer, stopwords ):
         ngram_set.update( ["Venue:"+word for word in bigrams] )
         
         ngram_set.add( "AvailableField:Venue" )
+        if term_freqs is not None:
+            count_ngrams( term_freqs, word_list, stopwords )
     
     ## DOI
     doi = str(doc_data.get("DOI","")).lower().strip()
@@ -164,6 +350,10 @@ def parse_document( doc_data, sent_tokenizer, stopwords ):
             ngram_set.update( get_unigrams( word_list, stopwords ) )
             ## get bigrams
             ngram_set.update( get_bigrams( word_list, stopwords ) )
+            if term_positions is not None:
+                position = add_term_positions( term_positions, word_list, stopwords, position )
+            if term_freqs is not None:
+                count_ngrams( term_freqs, word_list, stopwords )
     
     
     ## Others, not mandatory, varies on different collections
@@ -174,6 +364,15 @@ def parse_document( doc_data, sent_tokenizer, stopwords ):
     
     return ngram_set
 
+def get_empty_doc_columns( args ):
+    ## the per document columns stored in the segments: the publication years, and the document lengths if the term frequencies are indexed
+    doc_columns = {}
+    if args.index_format == "segment":
+        doc_columns["doc_years"] = array.array( "H" )
+    if args.index_term_frequencies:
+        doc_columns["doc_lengths"] = array.array( "I" )
+    return doc_columns
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-db_address")
@@ -184,10 +383,26 @@ if __name__ == "__main__":
     parser.add_argument("-overwrite", type = int, default = 1)
     parser.add_argument("-start", type = int, default = 0)
     parser.add_argument("-size", type = int, default = 0)
+    ## "segment": immutable mmapped segment file; "sqlitedict": SqliteDict of pickled numpy arrays (legacy format)
+    parser.add_argument("-index_format", default = "segment", choices = [ "segment", "sqlitedict" ])
+    ## when the in-memory inverted index reaches this size, it is flushed to disk as a sorted run
+    parser.add_argument("-memory_budget_mb", type = float, default = 4096)
+    ## resume from the checkpoint of an interrupted computation of the same shard, if any
+    parser.add_argument("-resume", type = int, default = 1)
+    ## also store the token positions of the unigrams (segment format only), they are needed to verify exact phrase queries
+    parser.add_argument("-index_positions", type = int, default = 0)
+    ## also store the term frequencies and the document lengths (segment format only), they are needed for BM25 ranking
+    parser.add_argument("-index_term_frequencies", type = int, default = 0)
     
     args = parser.parse_args()
 
     args.inv_idx_file_name += args.inv_idx_file_name_suffix
+    if args.index_positions and args.index_format != "segment":
+        print("Warning: positions are only supported by the segment format, they are not indexed")
+        args.index_positions = 0
+    if args.index_term_frequencies and args.index_format != "segment":
+        print("Warning: term frequencies are only supported by the segment format, they are not indexed")
+        args.index_term_frequencies = 0
     inv_idx_folder = os.path.dirname( args.inv_idx_file_name )
     if not os.path.exists( inv_idx_folder ):
         os.makedirs( inv_idx_folder )
@@ -196,17 +411,34 @@ if __name__ == "__main__":
     stopwords = set( sent_tokenizer.general_stopwords )
     sqlite_client = SqliteClient(db_address= args.db_address )
 
-    all_doc_ids = set()
-
-    print("Computing inverted index in ram...")
-    
     max_rowid = sqlite_client.get_max_rowid( args.collection )
     if args.size == 0:
         args.size = max_rowid 
     end = min( args.start + args.size, max_rowid)
     
-    inv_idx_in_ram = {}        
-    for count in tqdm(range( args.start, end )):
+    run_path_prefix = args.inv_idx_file_name + ".run_"
+    checkpoint_path = args.inv_idx_file_name + ".checkpoint.json"
+    ## the runs and the segment only cover the doc ids from the start of this document range (aligned to the bitmap chunk size),
+    ## so that their bitmaps and per document columns do not grow with the absolute doc ids
+    base_doc_id = ( args.start + 1 ) // CHUNK_SIZE * CHUNK_SIZE
+    checkpoint_info = { "collection":args.collection, "start":args.start, "end":end, "index_format":args.index_format, "index_positions":args.index_positions,
+                        "index_term_frequencies":args.index_term_frequencies, "base_doc_id":base_doc_id }
+    checkpoint = load_checkpoint( checkpoint_path, checkpoint_info ) if args.resume else None
+    if checkpoint is None:
+        checkpoint = dict( checkpoint_info, next_doc_pos = args.start, runs = [] )
+    else:
+        print("Resuming from the checkpoint: %d runs flushed, continuing from document %d"%( len(checkpoint["runs"]), checkpoint["next_doc_pos"] ))
+    memory_budget = args.memory_budget_mb * 1024**2
+
+    print("Computing inverted index in ram...")
+    
+    inv_idx_in_ram = {}
+    inv_pos_in_ram = {} if args.index_positions else None
+    inv_tf_in_ram = {} if args.index_term_frequencies else None
+    inv_idx_in_ram_nbytes = 0
+    doc_ids_in_ram = array.array( "I" )
+    doc_columns_in_ram = get_empty_doc_columns( args )
+    for count in tqdm(range( checkpoint["next_doc_pos"], end )):
         
         doc_id = count + 1
         paper_info = sqlite_client.get_papers( [{"collection":args.collection,"id_field":"id_int", "id_value":doc_id }] )[0]
@@ -214,42 +446,79 @@ if __name__ == "__main__":
         if paper_info is None or not paper_info.get("RequireIndexing", True):
             continue
         
-        ngram_set = parse_document( paper_info, sent_tokenizer, stopwords )
-        add_ngrams( inv_idx_in_ram, ngram_set, doc_id )
+        term_positions = {} if args.index_positions else None
+        term_freqs = {} if args.index_term_frequencies else None
+        ngram_set = parse_document( paper_info, sent_tokenizer, stopwords, term_positions, term_freqs )
+        inv_idx_in_ram_nbytes += add_ngrams( inv_idx_in_ram, ngram_set, doc_id, inv_tf_in_ram, term_freqs )
+        if args.index_positions:
+            inv_idx_in_ram_nbytes += add_positions( inv_pos_in_ram, term_positions, doc_id )
+        doc_ids_in_ram.append(doc_id)
+        if "doc_lengths" in doc_columns_in_ram:
+            doc_columns_in_ram["doc_lengths"].append( min( get_doc_length( term_freqs ), 2**32 - 1 ) )
+        if "doc_years" in doc_columns_in_ram:
+            doc_columns_in_ram["doc_years"].append( get_doc_year( paper_info ) )
+        inv_idx_in_ram_nbytes += doc_ids_in_ram.itemsize + sum( column.itemsize for column in doc_columns_in_ram.values() )
 
-        all_doc_ids.add(doc_id)
+        if inv_idx_in_ram_nbytes >= memory_budget:
+            run_path = run_path_prefix + str( len(checkpoint["runs"]) )
+            print("Memory budget reached, flushing %d keys to %s"%( len(inv_idx_in_ram), run_path ))
+            flush_run( inv_idx_in_ram, run_path, args.collection, doc_ids_in_ram, inv_pos_in_ram, inv_tf_in_ram, doc_columns_in_ram, base_doc_id )
+            checkpoint["runs"].append( run_path )
+            checkpoint["next_doc_pos"] = count + 1
+            save_checkpoint( checkpoint, checkpoint_path )
+            
+            inv_idx_in_ram = {}
+            inv_pos_in_ram = {} if args.index_positions else None
+            inv_tf_in_ram = {} if args.index_term_frequencies else None
+            inv_idx_in_ram_nbytes = 0
+            doc_ids_in_ram = array.array( "I" )
+            doc_columns_in_ram = get_empty_doc_columns( args )
 
-    key_list = list( inv_idx_in_ram.keys() )
-    total_num_keys = len(key_list)
-    print("Total number of keys:",total_num_keys )
-    
+    runs = [ InvertedIndexSegment( run_path ) for run_path in checkpoint["runs"] ]
+    ## relative to base_doc_id, like the runs
+    packed_doc_ids_list = [ run["INFO:PACKED_DOC_IDS"] for run in runs ]
+    if len(doc_ids_in_ram) > 0:
+        packed_doc_ids_list.append( pack_doc_ids( doc_ids_in_ram, base_doc_id ) )
+    print("Total number of runs:", len(runs), "number of keys in ram:", len(inv_idx_in_ram) )
     
-    if total_num_keys > 0:
-
-        print("Dumping inverted index on disk ...")
-        inv_idx_on_disk = SqliteDict(args.inv_idx_file_name, journal_mode = "OFF")
+    if len(packed_doc_ids_list) > 0:
 
-        all_doc_ids = np.array(list( all_doc_ids ))
-    
-        bool_arr = np.zeros( np.max(all_doc_ids) +1, dtype = np.uint8 )
-        bool_arr[ all_doc_ids ] = 1
-    
-        packed_doc_ids = np.packbits( bool_arr,  bitorder = "little")
+        print("Merging runs and dumping inverted index on disk ...")
 
-        for start_pos in range( 0, total_num_keys, args.commit_per_num_of_keys ):
-            dump_inv_idx( inv_idx_in_ram, inv_idx_on_disk, args.overwrite , key_list[  start_pos : start_pos+args.commit_per_num_of_keys ]  )
-            inv_idx_on_disk.commit()
-            print("Number of stored keys:", min( start_pos+args.commit_per_num_of_keys, total_num_keys  ) )
+        packed_doc_ids = bitwise_or_packed_doc_ids( packed_doc_ids_list )
+        postings = merge_sorted_postings( *[ run.items( with_payloads = bool( args.index_positions or args.index_term_frequencies ) ) for run in runs ], 
+                                          iter_inv_idx_postings( inv_idx_in_ram, inv_pos_in_ram, inv_tf_in_ram ) )
 
+        if args.index_format == "segment":
+            ## the runs cover disjoint documents
+            dense_doc_columns = {}
+            for name in doc_columns_in_ram:
+                run_columns = [ run.get_doc_column( name ) for run in runs ]
+                dense_doc_columns.update( get_dense_doc_columns( np.concatenate( [ doc_ids for doc_ids, _ in run_columns ] + [ np.array( doc_ids_in_ram, dtype = np.uint32 ) ] ),
+                                                                 { name: np.concatenate( [ values for _, values in run_columns ] + [ np.array( doc_columns_in_ram[name], dtype = np.int64 ) ] ) },
+                                                                 base_doc_id ) )
+            dump_postings_to_segment( postings, args.inv_idx_file_name, args.collection, packed_doc_ids, args.overwrite, base_doc_id, bool(args.index_positions),
+                                      bool(args.index_term_frequencies), dense_doc_columns )
+        else:
+            inv_idx_on_disk = SqliteDict(args.inv_idx_file_name, journal_mode = "OFF")
+            dump_postings( postings, inv_idx_on_disk, args.overwrite, args.commit_per_num_of_keys )
 
-        ## Add some INFO:XXX keys at last to make sure that they are not overwritten!
-        inv_idx_on_disk["INFO:PACKED_DOC_IDS"] = packed_doc_ids
-        inv_idx_on_disk["INFO:COLLECTION"] = args.collection
-        inv_idx_on_disk.commit()
-        
+            ## Add some INFO:XXX keys at last to make sure that they are not overwritten! The SqliteDict shards have absolute packed doc ids
+            packed_doc_ids = np.concatenate( [ np.zeros( base_doc_id // 8, dtype = np.uint8 ), packed_doc_ids ] )
+            if not args.overwrite and "INFO:PACKED_DOC_IDS" in inv_idx_on_disk:
+                packed_doc_ids = bitwise_or_packed_doc_ids( [ inv_idx_on_disk["INFO:PACKED_DOC_IDS"], packed_doc_ids ] )
+            inv_idx_on_disk["INFO:PACKED_DOC_IDS"] = packed_doc_ids
+            inv_idx_on_disk["INFO:COLLECTION"] = args.collection
+            inv_idx_on_disk.commit()
+            inv_idx_on_disk.close()
             
-        inv_idx_in_ram.clear()
-        inv_idx_in_ram = {}
-        inv_idx_on_disk.close()
         print("Processed documents:", end-args.start )
-        print("Inverted Index Computation Complete!")
\ No newline at end of file
+        print("Inverted Index Computation Complete!")
+    
+    ## the final index is complete, the runs and the checkpoint are no longer needed
+    for run in runs:
+        run.close()
+    for run_path in checkpoint["runs"]:
+        os.remove( run_path )
+    if os.path.exists( checkpoint_path ):
+        os.remove( checkpoint_path )
@@ -0,0 +1,151 @@
+import os
+from glob import glob
+import numpy as np
+from tqdm import tqdm
+import argparse
+
+from sqlitedict import SqliteDict
+from modules.ranking.segment import InvertedIndexSegment, InvertedIndexSegmentWriter, merge_sorted_postings, is_segment_file, slice_payloads
+from modules.ranking.bitmap import CHUNK_SIZE
+
+
+"""
+Merge the per-process inverted index shards (inverted_index.db_N, each covering the documents of one process)
+into a given number of serving segments with contiguous doc id ranges.
+Each serving segment stores its postings and packed doc ids relative to its base doc id, so that it does not carry
+a zero-padded bitmap of the doc ids below its range. The base doc ids are multiples of the bitmap chunk size (2^16),
+so that the query results of the segments can be shifted back to absolute doc ids for free.
+"""
+
+def open_shard( shard_path ):
+    if is_segment_file( shard_path ):
+        return InvertedIndexSegment( shard_path )
+    return SqliteDict( shard_path, journal_mode = "OFF" )
+
+def get_shard_doc_ids( shard ):
+    if isinstance( shard, InvertedIndexSegment ):
+        return shard.get_doc_ids()
+    return np.flatnonzero( np.unpackbits( shard["INFO:PACKED_DOC_IDS"], bitorder = "little" ) ).astype( np.uint32 )
+
+def has_positions( shard ):
+    return isinstance( shard, InvertedIndexSegment ) and shard.has_positions
+
+def has_term_freqs( shard ):
+    return isinstance( shard, InvertedIndexSegment ) and shard.has_term_freqs
+
+def iter_shard_items( shard, with_payloads = False ):
+    ## ( term, absolute doc ids ) sorted by term; ( term, absolute doc ids, positions or None, term frequencies or None ) if with_payloads
+    if isinstance( shard, InvertedIndexSegment ):
+        for item in shard.items( with_payloads = with_payloads ):
+            yield item
+    else:
+        ## sqlite compares TEXT keys bytewise, which is the same order as the utf-8 order of the segments
+        GET_ITEMS = 'SELECT key, value FROM "%s" ORDER BY key'%( shard.tablename )
+        for key, value in shard.conn.select( GET_ITEMS ):
+            if key.startswith("INFO:"):
+                continue
+            if with_payloads:
+                yield key, np.asarray( shard.decode( value ) ), None, None
+            else:
+                yield key, np.asarray( shard.decode( value ) )
+
+def iter_range_items( shard, lo, hi, with_payloads = False ):
+    ## the postings of a shard restricted to the doc ids in [lo, hi)
+    for item in iter_shard_items( shard, with_payloads ):
+        term, doc_ids = item[:2]
+        start, end = np.searchsorted( doc_ids, [ lo, hi ] )
+        if end > start:
+            if not with_payloads:
+                yield term, doc_ids[start:end]
+            else:
+                yield slice_payloads( item, start, end )
+
+def has_doc_years( shard ):
+    return isinstance( shard, InvertedIndexSegment ) and shard.has_doc_years
+
+def get_range_doc_column( shards, name, lo, hi ):
+    ## a per document column ("doc_lengths" or "doc_years") of the shards indexed by the doc id relative to lo, for the doc ids in [lo, hi)
+    values = np.zeros( hi - lo, dtype = np.int64 )
+    for shard in shards:
+        column = shard.get_doc_column( name ) if isinstance( shard, InvertedIndexSegment ) else None
+        if column is not None:
+            doc_ids, shard_values = column
+            in_range = ( doc_ids >= lo ) & ( doc_ids < hi )
+            values[ doc_ids[in_range].astype( np.int64 ) - lo ] = shard_values[in_range]
+    return values
+
+def get_segment_ranges( doc_ids, num_segments ):
+    """
+        Split the sorted doc ids into num_segments contiguous ranges [lo, hi) with about the same number of documents.
+        The boundaries are aligned to the bitmap chunk size, so tiny collections can end up with fewer segments.
+    """
+    boundaries = [0]
+    for count in range( 1, num_segments ):
+        boundary = int( doc_ids[ count * len(doc_ids) // num_segments ] ) // CHUNK_SIZE * CHUNK_SIZE
+        if boundary > boundaries[-1]:
+            boundaries.append( boundary )
+    boundaries.append( int(doc_ids[-1]) + 1 )
+    return list( zip( boundaries[:-1], boundaries[1:] ) )
+
+def merge_shards_into_segment( shards, shard_doc_ids, segment_path, collection, lo, hi ):
+    """
+        Write the documents of the shards within the doc id range [lo, hi) into one segment with base doc id lo.
+        shard_doc_ids: the (sorted, absolute) doc ids indexed in each shard
+    """
+    ## only the shards having documents within [lo, hi) are read
+    overlapping_shards = [ shard for shard, doc_ids in zip( shards, shard_doc_ids )
+                            if len(doc_ids) > 0 and doc_ids[0] < hi and doc_ids[-1] >= lo ]
+
+    all_doc_ids = np.unique( np.concatenate( [ np.zeros( 0, dtype = np.uint32 ) ] + list( shard_doc_ids ) ) )
+    doc_ids = all_doc_ids[ ( all_doc_ids >= lo ) & ( all_doc_ids < hi ) ] - lo
+    bool_arr = np.zeros( int(doc_ids[-1]) + 1 if len(doc_ids) > 0 else 0, dtype = np.uint8 )
+    bool_arr[ doc_ids ] = 1
+    packed_doc_ids = np.packbits( bool_arr, bitorder = "little" )
+
+    ## the positions (term frequencies) are kept if any of the shards has positions (term frequencies)
+    with_positions = any( has_positions( shard ) for shard in overlapping_shards )
+    with_term_freqs = any( has_term_freqs( shard ) for shard in overlapping_shards )
+    doc_lengths = get_range_doc_column( overlapping_shards, "doc_lengths", lo, hi ) if with_term_freqs else None
+    doc_years = get_range_doc_column( overlapping_shards, "doc_years", lo, hi ) if any( has_doc_years( shard ) for shard in overlapping_shards ) else None
+    postings = merge_sorted_postings( *[ iter_range_items( shard, lo, hi, with_positions or with_term_freqs ) for shard in overlapping_shards ] )
+    with InvertedIndexSegmentWriter( segment_path, collection, packed_doc_ids, base_doc_id = lo, has_positions = with_positions,
+                                     has_term_freqs = with_term_freqs, doc_lengths = doc_lengths, doc_years = doc_years ) as writer:
+        for item in tqdm( postings ):
+            writer.add( item[0], ( np.asarray( item[1], dtype = np.int64 ) - lo ).astype( np.uint32 ), *item[2:] )
+    return len(doc_ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-inv_idx_folder" )
+    parser.add_argument("-output_folder" )
+    parser.add_argument("-inv_idx_name_prefix", default = "inverted_index.db_" )
+    parser.add_argument("-num_segments", type = int )
+
+    args = parser.parse_args()
+
+    shard_names = glob( args.inv_idx_folder + "/" + args.inv_idx_name_prefix + "*" )
+    shard_names = [ name for name in shard_names if name.split("_")[-1].isdigit() ]
+    shard_names.sort( key = lambda x:int(x.split("_")[-1]) )
+    assert len(shard_names) > 0
+
+    shards = [ open_shard( name ) for name in shard_names ]
+    collection = shards[0]["INFO:COLLECTION"]
+    shard_doc_ids = [ get_shard_doc_ids( shard ) for shard in shards ]
+    all_doc_ids = np.unique( np.concatenate( shard_doc_ids ) )
+    assert len(all_doc_ids) > 0
+
+    if not os.path.exists( args.output_folder ):
+        os.makedirs( args.output_folder )
+
+    segment_ranges = get_segment_ranges( all_doc_ids, args.num_segments )
+    print("Merging %d shards into %d segments ..."%( len(shards), len(segment_ranges) ))
+
+    for count, ( lo, hi ) in enumerate( segment_ranges ):
+        segment_path = args.output_folder + "/" + args.inv_idx_name_prefix + str( count )
+        num_docs = merge_shards_into_segment( shards, shard_doc_ids, segment_path, collection, lo, hi )
+        print("Segment %s: doc ids [%d, %d), %d documents"%( segment_path, lo, hi, num_docs ))
+
+    for shard in shards:
+        shard.close()
+    print("All Done!")
@@ -16,6 +16,9 @@ from tqdm import tqdm
 
 import time
 from modules.service_utils.utils import wait_for_service
+from merge_inverted_index import merge_shards_into_segment, open_shard, get_shard_doc_ids
+from modules.ranking.bitmap import CHUNK_SIZE
+from modules.ranking.embedding_index import EmbeddingIndexShard, PosToDocIdMapper, save_embedding_index, remove_embedding_index
             
 # Make Flask application
 app = Flask(__name__)
@@ -25,6 +28,14 @@ CORS(app)
 ROOT_DATA_PATH = os.getenv("ROOT_DATA_PATH")
 SERVICE_SUFFIX = os.getenv("SERVICE_SUFFIX")
 NUM_EMBEDDING_INDEX_SHARDS = int(os.getenv("NUM_EMBEDDING_INDEX_SHARDS"))
+SENT2VEC_MODEL_PATH = os.getenv("SENT2VEC_MODEL_PATH")
+## the delta segments of the inverted index (and the delta shards of the embedding index) are compacted into one as soon as there are more than this number of them
+MAX_NUM_INVERTED_INDEX_DELTA_SEGMENTS = int(os.getenv("MAX_NUM_INVERTED_INDEX_DELTA_SEGMENTS", 8))
+MAX_NUM_EMBEDDING_INDEX_DELTA_SHARDS = int(os.getenv("MAX_NUM_EMBEDDING_INDEX_DELTA_SHARDS", 8))
+INDEX_POSITIONS = int(os.getenv("INDEX_POSITIONS", 0))
+INDEX_TERM_FREQUENCIES = int(os.getenv("INDEX_TERM_FREQUENCIES", 0))
+## approximate nearest neighbor search of the ranking service on CPU: "scann" or "hnsw"
+ANN_BACKEND = os.getenv("ANN_BACKEND", "scann")
 
 
 ADDRESS_SERVICE_PAPER_DATABASE = f"http://document_prefetch_service_paper_database_{SERVICE_SUFFIX}:8060"
@@ -164,8 +175,226 @@ def adjust_num_shards_for_embedding_index():
                      "-embedding_index_name_prefix", "embedding_index.db_",
                      "-num_shards", str( NUM_EMBEDDING_INDEX_SHARDS )
                     ] )
+    build_ann_indices( ROOT_DATA_PATH + "/ranking/embedding_index/", "embedding_index.db_" )
+
+
+def build_ann_indices( embedding_index_folder, embedding_index_name_prefix ):
+    ## the ScaNN searchers or the HNSW graphs of the shards, built here so that the ranking service only loads them
+    subprocess.run( ["python", "build_hnsw_indices.py" if ANN_BACKEND == "hnsw" else "build_scann_searchers.py",
+                     "-embedding_index_folder", embedding_index_folder,
+                     "-embedding_index_name_prefix", embedding_index_name_prefix
+                    ] )
             
 
+def post_to_ranking_service( route, request_info ):
+    wait_for_service( ADDRESS_SERVICE_RANKING )
+    try:
+        res = requests.post( ADDRESS_SERVICE_RANKING + route, 
+                   data = json.dumps( request_info ), 
+                   headers = {"Content-Type":"application/json"} ).json()["response"]
+        print(res)
+        return res["success"]
+    except:
+        print("fail")
+        return 0
+
+
+def index_new_documents( id_start, id_end ):
+    """
+        Index the papers with id_int in [id_start, id_end] (already inserted into the sqlite database) without rebuilding the whole index:
+        the new papers get their own delta segment of the inverted index and their own embedding shard, 
+        which are attached to the running ranking service. They are also added to the duplicate checking database.
+    """
+    global args
+    
+    paper_db = SqliteClient( args.sqlite_database_path )
+    assert len(paper_db.collections) == 1
+    collection = list(paper_db.collections)[0]
+    
+    ## row offset of compute_*.py: the document with id_int = start + 1 is the first one
+    start, size = id_start - 1, id_end - id_start + 1
+    suffix = "_delta_%d_%d"%( id_start, id_end )
+    
+    delta_buffer_folder = ROOT_DATA_PATH + "/ranking_delta_buffer"
+    try:
+        shutil.rmtree( delta_buffer_folder )
+    except:
+        pass
+    os.makedirs( delta_buffer_folder + "/inverted_index" )
+    os.makedirs( delta_buffer_folder + "/embedding_index" )
+    
+    subprocess.run( ["python", "compute_inverted_index.py",
+                     "-db_address", args.sqlite_database_path,
+                     "-collection", collection,
+                     "-inv_idx_file_name", delta_buffer_folder + "/inverted_index/inverted_index.db",
+                     "-inv_idx_file_name_suffix", suffix,
+                     "-resume", "0",
+                     "-index_positions", str( INDEX_POSITIONS ),
+                     "-index_term_frequencies", str( INDEX_TERM_FREQUENCIES ),
+                     "-start", str( start ),
+                     "-size", str( size )
+                    ], check = True )
+    subprocess.run( ["python", "compute_embedding.py",
+                     "-db_address", args.sqlite_database_path,
+                     "-collection", collection,
+                     "-embedding_file_name", delta_buffer_folder + "/embedding_index/embedding_index.db",
+                     "-embedding_file_name_suffix", suffix,
+                     "-text_encoder_model_path", SENT2VEC_MODEL_PATH,
+                     "-start", str( start ),
+                     "-size", str( size )
+                    ], check = True )
+    build_ann_indices( delta_buffer_folder + "/embedding_index/", "embedding_index.db" + suffix )
+    
+    ## the files are moved into the serving folders only when they are complete
+    inv_idx_shard = "inverted_index.db" + suffix
+    embedding_shard = "embedding_index.db" + suffix
+    ## (compute_embedding.py writes no file if none of the papers requires indexing)
+    for index_name, shard, route in [ ( "inverted_index", inv_idx_shard, "/update-inverted-index" ),
+                                      ( "embedding_index", embedding_shard, "/update-ranking-index" ) ]:
+        if not os.path.exists( delta_buffer_folder + "/" + index_name + "/" + shard ):
+            continue
+        shutil.move( delta_buffer_folder + "/" + index_name + "/" + shard, ROOT_DATA_PATH + "/ranking/" + index_name + "/" + shard )
+        post_to_ranking_service( route, { "shards":[ shard ], "action":"attach" } )
+    shutil.rmtree( delta_buffer_folder )
+
+    ## the duplicate check of new uploads (MD5, DOI, title) and the metadata search go through fast metadata search,
+    ## so the new papers are appended to its database, which is then reloaded
+    subprocess.run( ["python", "build_duplicate_checking_database.py",
+                     "-db_address", args.sqlite_database_path,
+                     "-duplicate_checking_database_path", ROOT_DATA_PATH + "/duplicate_checking/data.db",
+                     "-overwrite", "0",
+                     "-start", str( start ),
+                     "-size", str( size )
+                    ], check = True )
+    wait_for_service( ADDRESS_SERVICE_FAST_METADATA_SEARCH )
+    print("Rebooting fast metadata search service ...")
+    try:
+        print(requests.post( ADDRESS_SERVICE_FAST_METADATA_SEARCH + "/reboot",
+               data = json.dumps({}),
+               headers = {"Content-Type":"application/json"} ).json()["response"])
+    except:
+        print("fail")
+
+
+def get_delta_segment_range( shard_name ):
+    ## inverted_index.db_delta_<id_start>_<id_end>
+    return tuple( map( int, shard_name.split("_")[-2:] ) )
+
+
+def compact_inverted_index_delta_segments():
+    inv_idx_folder = ROOT_DATA_PATH + "/ranking/inverted_index/"
+    delta_shards = [ os.path.basename( name ) for name in glob( inv_idx_folder + "inverted_index.db_delta_*" ) if name.split("_")[-1].isdigit() ]
+    if len( delta_shards ) <= MAX_NUM_INVERTED_INDEX_DELTA_SEGMENTS:
+        return
+    print("Compacting %d delta segments of the inverted index ..."%( len(delta_shards) ))
+    delta_shards.sort( key = get_delta_segment_range )
+    
+    shards = [ open_shard( inv_idx_folder + name ) for name in delta_shards ]
+    shard_doc_ids = [ get_shard_doc_ids( shard ) for shard in shards ]
+    all_doc_ids = np.concatenate( shard_doc_ids )
+    if len(all_doc_ids) > 0:
+        lo = int( all_doc_ids.min() ) // CHUNK_SIZE * CHUNK_SIZE
+        hi = int( all_doc_ids.max() ) + 1
+    else:
+        lo, hi = 0, 0
+    
+    compacted_shard = "inverted_index.db_delta_%d_%d"%( get_delta_segment_range( delta_shards[0] )[0], get_delta_segment_range( delta_shards[-1] )[1] )
+    ## the ranking service skips the .tmp files, so it never opens a partially written segment
+    merge_shards_into_segment( shards, shard_doc_ids, inv_idx_folder + compacted_shard + ".tmp", shards[0]["INFO:COLLECTION"], lo, hi )
+    for shard in shards:
+        shard.close()
+    os.replace( inv_idx_folder + compacted_shard + ".tmp", inv_idx_folder + compacted_shard )
+    
+    if post_to_ranking_service( "/update-inverted-index", { "shards":[ compacted_shard ], "replaced_shards":delta_shards, "action":"replace" } ):
+        for name in delta_shards:
+            os.remove( inv_idx_folder + name )
+    else:
+        ## keep the old delta segments, otherwise the running ranking service would lose them
+        os.remove( inv_idx_folder + compacted_shard )
+
+
+def compact_embedding_index_delta_shards():
+    embedding_index_folder = ROOT_DATA_PATH + "/ranking/embedding_index/"
+    delta_shards = [ os.path.basename( name ) for name in glob( embedding_index_folder + "embedding_index.db_delta_*" ) if name.split("_")[-1].isdigit() ]
+    if len( delta_shards ) <= MAX_NUM_EMBEDDING_INDEX_DELTA_SHARDS:
+        return
+    print("Compacting %d delta shards of the embedding index ..."%( len(delta_shards) ))
+    delta_shards.sort( key = get_delta_segment_range )
+    compacted_shard = "embedding_index.db_delta_%d_%d"%( get_delta_segment_range( delta_shards[0] )[0], get_delta_segment_range( delta_shards[-1] )[1] )
+    
+    ## the compacted shard and its searcher are built in a buffer folder, so that a restarting ranking service never loads it together with the old shards
+    compaction_buffer_folder = ROOT_DATA_PATH + "/ranking_compaction_buffer"
+    shutil.rmtree( compaction_buffer_folder, ignore_errors = True )
+    os.makedirs( compaction_buffer_folder )
+    embedding_shards = [ EmbeddingIndexShard( embedding_index_folder + name ) for name in delta_shards ]
+    save_embedding_index( compaction_buffer_folder + "/" + compacted_shard,
+                          np.concatenate( [ shard.embedding_matrix for shard in embedding_shards ], axis = 0 ),
+                          PosToDocIdMapper.concatenate( [ shard.pos_to_doc_id_mapper for shard in embedding_shards ] ) )
+    embedding_shards = []
+    build_ann_indices( compaction_buffer_folder, compacted_shard )
+    shutil.move( compaction_buffer_folder + "/" + compacted_shard, embedding_index_folder + compacted_shard )
+    shutil.rmtree( compaction_buffer_folder )
+    
+    ## the old shards are detached first, otherwise the new papers would be returned twice in between
+    if not post_to_ranking_service( "/update-ranking-index", { "shards":delta_shards, "action":"detach" } ):
+        remove_embedding_index( embedding_index_folder + compacted_shard )
+        return
+    if post_to_ranking_service( "/update-ranking-index", { "shards":[ compacted_shard ], "action":"attach" } ):
+        for name in delta_shards:
+            remove_embedding_index( embedding_index_folder + name )
+    else:
+        ## keep the old delta shards, otherwise the running ranking service would lose them
+        post_to_ranking_service( "/update-ranking-index", { "shards":delta_shards, "action":"attach" } )
+        remove_embedding_index( embedding_index_folder + compacted_shard )
+
+
+def compact_delta_segments():
+    """
+        Merge policy of the delta segments: once there are more than MAX_NUM_INVERTED_INDEX_DELTA_SEGMENTS of them,
+        they are merged into a single delta segment covering their id ranges, which then replaces them in the ranking service.
+        The embedding shards of the deltas follow the same policy, with the threshold MAX_NUM_EMBEDDING_INDEX_DELTA_SHARDS.
+    """
+    global sem
+    
+    sem.acquire()
+    try:
+        compact_inverted_index_delta_segments()
+    except:
+        print("Compacting the delta segments of the inverted index failed!")
+    try:
+        compact_embedding_index_delta_shards()
+    except:
+        print("Compacting the delta shards of the embedding index failed!")
+    sem.release()
+
+
+@app.route('/index-new-documents', methods=['POST'])
+def index_new_documents_route():
+    global sem
+    
+    sem.acquire()
+    
+    try:
+        if not request.json:
+            assert False
+        request_info = request.json
+        id_start = int( request_info["id_start"] )
+        id_end = int( request_info["id_end"] )
+        assert 0 < id_start <= id_end
+        
+        index_new_documents( id_start, id_end )
+        results = {"response":"success"}
+    except:
+        results = {"response":"fail"}
+    
+    sem.release()
+    
+    ## the merge runs in the background, so that ingesting a few papers is not slowed down by it
+    threading.Thread( target = compact_delta_segments ).start()
+    
+    return json.dumps(results), 201
+
+
 @app.route('/build-index', methods=['POST'])
 def build_index():
     global sem
@@ -205,7 +434,10 @@ if __name__ == '__main__':
         ## In this case, the service for paper database, ranking and duplicate checking cannot be running, so we cannot signal them to reboot by sending http requests. Therefore, we set reboot_services_after_building to False
         build_index_pipeline(reboot_services_after_building = False)
         
-    if len( glob( ROOT_DATA_PATH + "/ranking/embedding_index/embedding_index.db*" ) ) != NUM_EMBEDDING_INDEX_SHARDS:
+    ## the delta shards added by index_new_documents() are not counted
+    base_embedding_shards = [ name for name in glob( ROOT_DATA_PATH + "/ranking/embedding_index/embedding_index.db_*" ) 
+                              if "_delta_" not in os.path.basename( name ) and name.split("_")[-1].isdigit() ]
+    if len( base_embedding_shards ) != NUM_EMBEDDING_INDEX_SHARDS:
         print("Specified number of embedding index has changed, adjusting the number of shards ...")
         adjust_num_shards_for_embedding_index()
         
@@ -53,6 +53,14 @@ def rebuild_index():
         data = json.dumps({}),
         headers = {"Content-Type":"application/json", "Connection": "close"}
     )
+
+def index_new_documents( id_start, id_end ):
+    ## only the papers with id_int in [id_start, id_end] are indexed (as delta segments), instead of rebuilding the whole index
+    requests.post(
+        ADDRESS_SERVICE_BUILD_INDEX + "/index-new-documents",
+        data = json.dumps({ "id_start":id_start, "id_end":id_end }),
+        headers = {"Content-Type":"application/json", "Connection": "close"}
+    )
             
 def bytes_to_base64_string(f_bytes):
     return base64.b64encode(f_bytes).decode('ASCII')
@@ -216,7 +224,7 @@ def index_pdfs():
         results_paper_ids = existing_paper_ids + newly_parsed_paper_ids
 
         if len(newly_parsed_paper_ids) > 0 and update_index_immediately:
-            rebuild_index()
+            index_new_documents( prev_max_row_id+1, post_max_row_id )
             
     except:
         results_paper_ids = []
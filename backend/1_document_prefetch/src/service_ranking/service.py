@@ -15,12 +15,12 @@ import uuid
 import multiprocessing as mp
 
 from modules.ranking.inverted_index import OnDiskInvertedIndex
-from modules.ranking.rankers import Ranker, Sent2vecEncoder
+from modules.ranking.rankers import Ranker, Sent2vecEncoder, CPU_QUANTIZED_INDICES
 
 import GPUtil
 
 import time
-from modules.service_utils.utils import wait_for_service
+from modules.service_utils.utils import wait_for_service, ReadWriteLock
 
 # Make Flask application
 app = Flask(__name__)
@@ -34,6 +34,8 @@ IS_PRIVATE_SERVER = int( os.getenv("IS_PRIVATE_SERVER") )
 USE_GPU = int( os.getenv("USE_GPU") )
 
 EMBEDDING_INDEX_PRECISION = os.getenv("EMBEDDING_INDEX_PRECISION")
+## approximate nearest neighbor search on CPU: "scann" or "hnsw"
+ANN_BACKEND = os.getenv("ANN_BACKEND", "scann")
 
 SERVICE_SUFFIX = os.getenv("SERVICE_SUFFIX")
 
@@ -41,10 +43,46 @@ SERVICE_SUFFIX = os.getenv("SERVICE_SUFFIX")
 ADDRESS_SERVICE_BUILD_INDEX = f"http://document_prefetch_service_build_index_{SERVICE_SUFFIX}:8060"
 
 
-def get_top_n( n, query,  keyword_filtering_results = None, doc_id_list = None , require_tokenize = True, ranking_shard_id_list = None ):
+def get_top_n( n, query,  keyword_filtering_results = None, doc_id_list = None , require_tokenize = True, ranking_shard_id_list = None, search_params = None ):
     global  encoder, ranker
     query_embedding = encoder.encode( [query], require_tokenize )[0]
-    return ranker.get_top_n_given_embedding( n, query_embedding, keyword_filtering_results, doc_id_list, ranking_shard_id_list )
+    return ranker.get_top_n_given_embedding( n, query_embedding, keyword_filtering_results, doc_id_list, ranking_shard_id_list, search_params )
+
+def get_top_n_bm25( n, query, keywords = "", doc_id_list = None ):
+    """
+        Lexical fast path: rank by BM25 directly from the inverted index, without encoding the query or touching the embedding shards.
+        Return the results in the same format as get_top_n(), and the number of documents matched by the keywords.
+    """
+    global on_disk_inv_idx
+    if doc_id_list is not None:
+        doc_id_list = [ int( doc_id["id_value"] ) for doc_id in doc_id_list 
+                          if doc_id.get("collection") == on_disk_inv_idx.collection and doc_id.get("id_field") == "id_int" ]
+    ( doc_ids, scores ), num_matched_documents = on_disk_inv_idx.get_top_n_bm25( n, query, keywords, doc_id_list )
+    results = [ { "collection":on_disk_inv_idx.collection, "id_field":"id_int", "id_type":"int", "id_value":int(doc_id) } for doc_id in doc_ids ]
+    return results, num_matched_documents
+
+def get_base_ranker_para( shard_id ):
+    global args
+    return {
+        ## By default, we use the base name of the embedding path as the shard_id
+        "shard_id": shard_id,
+        "embedding_path": args.embedding_index_folder +"/"+ shard_id, 
+        "vector_dim":args.vector_dim,
+        "gpu_list":args.gpu_list,
+        "internal_precision" : args.internal_precision,
+        "requires_precision_conversion":args.requires_precision_conversion ,
+        "num_threads": args.num_threads_per_shard,
+        "normalize_query_embedding" : args.normalize_query_embedding,
+        "final_num_neighbors": args.scann_final_num_neighbors,
+        "leaves_to_search": args.scann_leaves_to_search,
+        "pre_reorder_num_neighbors": args.scann_pre_reorder_num_neighbors,
+        "adaptive_search": args.scann_adaptive_search,
+        "search_latency_budget_ms": args.scann_latency_budget_ms,
+        "ann_backend": args.ann_backend,
+        "hnsw_m": args.hnsw_m,
+        "hnsw_ef_construction": args.hnsw_ef_construction,
+        "hnsw_ef_search": args.hnsw_ef_search
+    }
 
 def detach_embedding_index_shards( shards ):
     global ranker
@@ -54,30 +92,20 @@ def detach_embedding_index_shards( shards ):
 def attach_embedding_index_shards( shards ):
     global ranker, args
     detach_embedding_index_shards( shards )
-    base_ranker_para_list = [
-        {
-            "shard_id": shard_id,
-            "embedding_path": args.embedding_index_folder +"/"+ shard_id, 
-            "vector_dim":args.vector_dim,
-            "gpu_list":args.gpu_list,
-            "internal_precision" : args.internal_precision,
-            "requires_precision_conversion":args.requires_precision_conversion ,
-            "num_threads": args.num_threads_per_shard,
-            "normalize_query_embedding" : args.normalize_query_embedding 
-        }
-        for shard_id in shards if os.path.exists( args.embedding_index_folder +"/"+ shard_id )
-    ]
-    updating_ranker = Ranker( base_ranker_para_list, ranker.num_of_processes_of_gpu )
+    base_ranker_para_list = [ get_base_ranker_para( shard_id ) for shard_id in shards if os.path.exists( args.embedding_index_folder +"/"+ shard_id ) ]
+    ## the new shard processes keep the results of as many batches as the ranker has in flight
+    updating_ranker = Ranker( base_ranker_para_list, ranker.num_of_processes_of_gpu, max_in_flight_batches = ranker.max_in_flight_batches )
     ranker.update_shards( updating_ranker )
         
 @app.route('/document-search', methods=['POST'])
 def document_search():
 
     """Document search API route"""
-    global sem,  on_disk_inv_idx, ranker, args
+    global rw_lock,  on_disk_inv_idx, ranker, args
     
-    ## currently our search function does not support concurrent request
-    sem.acquire()
+    ## the searches run concurrently, the ranker batches the embedding queries of concurrent requests; 
+    ## the updates of the shards wait until the running searches are done
+    rw_lock.acquire_read()
 
     try:
         try:
@@ -98,17 +126,25 @@ def document_search():
         else:
             paper_list = request_info["paper_list"] 
                 
+        ## "embedding": rank by the embedding similarity to ranking_source; "bm25": rank by the BM25 score of ranking_source (or of the keywords if empty)
+        ranking_mode = request_info.get("ranking_mode", args.default_ranking_mode)
+        ## optional ScaNN / HNSW search parameters of the embedding ranking on CPU, overriding the ones of the shards, e.g. 
+        ## {"final_num_neighbors":5000, "leaves_to_search":200, "pre_reorder_num_neighbors":5000, "adaptive":1, "latency_budget_ms":500}
+        ## or {"ef_search":512} with the HNSW backend
+        search_params = request_info.get("search_params", None)
+        if not isinstance( search_params, dict ):
+            search_params = None
+        
         tic = time.time()
         keywords = keywords.strip()
-        if keywords == "":
+        if ranking_mode == "bm25":
+            results, num_matched_documents = get_top_n_bm25( n_results, ranking_source if ranking_source.strip() != "" else keywords, keywords, paper_list )
+        elif keywords == "":
             num_matched_documents = on_disk_inv_idx.num_matched_documents
-            results = get_top_n( n_results, ranking_source, keyword_filtering_results = None, doc_id_list = paper_list )
+            results = get_top_n( n_results, ranking_source, keyword_filtering_results = None, doc_id_list = paper_list, search_params = search_params )
         else:
-            filtered_results = on_disk_inv_idx.get( keywords )
-            num_matched_documents = 0
-            for c in filtered_results:
-                num_matched_documents += int(np.sum(filtered_results[c] ))
-            results = get_top_n( n_results, ranking_source, keyword_filtering_results = filtered_results, doc_id_list = paper_list )  
+            filtered_results, num_matched_documents = on_disk_inv_idx.get_with_count( keywords, packed = True )
+            results = get_top_n( n_results, ranking_source, keyword_filtering_results = filtered_results, doc_id_list = paper_list, search_params = search_params )  
             
         tac = time.time()
         print("doc search time:", tac - tic)
@@ -120,15 +156,40 @@ def document_search():
         json_out = json.dumps({"response":[], "nMatchingDocuments":0}) 
         logging.info("Doc search failed.") 
 
-    sem.release()
+    rw_lock.release_read()
+    return json_out, 201
+
+
+@app.route('/document-count', methods=['POST'])
+def document_count():
+    """Number of documents matched by the keywords, without ranking them"""
+    global rw_lock, on_disk_inv_idx
+    
+    rw_lock.acquire_read()
+    
+    try:
+        try:
+            request_info = request.json
+        except:
+            request_info = {}
+        keywords = request_info.get("keywords", "").strip()
+        ## approximate: broad queries are counted on a sample of the documents
+        approximate = bool( request_info.get("approximate", 0) )
+        
+        num_matched_documents, is_exact = on_disk_inv_idx.count( keywords, approximate = approximate )
+        json_out = json.dumps({"nMatchingDocuments":num_matched_documents, "isExact":int(is_exact)})
+    except:
+        json_out = json.dumps({"nMatchingDocuments":0, "isExact":0})
+        
+    rw_lock.release_read()
     return json_out, 201
 
 
 @app.route('/reboot', methods=['POST'])
 def reboot():
-    global args, ranker, on_disk_inv_idx, sem
+    global args, ranker, on_disk_inv_idx, rw_lock
 
-    sem.acquire()
+    rw_lock.acquire_write()
     try:        
         shards = list(ranker.rank_process_dict.keys())
         detach_embedding_index_shards( shards )
@@ -144,15 +205,15 @@ def reboot():
     except:
         msg = {"response":"fail"}
 
-    sem.release()
+    rw_lock.release_write()
     return jsonify(msg), 201
 
 
 @app.route('/reboot-ranking-index', methods=['POST'])
 def reboot_ranking_index():
-    global args, ranker, sem
+    global args, ranker, rw_lock
 
-    sem.acquire()
+    rw_lock.acquire_write()
     try:        
         shards = list(ranker.rank_process_dict.keys())
         detach_embedding_index_shards( shards )
@@ -165,14 +226,14 @@ def reboot_ranking_index():
     except:
         msg = {"response":"fail"}
 
-    sem.release()
+    rw_lock.release_write()
     return jsonify(msg), 201
 
 @app.route('/reboot-inverted-index', methods=['POST'])
 def reboot_inverted_index():
-    global args, on_disk_inv_idx, sem
+    global args, on_disk_inv_idx, rw_lock
 
-    sem.acquire()
+    rw_lock.acquire_write()
 
     try:
         on_disk_inv_idx.initiate()
@@ -180,15 +241,27 @@ def reboot_inverted_index():
     except:
         msg = {"response":"fail"}
 
-    sem.release()
+    rw_lock.release_write()
+    return jsonify(msg), 201
+
+
+@app.route('/inverted-index-cache-stats', methods=['POST'])
+def inverted_index_cache_stats():
+    global on_disk_inv_idx
+
+    try:
+        msg = {"response":on_disk_inv_idx.get_cache_stats()}
+    except:
+        msg = {"response":{}}
+
     return jsonify(msg), 201
 
 
 @app.route('/update-ranking-index', methods=['POST'])
 def update_ranking_index():
-    global args, ranker, sem
+    global args, ranker, rw_lock
 
-    sem.acquire()
+    rw_lock.acquire_write()
 
     try:
         if not request.json:
@@ -225,15 +298,15 @@ def update_ranking_index():
         
               }
     print(msg)
-    sem.release()
+    rw_lock.release_write()
     return jsonify(msg), 201
 
 
 @app.route('/update-inverted-index', methods=['POST'])
 def update_inverted_index():
-    global args, on_disk_inv_idx, sem
+    global args, on_disk_inv_idx, rw_lock
 
-    sem.acquire()
+    rw_lock.acquire_write()
 
     try:
         if not request.json:
@@ -254,13 +327,25 @@ def update_inverted_index():
                        }
                   }
         elif action == "attach":
-            on_disk_inv_idx.initiate()   
+            ## only the new shards are opened, e.g. the delta segment of newly added papers
+            on_disk_inv_idx.attach_shards( shards )
             msg = {"response":{
                         "info":"%d inverted index shards attached:\n\t"%(len(shards))+"\n\t".join( shards ),
                         "success":1
                        }
             
                   }
+        elif action == "replace":
+            ## swap the shards in one step, e.g. several delta segments for the segment they were compacted into
+            replaced_shards = request_info.get("replaced_shards", [])
+            if not isinstance( replaced_shards, list ):
+                replaced_shards = []
+            on_disk_inv_idx.replace_shards( replaced_shards, shards )
+            msg = {"response":{
+                        "info":"%d inverted index shards replaced by:\n\t"%(len(replaced_shards))+"\n\t".join( shards ),
+                        "success":1
+                       }
+                  }
     except:
         msg = {"response":{
                     "info":"Inverted index deletion/updating failed! Make sure the shards to be detached/attached are all within folder %s !"%( args.inverted_index_folder ),
@@ -269,7 +354,7 @@ def update_inverted_index():
               }
 
     print(msg)
-    sem.release()
+    rw_lock.release_write()
 
     return jsonify(msg), 201
 
@@ -288,8 +373,47 @@ if __name__ == "__main__":
     parser.add_argument( "-requires_precision_conversion", type = int, default = 1 )
     parser.add_argument( "-num_threads_per_shard", type = int, default = 1 )
     parser.add_argument( "-normalize_query_embedding", type = int, default = 1 )
+    ## result cache of the keyword filtering: maximum number of entries (0 disables it), time-to-live in seconds and memory budget in MB
+    parser.add_argument( "-inverted_index_cache_size", type = int, default = 1024 )
+    parser.add_argument( "-inverted_index_cache_ttl", type = float, default = 3600 )
+    parser.add_argument( "-inverted_index_cache_max_memory_mb", type = float, default = 512 )
+    ## number of threads evaluating the inverted index shards in parallel (default: number of cores)
+    parser.add_argument( "-inverted_index_num_workers", type = int, default = None )
+    ## /document-count with "approximate" samples the queries estimated to match at least this number of documents
+    parser.add_argument( "-inverted_index_approximate_count_threshold", type = int, default = 1000000 )
+    ## a wildcard word (e.g. "transform*") is expanded into at most this number of indexed terms
+    parser.add_argument( "-inverted_index_max_expansions", type = int, default = 128 )
+    ## ranking mode of the requests that do not specify one: "embedding" or "bm25" (see /document-search)
+    parser.add_argument( "-default_ranking_mode", default = "embedding", choices = [ "embedding", "bm25" ] )
+    ## ScaNN search of each shard on CPU, can be overridden per request with "search_params" (see /document-search):
+    ## number of neighbors (default: nResults), leaves to search, neighbors reordered with the exact similarity, 
+    ## adaptive widening of the search until nResults are found, and the time budget of this widening in ms (<=0: no limit)
+    parser.add_argument( "-scann_final_num_neighbors", type = int, default = None )
+    parser.add_argument( "-scann_leaves_to_search", type = int, default = 100 )
+    parser.add_argument( "-scann_pre_reorder_num_neighbors", type = int, default = 100 )
+    parser.add_argument( "-scann_adaptive_search", type = int, default = 1 )
+    parser.add_argument( "-scann_latency_budget_ms", type = float, default = 200 )
+    ## ANN backend of the shards on CPU (with the float32 precision): ScaNN, or an HNSW graph saved next to each shard 
+    ## (built by the build index service with the same ANN_BACKEND; a shard without an up-to-date graph is served by ScaNN);
+    ## HNSW: maximum number of neighbors per node, candidate list size when building, and when searching ("ef_search" in "search_params")
+    parser.add_argument( "-ann_backend", default = ANN_BACKEND, choices = [ "scann", "hnsw" ],
+                         help = "hnsw: the graphs are built by build_hnsw_indices.py, never by this service. With the default -hnsw_m/-hnsw_ef_construction, "
+                                "the build of a shard of 700-dim embeddings on one core takes about 5 s for 20k embeddings and 70 s for 100k, growing faster than linearly, "
+                                "so a shard of 1M embeddings takes tens of core-minutes (the search part of the build is spread over the cores). "
+                                "Shards without an up-to-date graph fall back to ScaNN" )
+    parser.add_argument( "-hnsw_m", type = int, default = 16 )
+    parser.add_argument( "-hnsw_ef_construction", type = int, default = 100 )
+    parser.add_argument( "-hnsw_ef_search", type = int, default = 128 )
+    ## the embedding queries of concurrent requests are collected for up to this time (ms) and searched as one batch of at most this size per shard
+    parser.add_argument( "-ranking_batch_window_ms", type = float, default = 2 )
+    parser.add_argument( "-ranking_max_batch_size", type = int, default = 64 )
+    ## per shard process: at most this many batches wait to be sent, and at most this many are sent and not answered yet
+    parser.add_argument( "-ranking_max_queued_batches", type = int, default = 16 )
+    parser.add_argument( "-ranking_max_in_flight_batches", type = int, default = 4 )
     
     args = parser.parse_args()
+    if args.scann_latency_budget_ms <= 0:
+        args.scann_latency_budget_ms = None
     
     wait_for_service(ADDRESS_SERVICE_BUILD_INDEX)
     
@@ -298,7 +422,13 @@ if __name__ == "__main__":
     args.embedding_index_folder = os.path.abspath( args.embedding_index_folder )
     args.encoding_model_path = os.path.abspath(  args.encoding_model_path  )
     
-    on_disk_inv_idx = OnDiskInvertedIndex( args.inverted_index_folder )
+    on_disk_inv_idx = OnDiskInvertedIndex( args.inverted_index_folder, 
+                                           cache_size = args.inverted_index_cache_size,
+                                           cache_ttl = args.inverted_index_cache_ttl,
+                                           cache_max_nbytes = int( args.inverted_index_cache_max_memory_mb * 1024**2 ),
+                                           num_workers = args.inverted_index_num_workers,
+                                           approximate_count_threshold = args.inverted_index_approximate_count_threshold,
+                                           max_expansions = args.inverted_index_max_expansions )
     encoder = Sent2vecEncoder( args.encoding_model_path )
     
     args.vector_dim = encoder.model.get_emb_size()
@@ -312,7 +442,8 @@ if __name__ == "__main__":
     else:
         args.gpu_list = []
         
-    if len(args.gpu_list) == 0:
+    ## on CPU, int8 and bool select the search on compact codes, the other precisions fall back to the float32 ANN
+    if len(args.gpu_list) == 0 and args.internal_precision not in CPU_QUANTIZED_INDICES:
         args.internal_precision = "float32"
         
     mp.set_start_method('spawn')
@@ -320,22 +451,17 @@ if __name__ == "__main__":
     shard_list = os.listdir(args.embedding_index_folder)
     base_ranker_para_list = []
     for shard_name in shard_list:
-        base_ranker_para_list.append( {
-                    ## By default, we use the base name of the embedding path as the shard_id
-                    "shard_id": shard_name,
-                    "embedding_path": args.embedding_index_folder +"/"+ shard_name, 
-                    "vector_dim":args.vector_dim,
-                    "gpu_list":args.gpu_list,
-                    "internal_precision" : args.internal_precision,
-                    "requires_precision_conversion":args.requires_precision_conversion ,
-                    "num_threads": args.num_threads_per_shard,
-                    "normalize_query_embedding" : args.normalize_query_embedding })
-
-    ranker = Ranker(base_ranker_para_list )
+        base_ranker_para_list.append( get_base_ranker_para( shard_name ) )
+
+    ranker = Ranker(base_ranker_para_list, batch_window_ms = args.ranking_batch_window_ms, max_batch_size = args.ranking_max_batch_size,
+                    max_queued_batches = args.ranking_max_queued_batches, max_in_flight_batches = args.ranking_max_in_flight_batches )
 
     get_top_n( 10, "warm-up query" )
     
-    sem = threading.Semaphore()
+    rw_lock = ReadWriteLock()
 
     print("\n\nWaiting for requests...")
-    app.run(host='0.0.0.0', port=args.flask_port, threaded = True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=args.flask_port, threaded = True)
+    
+    ## stop the shard processes and release the shared memory when the server stops
+    ranker.close()
\ No newline at end of file